@@ -0,0 +1,305 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact, lossy encoding of sketch data, for archiving .tilts.
+
+Control points are stored as columns, then zlib-compressed:
+  position     Quantized to multiples of the position step (by default
+               POSITION_STEP). Each stroke's first position is stored
+               as a varint; the rest as deltas from the previous position,
+               in the narrowest integer type that holds them all
+  orientation  "Smallest three" packing of the unit quaternion into 32 bits
+  pressure     Quantized to 16 bits, if it's within [0, 1]; else unchanged
+  timestamp    Deltas from the previous control point, as zigzag varints
+Everything else, including the stroke headers, is stored exactly.
+
+The error this introduces is at most:
+  position     position_step / 2 in each of x, y and z, plus float32 rounding
+  orientation  MAX_ANGLE_ERROR degrees. Orientations are normalized, and
+               may come back negated (which is the same rotation).
+  pressure     0.5 / 65535
+
+Sketch.write(destination, archival=True) writes sketch data this way.
+Sketch(), Sketch.probe(), Sketch.iter() and Tilt.stroke_index read it like
+any other, but decode all of it first, so they lose their advantages
+(skipping or streaming control points) for archived sketches. Tilt Brush
+can't read it at all, so restore_tilt() a .tilt before using it there.
+Requires numpy."""
+
+import struct
+import zlib
+from cStringIO import StringIO
+
+import numpy
+
+from tiltbrush.tilt import Tilt, Sketch, Stroke, binfile, bufferfile, \
+    CONTROLPOINT_EXTENSION_BITS, _ARCHIVE_MAGIC, _get_ext_infos, _make_cp_codec, \
+    _make_cp_dtype, _read_sketch_header
+
+__all__ = ('POSITION_STEP', 'MAX_ANGLE_ERROR', 'encode', 'decode', 'archive_tilt',
+           'restore_tilt')
+
+# Default position quantization, in decimeters
+POSITION_STEP = 1e-4
+
+# Bound on the orientation error, in degrees; see _pack_orientations()
+MAX_ANGLE_ERROR = 0.3
+
+VERSION = 1
+_HEADER = struct.Struct('<4sII')    # magic, version, zlib-compressed length
+
+# Encodings of an extension column
+_EXACT, _UNIT16, _DELTA = range(3)
+
+
+def encode(sketch, position_step=POSITION_STEP):
+  """Returns the sketch data of *sketch* (a Sketch, or anything with the
+  same .header, .additional_header and .strokes), archived."""
+  strokes = sketch.strokes
+  records = [stroke.controlpoint_array() for stroke in strokes]
+  body = StringIO()
+  b = binfile(body)
+  b.pack('<3I', *sketch.header)
+  b.write_length_prefixed(sketch.additional_header)
+  b.pack('<id', len(strokes), position_step)
+
+  headers = StringIO()
+  for (stroke, stroke_records) in zip(strokes, records):
+    stroke._write_header(binfile(headers), len(stroke_records))
+  b.write_length_prefixed(headers.getvalue())
+
+  positions = _concatenate([r['position'] for r in records], (0, 3))
+  if not numpy.isfinite(positions).all():
+    raise ValueError("Can't archive non-finite control point positions")
+  quantized = numpy.rint(positions / position_step).astype(numpy.int64)
+  counts = numpy.array([len(r) for r in records], dtype=numpy.int64)
+  first_rows = _starts(counts)[counts > 0]
+  b.write_length_prefixed(_encode_deltas(quantized[first_rows].T.ravel()))
+  deltas = numpy.diff(quantized, axis=0, prepend=quantized[:1])
+  deltas[first_rows] = 0
+  for dtype in ('<i1', '<i2', '<i4', '<i8'):
+    info = numpy.iinfo(dtype)
+    if deltas.size == 0 or info.min <= deltas.min() and deltas.max() <= info.max:
+      break
+  b.pack('<B', numpy.dtype(dtype).itemsize)
+  b.write_length_prefixed(deltas.T.astype(dtype).tostring())
+  orientations = _concatenate([r['orientation'] for r in records], (0, 4))
+  b.write_length_prefixed(_pack_orientations(orientations).astype('<u4').tostring())
+
+  for name in _extension_names(strokes):
+    values = _concatenate([r[name] for r in records if name in r.dtype.names], (0,))
+    if name == 'pressure' and ((values >= 0) & (values <= 1)).all():
+      (encoding, data) = (_UNIT16, numpy.rint(values * 65535).astype('<u2').tostring())
+    elif name == 'timestamp':
+      (encoding, data) = (_DELTA, _encode_deltas(values.astype(numpy.int64)))
+    else:
+      (encoding, data) = (_EXACT, values.tostring())
+    b.pack('<B', encoding)
+    b.write_length_prefixed(data)
+
+  compressed = zlib.compress(body.getvalue(), 9)
+  return _HEADER.pack(_ARCHIVE_MAGIC, VERSION, len(compressed)) + compressed
+
+
+def decode(data):
+  """Returns (header, additional_header, strokes) decoded from the archived
+  sketch data *data*. The strokes' control points are re-encoded in the
+  standard format, ready to be written; they aren't decoded until used."""
+  (magic, version, length) = _HEADER.unpack_from(data)
+  if magic != _ARCHIVE_MAGIC:
+    raise ValueError('Not archived sketch data')
+  if version != VERSION:
+    raise ValueError('Unsupported sketch archive version %d' % version)
+  body = zlib.decompress(buffer(data, _HEADER.size, length))
+  b = binfile(bufferfile(body))
+  (header, additional_header, num_strokes) = _read_sketch_header(b)
+  (position_step,) = b.unpack('<d')
+
+  headers = binfile(bufferfile(b.read_length_prefixed()))
+  strokes = []
+  counts = numpy.empty(num_strokes, dtype=numpy.int64)
+  for i in xrange(num_strokes):
+    stroke = Stroke()
+    counts[i] = stroke._parse_header(headers)
+    strokes.append(stroke)
+  dtypes = [_make_cp_dtype(s.cp_mask) for s in strokes]
+
+  starts = _starts(counts)
+  nonempty = counts > 0
+  firsts = _decode_deltas(b.read_length_prefixed()).reshape(3, -1)
+  (itemsize,) = b.unpack('<B')
+  deltas = numpy.frombuffer(b.read_length_prefixed(), '<i%d' % itemsize).reshape(3, -1)
+  positions = numpy.cumsum(deltas, axis=1, dtype=numpy.int64)
+  positions += numpy.repeat(firsts - positions[:, starts[nonempty]], counts[nonempty], axis=1)
+  positions = positions.T * position_step
+  orientations = _unpack_orientations(numpy.frombuffer(b.read_length_prefixed(), '<u4'))
+  # Extension columns only have rows for the strokes with that extension, so
+  # each has its own offsets
+  extensions = {}
+  for name in _extension_names(strokes):
+    (encoding,) = b.unpack('<B')
+    data = b.read_length_prefixed()
+    has_name = numpy.array([name in dtype.names for dtype in dtypes])
+    if encoding == _UNIT16:
+      values = numpy.frombuffer(data, '<u2') / 65535.0
+    elif encoding == _DELTA:
+      values = _decode_deltas(data)
+    else:
+      values = numpy.frombuffer(data, dtypes[has_name.argmax()][name])
+    extensions[name] = (values, _starts(counts * has_name))
+
+  # Re-encode in the standard format, one cp_mask at a time
+  by_mask = {}
+  for (i, stroke) in enumerate(strokes):
+    by_mask.setdefault(stroke.cp_mask, []).append(i)
+  for (cp_mask, indices) in by_mask.iteritems():
+    indices = numpy.array(indices)
+    if len(indices) == num_strokes:
+      rows = slice(None)
+    else:
+      rows = _rows(starts[indices], counts[indices])
+    records = numpy.empty(counts[indices].sum(), dtype=_make_cp_dtype(cp_mask))
+    records['position'] = positions[rows]
+    records['orientation'] = orientations[rows]
+    for name in records.dtype.names[2:]:
+      (values, offsets) = extensions[name]
+      records[name] = values[rows if len(indices) == num_strokes else
+                             _rows(offsets[indices], counts[indices])]
+    data = records.tostring()
+    cp_decode = _make_cp_codec(cp_mask)[0]
+    pos = 0
+    for i in indices.tolist():
+      size = int(counts[i]) * records.itemsize
+      strokes[i]._controlpoints = (cp_decode, int(counts[i]), buffer(data, pos, size))
+      pos += size
+  return (header, additional_header, strokes)
+
+
+def archive_tilt(filename, position_step=POSITION_STEP):
+  """Archives the sketch data of the .tilt *filename* in place. Returns
+  (old size, new size) of the sketch data."""
+  with Tilt(filename, keep_open=True) as tilt:
+    sketch = Sketch(tilt)
+    old_size = tilt._subfile_key('data.sketch')[1]
+    data = encode(sketch, position_step)
+    with tilt.subfile_writer('data.sketch') as outf:
+      outf.write(data)
+  return (old_size, len(data))
+
+
+def restore_tilt(filename):
+  """Rewrites the archived sketch data of the .tilt *filename* in the
+  standard format, so Tilt Brush can read it."""
+  with Tilt(filename, keep_open=True) as tilt:
+    Sketch(tilt).write(tilt)
+
+
+def _concatenate(arrays, empty_shape):
+  return numpy.concatenate(arrays) if arrays else numpy.empty(empty_shape)
+
+
+def _extension_names(strokes):
+  """Returns the names of the control point extensions used by any of
+  *strokes*, in file order."""
+  cp_mask = 0
+  for stroke in strokes:
+    cp_mask |= stroke.cp_mask
+  return [name for (name, _) in _get_ext_infos(CONTROLPOINT_EXTENSION_BITS, cp_mask)]
+
+
+def _starts(counts):
+  """Returns where each of a run of blocks of *counts* rows starts."""
+  starts = numpy.zeros(len(counts), dtype=numpy.int64)
+  numpy.cumsum(counts[:-1], out=starts[1:])
+  return starts
+
+
+def _rows(starts, counts):
+  """Returns the concatenation of ranges [starts[i], starts[i] + counts[i])."""
+  return numpy.repeat(starts - _starts(counts), counts) + numpy.arange(counts.sum())
+
+
+#
+# Integer columns
+#
+
+def _encode_deltas(values):
+  """Returns the deltas between the int64 *values*, as zigzag varints."""
+  deltas = numpy.diff(values, prepend=0) if values.size else values
+  zigzag = ((deltas << 1) ^ (deltas >> 63)).astype(numpy.uint64)
+  # Seven bits per byte; the high bit is set on all but the last
+  num_bytes = numpy.ones(len(zigzag), dtype=numpy.int64)
+  for i in xrange(1, 10):
+    num_bytes += zigzag >= (numpy.uint64(1) << numpy.uint64(7 * i))
+  index = _rows(numpy.zeros(len(zigzag), dtype=numpy.int64), num_bytes)
+  values = numpy.repeat(zigzag, num_bytes) >> (7 * index).astype(numpy.uint64)
+  more = index < numpy.repeat(num_bytes - 1, num_bytes)
+  return ((values & numpy.uint64(0x7f)) | (more * numpy.uint64(0x80))).astype(numpy.uint8).tostring()
+
+
+def _decode_deltas(data):
+  """The inverse of _encode_deltas(); returns an int64 array."""
+  data = numpy.frombuffer(data, dtype=numpy.uint8)
+  if len(data) == 0:
+    return numpy.empty(0, dtype=numpy.int64)
+  ends = numpy.flatnonzero(data < 0x80)
+  starts = numpy.concatenate([[0], ends[:-1] + 1]).astype(numpy.int64)
+  index = _rows(numpy.zeros(len(starts), dtype=numpy.int64), ends - starts + 1)
+  parts = (data & 0x7f).astype(numpy.uint64) << (7 * index).astype(numpy.uint64)
+  zigzag = numpy.add.reduceat(parts, starts)
+  deltas = (zigzag >> numpy.uint64(1)).astype(numpy.int64) ^ -(zigzag & numpy.uint64(1)).astype(numpy.int64)
+  return numpy.cumsum(deltas)
+
+
+#
+# Orientations
+#
+
+# Largest component -> the other three, in order
+_OTHERS = numpy.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+# Largest component -> where each component is in (other three, largest)
+_SOURCES = numpy.array([[3, 0, 1, 2], [0, 3, 1, 2], [0, 1, 3, 2], [0, 1, 2, 3]])
+_BITS = 10
+_SCALE = ((1 << _BITS) - 1) / numpy.sqrt(2)
+
+
+def _pack_orientations(orientations):
+  """Packs unit quaternions into uint32s: 2 bits saying which component is
+  largest, then the other three, which are within +/- 1/sqrt(2), in 10
+  bits each. The largest is made positive, so it can be recomputed from
+  the others. Each of those is off by at most sqrt(2)/2046 (about 0.0007),
+  which keeps the angle within MAX_ANGLE_ERROR."""
+  q = numpy.asarray(orientations, dtype=numpy.float64)
+  norms = numpy.sqrt((q * q).sum(1))
+  q = numpy.where((norms > 0)[:, None], q / numpy.where(norms > 0, norms, 1)[:, None],
+                  [0, 0, 0, 1])
+  rows = numpy.arange(len(q))
+  largest = numpy.abs(q).argmax(1)
+  q *= numpy.where(q[rows, largest] < 0, -1, 1)[:, None]
+  others = q[rows[:, None], _OTHERS[largest]]
+  quantized = numpy.clip(numpy.rint((others + 1 / numpy.sqrt(2)) * _SCALE), 0, (1 << _BITS) - 1)
+  quantized = quantized.astype(numpy.uint32)
+  return ((largest.astype(numpy.uint32) << 30) | (quantized[:, 0] << 20) |
+          (quantized[:, 1] << 10) | quantized[:, 2])
+
+
+def _unpack_orientations(packed):
+  """The inverse of _pack_orientations(); returns float32 quaternions."""
+  packed = packed.astype(numpy.uint32)
+  largest = (packed >> 30).astype(numpy.int64)
+  mask = (1 << _BITS) - 1
+  others = numpy.stack([(packed >> 20) & mask, (packed >> 10) & mask, packed & mask], axis=1)
+  others = others / _SCALE - 1 / numpy.sqrt(2)
+  w = numpy.sqrt(numpy.maximum(0, 1 - (others * others).sum(1)))
+  return numpy.take_along_axis(numpy.column_stack([others, w]), _SOURCES[largest], 1)
@@ -0,0 +1,203 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps an on-disk index of the .tilt files in a directory tree, so
+questions like "which sketches use this brush?" can be answered without
+opening any of them. The main export is Catalog."""
+
+import json
+import os
+import sqlite3
+
+from tiltbrush import library
+from tiltbrush.tilt import BadMetadata, validate_metadata
+
+__all__ = ('Catalog',)
+
+SCHEMA_VERSION = 2
+
+_SCHEMA = '''
+CREATE TABLE files (
+  id INTEGER PRIMARY KEY,
+  filename TEXT UNIQUE NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  error TEXT,           -- Set if the .tilt could not be read at all
+  metadata_error TEXT,  -- Set if metadata.json fails validate_metadata()
+  metadata TEXT,        -- metadata.json, as json
+  environment TEXT,     -- EnvironmentPreset GUID, lowercased
+  num_strokes INTEGER,
+  bounds TEXT           -- As json; see library.summarize()
+);
+CREATE INDEX files_environment ON files (environment);
+CREATE TABLE brushes (
+  file_id INTEGER NOT NULL,
+  guid TEXT NOT NULL,   -- Lowercased
+  num_strokes INTEGER NOT NULL,
+  PRIMARY KEY (file_id, guid)
+);
+CREATE INDEX brushes_guid ON brushes (guid);
+'''
+
+# Commit after this many files, so an interrupted update() keeps its progress
+_BATCH_SIZE = 100
+
+
+def _lower(guid):
+  # GUIDs are case-insensitive. Metadata may hold anything, though.
+  if isinstance(guid, basestring):
+    return guid.lower()
+  return guid
+
+
+class Catalog(object):
+  """An index of .tilt files, stored in an SQLite database.
+
+  Filenames are stored as absolute paths. Each file is read once, by
+  update(); after that, it is only read again if its size or mtime changes.
+  All the queries are answered from the database alone. GUIDs are compared
+  case-insensitively, and returned lowercased.
+
+  The database is only a cache: if it was written by an incompatible version
+  of this module, it is emptied and rebuilt by the next update()."""
+  def __init__(self, db_filename):
+    self.db_filename = db_filename
+    self._db = sqlite3.connect(db_filename)
+    (version,) = self._db.execute('PRAGMA user_version').fetchone()
+    if version != SCHEMA_VERSION:
+      with self._db:
+        self._db.execute('DROP TABLE IF EXISTS files')
+        self._db.execute('DROP TABLE IF EXISTS brushes')
+        self._db.executescript(_SCHEMA)
+        self._db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+  def close(self):
+    self._db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def update(self, root, workers=None):
+    """Brings the entries for the .tilts under *root* up to date: new and
+    changed files are read (by *workers* processes; see library.scan()), and
+    the entries for files that no longer exist are removed.
+
+    Returns (number of files read, number of entries removed)."""
+    root = os.path.abspath(root)
+    known = dict((filename, (size, mtime)) for (filename, size, mtime) in
+                 self._db.execute('SELECT filename, size, mtime FROM files '
+                                  'WHERE filename = ? OR substr(filename, 1, ?) = ?',
+                                  (root, len(root) + 1, os.path.join(root, ''))))
+    filenames = library.find_tilts(root)
+    stale = [f for f in filenames if known.get(f) != library.stat_tilt(f)]
+    gone = set(known).difference(filenames)
+
+    with self._db:
+      for filename in gone:
+        self._remove(filename)
+    for (i, summary) in enumerate(library.summarize_all(stale, workers)):
+      self._remove(summary['filename'])
+      self._insert(summary)
+      if (i + 1) % _BATCH_SIZE == 0:
+        self._db.commit()
+    self._db.commit()
+    return (len(stale), len(gone))
+
+  def _remove(self, filename):
+    row = self._db.execute('SELECT id FROM files WHERE filename = ?', (filename,)).fetchone()
+    if row is not None:
+      self._db.execute('DELETE FROM brushes WHERE file_id = ?', row)
+      self._db.execute('DELETE FROM files WHERE id = ?', row)
+
+  def _insert(self, summary):
+    if summary['error'] is not None:
+      self._db.execute('INSERT INTO files (filename, size, mtime, error) VALUES (?, ?, ?, ?)',
+                       (summary['filename'], summary['size'], summary['mtime'],
+                        summary['error']))
+      return
+
+    metadata = summary['metadata']
+    try:
+      validate_metadata(metadata)
+      metadata_error = None
+    except BadMetadata as e:
+      metadata_error = str(e)
+    file_id = self._db.execute(
+      'INSERT INTO files (filename, size, mtime, metadata_error, metadata, environment, '
+      'num_strokes, bounds) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+      (summary['filename'], summary['size'], summary['mtime'], metadata_error,
+       json.dumps(metadata), _lower(metadata.get('EnvironmentPreset')),
+       summary['num_strokes'], json.dumps(summary['bounds']))).lastrowid
+
+    # Brushes in the BrushIndex but not used by any stroke get a count of 0
+    brush_counts = dict.fromkeys((_lower(guid) for guid in metadata.get('BrushIndex', [])), 0)
+    for (guid, count) in summary['brush_counts'].items():
+      brush_counts[_lower(guid)] = brush_counts.get(_lower(guid), 0) + count
+    self._db.executemany('INSERT INTO brushes (file_id, guid, num_strokes) VALUES (?, ?, ?)',
+                         [(file_id, guid, count) for (guid, count) in brush_counts.items()])
+
+  #
+  # Queries
+  #
+
+  def filenames(self):
+    """Returns the names of all the indexed .tilts, sorted."""
+    return [f for (f,) in self._db.execute('SELECT filename FROM files ORDER BY filename')]
+
+  def with_brush(self, guid):
+    """Returns the names of the .tilts with strokes using brush *guid*, sorted."""
+    return [f for (f,) in self._db.execute(
+      'SELECT filename FROM files JOIN brushes ON files.id = brushes.file_id '
+      'WHERE guid = ? AND brushes.num_strokes > 0 ORDER BY filename', (_lower(guid),))]
+
+  def with_environment(self, guid):
+    """Returns the names of the .tilts using environment preset *guid*, sorted."""
+    return [f for (f,) in self._db.execute(
+      'SELECT filename FROM files WHERE environment = ? ORDER BY filename', (_lower(guid),))]
+
+  def brush_usage(self):
+    """Returns a dict mapping brush GUID to (number of .tilts using it,
+    total number of strokes using it)."""
+    return dict((guid, (num_files, num_strokes)) for (guid, num_files, num_strokes) in
+                self._db.execute('SELECT guid, COUNT(*), SUM(num_strokes) FROM brushes '
+                                 'WHERE num_strokes > 0 GROUP BY guid'))
+
+  def errors(self):
+    """Returns a dict mapping the name of every .tilt that couldn't be read,
+    or whose metadata is invalid, to a message saying why."""
+    return dict((f, error or metadata_error) for (f, error, metadata_error) in
+                self._db.execute('SELECT filename, error, metadata_error FROM files '
+                                 'WHERE error IS NOT NULL OR metadata_error IS NOT NULL'))
+
+  def summary(self, filename):
+    """Returns the summary of *filename*, in the form returned by
+    library.summarize() but with lowercased brush GUIDs; or None if it isn't
+    indexed."""
+    row = self._db.execute(
+      'SELECT id, filename, size, mtime, error, metadata, num_strokes, bounds '
+      'FROM files WHERE filename = ?', (os.path.abspath(filename),)).fetchone()
+    if row is None:
+      return None
+    (file_id, filename, size, mtime, error, metadata, num_strokes, bounds) = row
+    summary = dict(filename=filename, size=size, mtime=mtime, error=error)
+    if error is None:
+      summary.update(
+        metadata=json.loads(metadata), num_strokes=num_strokes, bounds=json.loads(bounds),
+        brush_counts=dict(self._db.execute(
+          'SELECT guid, num_strokes FROM brushes WHERE file_id = ? AND num_strokes > 0',
+          (file_id,))))
+    return summary
@@ -0,0 +1,163 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summarizes directories full of .tilt files, using multiple processes.
+The main export is scan()."""
+
+import os
+import json
+from collections import defaultdict
+
+from tiltbrush.tilt import Tilt, Sketch
+
+__all__ = ('find_tilts', 'stat_tilt', 'summarize', 'summarize_all', 'scan')
+
+CACHE_VERSION = 1
+
+
+def find_tilts(root):
+  """Returns the names of all .tilt files (packed or unpacked) under *root*,
+  sorted."""
+  found = []
+  for (r, ds, fs) in os.walk(root):
+    found.extend(os.path.join(r, f) for f in ds + fs if f.endswith('.tilt'))
+    # Don't look inside unpacked .tilts
+    ds[:] = [d for d in ds if not d.endswith('.tilt')]
+  return sorted(found)
+
+
+def stat_tilt(filename):
+  """Returns (size, mtime) of a packed or unpacked .tilt. For an unpacked
+  .tilt, these are the total size and latest mtime of its contents."""
+  if os.path.isdir(filename):
+    stats = [os.stat(os.path.join(filename, f)) for f in os.listdir(filename)]
+    return (sum(st.st_size for st in stats), max([st.st_mtime for st in stats] or [0]))
+  st = os.stat(filename)
+  return (st.st_size, st.st_mtime)
+
+
+def _summarize_strokes(tilt):
+  """Returns (brush_idx of every stroke, bounds of all control points)."""
+  probe = Sketch.probe(tilt, bounds=True)
+  bounds = probe.bounds
+  return ([s.brush_idx for s in probe.strokes], bounds and [list(bounds[0]), list(bounds[1])])
+
+
+def summarize(filename):
+  """Returns a dict summarizing the .tilt *filename*, with keys:
+    filename      As passed
+    size, mtime   As returned by stat_tilt()
+    metadata      Tilt.metadata
+    num_strokes   Number of strokes in the sketch
+    brush_counts  Dict mapping brush GUID to the number of strokes using it
+    bounds        [[min x, y, z], [max x, y, z]] of the control point
+                  positions, or None if there are none
+    error         None; or, if the .tilt could not be read, a message saying
+                  why. In that case, only filename, size and mtime are set."""
+  (size, mtime) = stat_tilt(filename)
+  summary = dict(filename=filename, size=size, mtime=mtime, error=None)
+  try:
+    with Tilt(filename, keep_open=True) as tilt:
+      (brush_idxs, bounds) = _summarize_strokes(tilt)
+      metadata = tilt.metadata
+  except Exception as e:
+    # Report, rather than abort a long scan
+    summary['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return summary
+
+  brush_index = metadata.get('BrushIndex', [])
+  brush_counts = defaultdict(int)
+  for brush_idx in brush_idxs:
+    if 0 <= brush_idx < len(brush_index):
+      brush_counts[brush_index[brush_idx]] += 1
+    else:
+      brush_counts['unknown brush_idx %d' % brush_idx] += 1
+
+  summary.update(metadata=metadata, num_strokes=len(brush_idxs),
+                 brush_counts=dict(brush_counts), bounds=bounds)
+  return summary
+
+
+def _load_cache(cache_filename):
+  try:
+    with file(cache_filename, 'rb') as inf:
+      cache = json.load(inf)
+  except (IOError, ValueError):
+    return {}
+  if cache.get('version') != CACHE_VERSION:
+    return {}
+  return cache['summaries']
+
+
+def _save_cache(cache_filename, summaries):
+  tmp_filename = cache_filename + '.part'
+  with file(tmp_filename, 'wb') as outf:
+    json.dump({'version': CACHE_VERSION, 'summaries': summaries}, outf)
+  if os.name == 'nt' and os.path.exists(cache_filename):
+    os.unlink(cache_filename)
+  os.rename(tmp_filename, cache_filename)
+
+
+def scan(root, workers=None, cache_filename=None):
+  """Generates a summary (see summarize()) of every .tilt under *root*,
+  in filename order. Files that can't be read are included, with 'error' set.
+
+  The files are read by *workers* processes; the default is one per CPU.
+  If *cache_filename* is passed, summaries are cached in that file, and
+  files whose size and mtime haven't changed since are not read again."""
+  filenames = find_tilts(root)
+  cache = _load_cache(cache_filename) if cache_filename is not None else {}
+
+  stale = []
+  for filename in filenames:
+    cached = cache.get(filename)
+    if cached is None or (cached['size'], cached['mtime']) != stat_tilt(filename):
+      stale.append(filename)
+
+  summaries = {}
+  fresh = summarize_all(stale, workers)
+  try:
+    stale = set(stale)
+    for filename in filenames:
+      if filename in stale:
+        summary = next(fresh)
+      else:
+        summary = cache[filename]
+      summaries[filename] = summary
+      yield summary
+  finally:
+    fresh.close()
+    if cache_filename is not None:
+      # Keep what was summarized, even if the scan was cut short
+      cache.update(summaries)
+      _save_cache(cache_filename, cache)
+
+
+def summarize_all(filenames, workers=None):
+  """Generates summarize(filename) for each of *filenames*, in order, using
+  *workers* processes; the default is one per CPU."""
+  import multiprocessing
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if workers <= 1 or len(filenames) <= 1:
+    for filename in filenames:
+      yield summarize(filename)
+    return
+  pool = multiprocessing.Pool(workers)
+  try:
+    for summary in pool.imap(summarize, filenames, chunksize=4):
+      yield summary
+  finally:
+    pool.terminate()  # Either done, or the caller stopped early
+    pool.join()
@@ -0,0 +1,242 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Removes redundant control points from strokes, keeping each stroke
+within a given distance (and angle) of its original path. The main exports
+are simplify_sketch() and simplify_files(). Requires numpy."""
+
+import math
+from collections import namedtuple
+from itertools import izip
+
+import numpy
+
+from tiltbrush.tilt import Tilt
+
+__all__ = ('Reduction', 'simplify_points', 'simplify_sketch', 'simplify_tilt', 'simplify_files')
+
+
+class Reduction(namedtuple('Reduction', 'num_strokes points_before points_after '
+                           'bytes_before bytes_after')):
+  """How much a sketch was simplified: the number of strokes, and the number
+  of control points and bytes of control point data before and after.
+  Nothing else in the sketch changes size, so bytes_before - bytes_after is
+  also how much smaller the sketch data got."""
+  __slots__ = ()
+
+  @classmethod
+  def total(cls, reductions):
+    """Returns the sum of *reductions*."""
+    totals = [0] * len(cls._fields)
+    for reduction in reductions:
+      totals = [a + b for (a, b) in zip(totals, reduction)]
+    return cls._make(totals)
+
+  def __str__(self):
+    return '%d strokes: %d -> %d control points (%.1f%%), %d -> %d bytes' % (
+      self.num_strokes, self.points_before, self.points_after,
+      100.0 * self.points_after / max(self.points_before, 1),
+      self.bytes_before, self.bytes_after)
+
+
+def simplify_points(positions, orientations, offsets, tolerance, angle_tolerance=5,
+                    pressures=None, pressure_tolerance=None):
+  """Ramer-Douglas-Peucker simplification of many strokes at once.
+
+  positions and orientations are arrays of shape (n, 3) and (n, 4): the
+  control points of every stroke, concatenated. The control points of
+  stroke i are rows offsets[i] to offsets[i+1].
+  Returns a boolean array saying which control points to keep.
+
+  The first and last control point of each stroke are always kept. Every
+  other control point that's removed is within *tolerance* of the
+  simplified stroke, and its orientation is within *angle_tolerance*
+  degrees of the orientation interpolated there. If *pressure_tolerance*
+  is passed, the same goes for *pressures* (an array of length n).
+  angle_tolerance=None ignores orientation.
+
+  Each pass tests the remaining points of every stroke at once, so the
+  cost is a few numpy operations per level of subdivision."""
+  if tolerance <= 0:
+    raise ValueError('tolerance must be positive')
+  positions = numpy.asarray(positions, dtype=numpy.float64)
+  orientations = numpy.asarray(orientations, dtype=numpy.float64)
+  offsets = numpy.asarray(offsets, dtype=numpy.int64)
+  keep = numpy.zeros(len(positions), dtype=bool)
+  nonempty = offsets[1:] > offsets[:-1]
+  starts = offsets[:-1][nonempty]
+  ends = offsets[1:][nonempty] - 1
+  keep[starts] = keep[ends] = True
+
+  # Segments [starts[i], ends[i]] of the simplified strokes; only those with
+  # points between their ends still need testing.
+  while True:
+    counts = ends - starts - 1
+    untested = counts > 0
+    (starts, ends, counts) = (starts[untested], ends[untested], counts[untested])
+    if len(starts) == 0:
+      return keep
+    firsts = numpy.zeros(len(counts), dtype=numpy.int64)
+    numpy.cumsum(counts[:-1], out=firsts[1:])
+    segment = numpy.repeat(numpy.arange(len(starts)), counts)
+    rows = numpy.repeat(starts + 1 - firsts, counts) + numpy.arange(counts.sum())
+
+    # Distance from each point to its segment, and where along it the point is
+    a = positions[starts][segment]
+    ab = positions[ends][segment] - a
+    length2 = (ab * ab).sum(1)
+    t = ((positions[rows] - a) * ab).sum(1) / numpy.where(length2 > 0, length2, 1)
+    numpy.clip(t, 0, 1, out=t)
+    offset = a + t[:, None] * ab - positions[rows]
+    error = numpy.sqrt((offset * offset).sum(1)) / tolerance
+
+    if angle_tolerance is not None:
+      error = numpy.maximum(error, _orientation_error(
+        orientations[starts][segment], orientations[ends][segment], orientations[rows], t)
+        / math.radians(angle_tolerance))
+    if pressure_tolerance is not None:
+      p0 = pressures[starts][segment]
+      expected = p0 + t * (pressures[ends][segment] - p0)
+      error = numpy.maximum(error, numpy.abs(expected - pressures[rows]) / pressure_tolerance)
+    error[numpy.isnan(error)] = numpy.inf
+
+    # Split each segment at its worst point, if that's out of tolerance
+    worst = numpy.maximum.reduceat(error, firsts)
+    candidates = numpy.flatnonzero(error == worst[segment])
+    (_, first_candidates) = numpy.unique(segment[candidates], return_index=True)
+    split = worst > 1
+    splits = rows[candidates[first_candidates]][split]
+    keep[splits] = True
+    (starts, ends) = (numpy.concatenate([starts[split], splits]),
+                      numpy.concatenate([splits, ends[split]]))
+
+
+def _orientation_error(q0, q1, actual, t):
+  """Returns the angles (radians) between orientations *actual* and the
+  orientations interpolated between q0 and q1 at *t*."""
+  q1 = numpy.where(((q0 * q1).sum(1) < 0)[:, None], -q1, q1)
+  expected = q0 + t[:, None] * (q1 - q0)
+  cos = numpy.abs((expected * actual).sum(1))
+  cos /= numpy.sqrt((expected * expected).sum(1) * (actual * actual).sum(1))
+  return 2 * numpy.arccos(numpy.clip(cos, 0, 1))
+
+
+def _simplify_task(args):
+  (positions, orientations, pressures, offsets, tolerances) = args
+  (tolerance, angle_tolerance, pressure_tolerance) = tolerances
+  return simplify_points(positions, orientations, offsets, tolerance, angle_tolerance,
+                         pressures, pressure_tolerance)
+
+
+def simplify_sketch(sketch, tolerance, angle_tolerance=5, pressure_tolerance=None,
+                    workers=None):
+  """Simplifies the strokes of *sketch* in place; see simplify_points() for
+  the meaning of the tolerances. Returns a Reduction.
+
+  Only the control points that are kept remain, with their extension data
+  (pressure, timestamp, etc) unchanged. Strokes that lose no control points
+  aren't touched. The others are left encoded, as by
+  Stroke.set_controlpoint_array().
+
+  workers, if > 1, is a number of processes to share the work between.
+  This is only worthwhile for very large sketches."""
+  strokes = sketch.strokes
+  records = [stroke.controlpoint_array() for stroke in strokes]
+  offsets = numpy.zeros(len(records) + 1, dtype=numpy.int64)
+  numpy.cumsum([len(r) for r in records], out=offsets[1:])
+  positions = numpy.concatenate([r['position'] for r in records] or [numpy.empty((0, 3))])
+  orientations = numpy.concatenate([r['orientation'] for r in records] or [numpy.empty((0, 4))])
+  pressures = None
+  if pressure_tolerance is not None:
+    # Strokes without pressure data have nothing to keep consistent
+    pressures = numpy.concatenate(
+      [r['pressure'] if 'pressure' in r.dtype.names else numpy.zeros(len(r)) for r in records]
+      or [numpy.empty(0)])
+  tolerances = (tolerance, angle_tolerance, pressure_tolerance)
+
+  if workers > 1 and len(strokes) > 1:
+    keep = numpy.concatenate(_map_in_pool(workers, _simplify_task, [
+      (positions[lo:hi], orientations[lo:hi], pressures if pressures is None else pressures[lo:hi],
+       offsets[first:last + 1] - lo, tolerances)
+      for (first, last, lo, hi) in _split_strokes(offsets, workers * 4)]))
+  else:
+    keep = simplify_points(positions, orientations, offsets, tolerance, angle_tolerance,
+                           pressures, pressure_tolerance)
+
+  bytes_before = bytes_after = 0
+  for (i, (stroke, stroke_records)) in enumerate(zip(strokes, records)):
+    stroke_keep = keep[offsets[i]:offsets[i + 1]]
+    num_kept = numpy.count_nonzero(stroke_keep)
+    if num_kept < len(stroke_records):
+      stroke.set_controlpoint_array(stroke_records[stroke_keep])
+    bytes_before += stroke_records.nbytes
+    bytes_after += num_kept * stroke_records.itemsize
+  return Reduction(len(strokes), len(keep), int(numpy.count_nonzero(keep)),
+                   bytes_before, bytes_after)
+
+
+def _split_strokes(offsets, num_tasks):
+  """Splits strokes into at most *num_tasks* runs with similar numbers of
+  control points. Yields (first stroke, last stroke + 1, first row, last row + 1)."""
+  num_strokes = len(offsets) - 1
+  bounds = numpy.searchsorted(offsets, numpy.linspace(0, offsets[-1], num_tasks + 1)[1:-1])
+  bounds = numpy.unique(numpy.concatenate([[0], bounds, [num_strokes]]))
+  for (first, last) in zip(bounds[:-1], bounds[1:]):
+    yield (first, last, offsets[first], offsets[last])
+
+
+def _map_in_pool(workers, function, tasks):
+  import multiprocessing
+  pool = multiprocessing.Pool(workers)
+  try:
+    return pool.map(function, tasks)
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def simplify_tilt(filename, tolerance, angle_tolerance=5, pressure_tolerance=None):
+  """Simplifies the sketch in the .tilt *filename*, and writes it back if
+  anything changed. Returns a Reduction."""
+  with Tilt(filename, keep_open=True) as tilt:
+    reduction = simplify_sketch(tilt.sketch, tolerance, angle_tolerance, pressure_tolerance)
+    if reduction.points_after < reduction.points_before:
+      tilt.write_sketch()
+  return reduction
+
+
+def _simplify_tilt_task(args):
+  return simplify_tilt(*args)
+
+
+def simplify_files(filenames, tolerance, angle_tolerance=5, pressure_tolerance=None,
+                   workers=None):
+  """Simplifies each of the .tilts *filenames* in place (see simplify_tilt()),
+  using *workers* processes; the default is one per CPU.
+  Generates (filename, Reduction), in order."""
+  import multiprocessing
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  tasks = [(f, tolerance, angle_tolerance, pressure_tolerance) for f in filenames]
+  if workers <= 1 or len(tasks) <= 1:
+    for task in tasks:
+      yield (task[0], _simplify_tilt_task(task))
+    return
+  pool = multiprocessing.Pool(workers)
+  try:
+    for (task, reduction) in izip(tasks, pool.imap(_simplify_tilt_task, tasks)):
+      yield (task[0], reduction)
+  finally:
+    pool.terminate()  # Either done, or the caller stopped early
+    pool.join()
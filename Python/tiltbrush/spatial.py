@@ -0,0 +1,322 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spatial index over the strokes of a sketch, for finding the strokes in a
+region, under a ray, or nearest a point. The main export is SpatialIndex.
+Requires numpy."""
+
+import os
+import zipfile
+
+import numpy
+
+from tiltbrush.tilt import Sketch
+
+__all__ = ('SpatialIndex', 'SPATIAL_INDEX_SUFFIX')
+
+# Appended to a .tilt's filename, to get the name of its cached spatial index
+SPATIAL_INDEX_SUFFIX = '.spatialindex'
+
+
+class SpatialIndex(object):
+  """Bounding volume hierarchy over the strokes of a sketch.
+
+  Each stroke is split into spans of up to SPAN_LENGTH segments, so long
+  strokes get tight bounds. Span bounds are padded by half the stroke's
+  brush size (times its 'scale' extension), so queries account for the
+  stroke's width. Queries return indices into the sketch's .strokes.
+
+  The spans are sorted along a Morton (Z-order) curve, and grouped BRANCHING
+  at a time into nodes, which are grouped into nodes in turn, up to a single
+  root. Queries test a whole level of the tree at a time with numpy.
+
+  The index describes the strokes as they were when it was built."""
+  SPAN_LENGTH = 8
+  BRANCHING = 16
+  VERSION = 2
+
+  # Arrays that make up the index:
+  #   positions    Control point positions of every stroke, concatenated
+  #   radii        Half the brush size of every stroke
+  #   span_stroke  Stroke of each span
+  #   span_rows    Rows [first, last] of positions for each span
+  #   span_min, span_max  Bounds of each span
+  #   node_min, node_max  Bounds of the nodes, concatenated level by level,
+  #                the root last. Node i of a level covers nodes (or spans)
+  #                [i*BRANCHING, (i+1)*BRANCHING) of the level below.
+  #   level_sizes  Number of nodes in each level, the root level last
+  _ARRAYS = ('positions', 'radii', 'span_stroke', 'span_rows', 'span_min', 'span_max',
+             'node_min', 'node_max', 'level_sizes')
+
+  def __init__(self, arrays, key=(0, 0, 0)):
+    for name in SpatialIndex._ARRAYS:
+      setattr(self, name, arrays[name])
+    self.key = key
+    self.num_strokes = len(self.radii)
+    levels = [(self.span_min, self.span_max)]
+    start = 0
+    for size in self.level_sizes.tolist():
+      levels.append((self.node_min[start : start + size], self.node_max[start : start + size]))
+      start += size
+    self._levels = levels
+
+  @classmethod
+  def build(cls, sketch, key=(0, 0, 0)):
+    """Returns a SpatialIndex of the strokes in Sketch *sketch*.
+    key identifies the sketch, as for StrokeIndex.key."""
+    strokes = sketch.strokes
+    columns = [stroke.controlpoint_array()['position'] for stroke in strokes]
+    counts = numpy.array([len(c) for c in columns], dtype=numpy.int64)
+    offsets = numpy.zeros(len(strokes) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    if columns:
+      positions = numpy.concatenate(columns).astype(numpy.float32)
+    else:
+      positions = numpy.zeros((0, 3), dtype=numpy.float32)
+    radii = numpy.array([
+      stroke.brush_size * (stroke.scale if stroke.has_stroke_extension('scale') else 1) / 2.
+      for stroke in strokes], dtype=numpy.float32)
+
+    # Spans: rows [first, last] of positions, for runs of SPAN_LENGTH segments
+    span_length = cls.SPAN_LENGTH
+    span_counts = numpy.where(counts > 0, numpy.maximum((counts - 2) // span_length + 1, 1), 0)
+    span_stroke = numpy.repeat(numpy.arange(len(strokes)), span_counts)
+    span_first = offsets[span_stroke] + span_length * _ranges(numpy.zeros_like(span_counts),
+                                                             span_counts)
+    span_last = numpy.minimum(span_first + span_length, offsets[span_stroke + 1] - 1)
+    if len(span_stroke):
+      # reduceat() stops just short of the next span's first row
+      span_min = numpy.minimum(numpy.minimum.reduceat(positions, span_first),
+                               positions[span_last])
+      span_max = numpy.maximum(numpy.maximum.reduceat(positions, span_first),
+                               positions[span_last])
+      padding = radii[span_stroke][:, numpy.newaxis]
+      span_min -= padding
+      span_max += padding
+    else:
+      span_min = span_max = numpy.zeros((0, 3), dtype=numpy.float32)
+
+    order = numpy.argsort(_morton_codes((span_min + span_max) / 2), kind='mergesort')
+    (span_min, span_max) = (span_min[order], span_max[order])
+    node_mins = []
+    node_maxs = []
+    (level_min, level_max) = (span_min, span_max)
+    while len(level_min) > 1 or not node_mins:
+      groups = numpy.arange(0, len(level_min), cls.BRANCHING)
+      if len(groups):
+        level_min = numpy.minimum.reduceat(level_min, groups)
+        level_max = numpy.maximum.reduceat(level_max, groups)
+      node_mins.append(level_min)
+      node_maxs.append(level_max)
+
+    arrays = dict(
+      positions=positions, radii=radii, span_stroke=span_stroke[order],
+      span_rows=numpy.stack([span_first, span_last], axis=-1)[order],
+      span_min=span_min, span_max=span_max,
+      node_min=numpy.concatenate(node_mins).reshape(-1, 3),
+      node_max=numpy.concatenate(node_maxs).reshape(-1, 3),
+      level_sizes=numpy.array([len(m) for m in node_mins], dtype=numpy.int64))
+    return cls(arrays, key)
+
+  @classmethod
+  def for_tilt(cls, tilt):
+    """Returns a SpatialIndex of the sketch in *tilt*, as saved. It is cached
+    in a file next to the .tilt (see SPATIAL_INDEX_SUFFIX), which is rebuilt
+    if the sketch has changed."""
+    index_filename = os.path.normpath(tilt.filename) + SPATIAL_INDEX_SUFFIX
+    key = tilt._subfile_key('data.sketch')
+    try:
+      index = cls.load(index_filename)
+      if index.key == key:
+        return index
+    except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+      pass
+    index = cls.build(Sketch(tilt, layout='columnar'), key)
+    try:
+      index.save(index_filename)
+    except (IOError, OSError):
+      pass  # It's only a cache
+    return index
+
+  @classmethod
+  def load(cls, filename):
+    with file(filename, 'rb') as inf:
+      npz = numpy.load(inf)
+      header = npz['header'].tolist()
+      if header[0] != SpatialIndex.VERSION:
+        raise ValueError('Not a spatial index')
+      return cls(dict((name, npz[name]) for name in SpatialIndex._ARRAYS), tuple(header[1:]))
+
+  def save(self, filename):
+    tmp_filename = filename + '.part'
+    arrays = dict((name, getattr(self, name)) for name in SpatialIndex._ARRAYS)
+    arrays['header'] = numpy.array([SpatialIndex.VERSION] + list(self.key), dtype=numpy.uint64)
+    with file(tmp_filename, 'wb') as outf:
+      # Passing a file stops numpy from appending '.npz' to the name
+      numpy.savez(outf, **arrays)
+    if os.name == 'nt' and os.path.exists(filename):
+      os.unlink(filename)
+    os.rename(tmp_filename, filename)
+
+  #
+  # Queries
+  #
+
+  def in_box(self, lo, hi):
+    """Returns the sorted indices of the strokes whose bounds intersect the
+    box with corners *lo* and *hi*."""
+    lo = numpy.asarray(lo, dtype=numpy.float32)
+    hi = numpy.asarray(hi, dtype=numpy.float32)
+    spans = self._find_spans(lambda mins, maxs: ((mins <= hi) & (maxs >= lo)).all(axis=1))
+    return numpy.unique(self.span_stroke[spans]).tolist()
+
+  def in_sphere(self, center, radius):
+    """Returns the sorted indices of the strokes that come within *radius*
+    of *center*."""
+    (strokes, distances) = self._strokes_within(numpy.asarray(center, numpy.float64), radius)
+    return strokes[distances <= radius].tolist()
+
+  def on_ray(self, origin, direction, max_distance=float('inf')):
+    """Returns the indices of the strokes whose bounds the ray from *origin*
+    along *direction* passes through, nearest first. max_distance is in
+    units of direction's length."""
+    origin = numpy.asarray(origin, dtype=numpy.float64)
+    direction = numpy.asarray(direction, dtype=numpy.float64)
+    def entries(mins, maxs):
+      return _ray_box_entries(origin, direction, mins, maxs, max_distance)
+    spans = self._find_spans(lambda mins, maxs: entries(mins, maxs) >= 0)
+    (strokes, t) = _min_per_stroke(self.span_stroke[spans],
+                                   entries(self.span_min[spans], self.span_max[spans]))
+    return strokes[numpy.lexsort((strokes, t))].tolist()
+
+  def nearest(self, point, k=1):
+    """Returns the indices of the *k* strokes nearest to *point*, nearest
+    first. A stroke's distance is from its surface, so may be 0."""
+    if len(self.span_stroke) == 0 or k <= 0:
+      return []
+    point = numpy.asarray(point, dtype=numpy.float64)
+    (root_min, root_max) = self._levels[-1]
+    # Search ever larger spheres, until one holds k strokes. The farthest
+    # anything can be is the far corner of the root's bounds.
+    farthest = numpy.sqrt((numpy.maximum(abs(root_min - point), abs(root_max - point)) ** 2).sum())
+    radius = max(numpy.sqrt(_box_distances2(point, root_min, root_max)[0]),
+                 numpy.sqrt(((root_max - root_min) ** 2).sum()) / 256., 1e-6)
+    while True:
+      (strokes, distances) = self._strokes_within(point, radius)
+      if (distances <= radius).sum() >= k or radius >= farthest:
+        break
+      radius *= 2
+    return strokes[numpy.lexsort((strokes, distances))][:k].tolist()
+
+  def _find_spans(self, test):
+    # Returns the indices of the spans that pass test(mins, maxs), whose
+    # nodes all pass it too. test is vectorized, returning a bool array.
+    if len(self.span_stroke) == 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    candidates = numpy.arange(len(self._levels[-1][0]))
+    for (level, (mins, maxs)) in reversed(list(enumerate(self._levels))):
+      candidates = candidates[test(mins[candidates], maxs[candidates])]
+      if level == 0:
+        return candidates
+      num_below = len(self._levels[level - 1][0])
+      starts = candidates * self.BRANCHING
+      candidates = _ranges(starts, numpy.minimum(starts + self.BRANCHING, num_below) - starts)
+
+  def _strokes_within(self, center, radius):
+    # Returns (strokes, distances): every stroke with a span whose bounds are
+    # within radius of center, and the distance from center to its surface.
+    spans = self._find_spans(
+      lambda mins, maxs: _box_distances2(center, mins, maxs) <= radius * radius)
+    (first, last) = self.span_rows[spans].T
+    # Every segment of those spans; a span with one point gets one
+    # zero-length segment
+    num_segments = numpy.maximum(last - first, 1)
+    a = _ranges(first, num_segments)
+    b = numpy.minimum(a + 1, numpy.repeat(last, num_segments))
+    (a, b) = (self.positions[a].astype(numpy.float64), self.positions[b].astype(numpy.float64))
+    ab = b - a
+    lengths2 = (ab * ab).sum(axis=1)
+    t = ((center - a) * ab).sum(axis=1) / numpy.where(lengths2 > 0, lengths2, 1)
+    nearest = a + numpy.clip(t, 0, 1)[:, numpy.newaxis] * ab
+    distances = numpy.sqrt(((nearest - center) ** 2).sum(axis=1))
+    if len(spans):
+      segment_starts = numpy.zeros(len(spans), dtype=numpy.int64)
+      numpy.cumsum(num_segments[:-1], out=segment_starts[1:])
+      distances = numpy.minimum.reduceat(distances, segment_starts)
+    span_stroke = self.span_stroke[spans]
+    distances = numpy.maximum(distances - self.radii[span_stroke], 0)
+    return _min_per_stroke(span_stroke, distances)
+
+
+def _ranges(starts, counts):
+  """Returns the concatenation of arange(start, start+count) for each
+  start and count in the int arrays *starts* and *counts*."""
+  if len(counts) == 0:
+    return numpy.zeros(0, dtype=numpy.int64)
+  firsts = numpy.zeros(len(counts), dtype=numpy.int64)
+  numpy.cumsum(counts[:-1], out=firsts[1:])
+  return numpy.repeat(starts - firsts, counts) + numpy.arange(counts.sum())
+
+
+def _min_per_stroke(strokes, values):
+  """Returns (unique strokes, the least of the values for each)."""
+  order = numpy.lexsort((values, strokes))
+  (strokes, values) = (strokes[order], values[order])
+  first = numpy.ones(len(strokes), dtype=bool)
+  first[1:] = strokes[1:] != strokes[:-1]
+  return (strokes[first], values[first])
+
+
+def _morton_codes(points):
+  """Returns the Morton (Z-order) code of each row of *points*, quantized
+  to 10 bits per axis over their bounds."""
+  if len(points) == 0:
+    return numpy.zeros(0, dtype=numpy.int64)
+  lo = points.min(axis=0)
+  extent = numpy.maximum(points.max(axis=0) - lo, 1e-9)
+  q = ((points - lo) / extent * 1023).astype(numpy.int64)
+  def spread(x):
+    # Puts two zero bits between each of the low 10 bits of x
+    x = (x | (x << 16)) & 0x30000ff
+    x = (x | (x << 8)) & 0x300f00f
+    x = (x | (x << 4)) & 0x30c30c3
+    x = (x | (x << 2)) & 0x9249249
+    return x
+  return spread(q[:, 0]) | (spread(q[:, 1]) << 1) | (spread(q[:, 2]) << 2)
+
+
+def _box_distances2(point, mins, maxs):
+  """Returns the squared distance from *point* to each box (mins[i], maxs[i])."""
+  d = numpy.maximum(mins - point, 0) + numpy.maximum(point - maxs, 0)
+  return (d * d).sum(axis=-1)
+
+
+def _ray_box_entries(origin, direction, mins, maxs, max_t):
+  """Returns the ray parameter at which the ray enters each box (0 if it
+  starts inside), or -1 where it misses it before max_t."""
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    ta = (mins - origin) / direction
+    tb = (maxs - origin) / direction
+  near = numpy.minimum(ta, tb)
+  far = numpy.maximum(ta, tb)
+  # Where the ray is parallel to an axis, it's either always or never
+  # between the planes
+  parallel = (direction == 0)
+  if parallel.any():
+    inside = (mins <= origin) & (origin <= maxs)
+    near = numpy.where(parallel, numpy.where(inside, -numpy.inf, numpy.inf), near)
+    far = numpy.where(parallel, numpy.where(inside, numpy.inf, -numpy.inf), far)
+  entry = numpy.maximum(near.max(axis=-1), 0)
+  exit = numpy.minimum(far.min(axis=-1), max_t)
+  return numpy.where(entry <= exit, entry, -1)
@@ -16,15 +16,22 @@
 
 import os
 import math
+import array
+import bisect
 import json
 import uuid
 import struct
 import contextlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple, MutableSequence
 from cStringIO import StringIO
 
-__all__ = ('Tilt', 'Sketch', 'Stroke', 'ControlPoint',
-           'BadTilt', 'BadMetadata', 'MissingKey')
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+__all__ = ('Tilt', 'Sketch', 'SketchView', 'SketchProbe', 'SketchStream', 'StrokeIndex',
+           'Timeline', 'Stroke', 'ControlPoint', 'BadTilt', 'BadMetadata', 'MissingKey')
 
 # Format characters are as for struct.pack/unpack, with the addition of
 # '@' which is a 4-byte-length-prefixed data blob.
@@ -48,6 +55,30 @@ CONTROLPOINT_EXTENSION_BITS = {
   'unknown': lambda bit: ('cp_ext_%d' % math.log(bit, 2), 'I')
 }
 
+# Maps extension format characters to numpy dtypes
+NUMPY_EXTENSION_TYPES = {
+  'f': '<f4',
+  'I': '<u4',
+  'i': '<i4',
+}
+
+# First bytes of sketch data written by tiltbrush.archive
+_ARCHIVE_MAGIC = 'tiAR'
+
+# Tilt.stroke_index is cached in a file with this suffix, next to the .tilt
+STROKE_INDEX_SUFFIX = '.strokeindex'
+
+# If true, uncompressed subfiles are memory-mapped rather than read. Off on
+# Windows, which does not allow mapped files to be replaced or deleted.
+MMAP_SUBFILES = (os.name != 'nt')
+
+# Sketches with more strokes than this are loaded lazily, so that memory use
+# doesn't grow with the size of the sketch; see Sketch. Strokes with more
+# control points than this keep their control point data on disk, in a
+# memory-mapped temporary file, when the sketch itself isn't memory-mapped.
+LARGE_SKETCH_STROKES = 300000
+LARGE_STROKE_CONTROLPOINTS = 10000
+
 #
 # Internal utils
 #
@@ -71,16 +102,46 @@ class binfile(object):
   # Helper for parsing
   def __init__(self, inf):
     self.inf = inf
+    self.pos = 0            # Number of bytes read so far
+    self._seekable = None   # Unknown until the first skip()
 
   def read(self, n):
-    return self.inf.read(n)
+    data = self.inf.read(n)
+    self.pos += len(data)
+    return data
+
+  def read_buffer(self, n):
+    """Like read(), but returns a zero-copy buffer if the file supports it."""
+    try:
+      read_buffer = self.inf.read_buffer
+    except AttributeError:
+      return self.read(n)
+    data = read_buffer(n)
+    self.pos += len(data)
+    return data
+
+  def skip(self, n):
+    """Moves past the next n bytes; seeks if possible, reads if not."""
+    if self._seekable is not False:
+      try:
+        self.inf.seek(n, 1)
+        self._seekable = True
+        self.pos += n
+        return
+      except (AttributeError, IOError):
+        self._seekable = False
+    while n > 0:
+      data = self.read(min(n, 1 << 16))
+      if not data:
+        break
+      n -= len(data)
 
   def write(self, data):
     return self.inf.write(data)
 
   def read_length_prefixed(self):
     n, = self.unpack("<I")
-    return self.inf.read(n)
+    return self.read(n)
 
   def write_length_prefixed(self, data):
     self.pack("<I", len(data))
@@ -88,13 +149,159 @@ class binfile(object):
 
   def unpack(self, fmt):
     n = struct.calcsize(fmt)
-    data = self.inf.read(n)
+    data = self.read(n)
     return struct.unpack(fmt, data)
 
   def pack(self, fmt, *args):
     data = struct.pack(fmt, *args)
     return self.inf.write(data)
 
+def _require_numpy(feature):
+  if numpy is None:
+    raise ImportError('%s requires numpy' % feature)
+
+class bufferfile(object):
+  """Read-only file-like wrapper around a string, buffer, or mmap.
+  read_buffer() returns zero-copy slices of the underlying data."""
+  def __init__(self, data):
+    self.data = data
+    self.pos = 0
+
+  def __len__(self):
+    return len(self.data)
+
+  def read(self, n=-1):
+    pos = self.pos
+    self.pos = len(self.data) if n < 0 else min(pos + n, len(self.data))
+    return self.data[pos : self.pos]
+
+  def read_buffer(self, n=-1):
+    pos = self.pos
+    self.pos = len(self.data) if n < 0 else min(pos + n, len(self.data))
+    return buffer(self.data, pos, self.pos - pos)
+
+  def seek(self, pos, whence=0):
+    if whence == 1:
+      pos += self.pos
+    elif whence == 2:
+      pos += len(self.data)
+    self.pos = max(0, pos)
+
+  def tell(self):
+    return self.pos
+
+
+def _stat_key(st):
+  """Returns a key that changes when the file *st* is the os.stat() of is
+  modified or replaced."""
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def _map_file(inf, offset=0, length=None):
+  """Returns a read-only buffer of *length* bytes of the open file *inf*,
+  starting at *offset*. The bytes are paged in from disk as they are used."""
+  import mmap
+  if length is None:
+    length = os.fstat(inf.fileno()).st_size - offset
+  if length == 0:
+    return ''  # mmap refuses empty files
+  mapping = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+  return buffer(mapping, offset, length)
+
+
+def _copy_to_file(b, outf, n=-1):
+  """Copies *n* bytes (or the rest) of binfile *b* to *outf*; returns the
+  number of bytes copied, which is less than *n* if *b* runs out."""
+  copied = 0
+  while n != 0:
+    chunk = b.read(1 << 20 if n < 0 else min(n, 1 << 20))
+    if not chunk:
+      break
+    outf.write(chunk)
+    copied += len(chunk)
+    n -= len(chunk) if n > 0 else 0
+  return copied
+
+
+def _read_to_disk(b, n=-1):
+  """Reads *n* bytes (or the rest) of binfile *b* into a temporary file, and
+  returns them memory-mapped; see _map_file()."""
+  import tempfile
+  with tempfile.TemporaryFile() as tmpf:
+    _copy_to_file(b, tmpf, n)
+    tmpf.flush()
+    # The mapping outlives the file
+    return _map_file(tmpf)
+
+
+class _SpillFile(object):
+  """The control point data of the large strokes of a sketch read from a
+  stream, copied to a single temporary file; see Stroke._parse(). The
+  strokes get their data once map() has been called."""
+  def __init__(self):
+    self._file = None
+    self._spilled = []    # (stroke, offset, length)
+    self._size = 0
+
+  def add(self, stroke, b, num_bytes):
+    """Copies the next *num_bytes* of binfile *b* for *stroke*; returns
+    the number of bytes copied."""
+    if self._file is None:
+      import tempfile
+      self._file = tempfile.TemporaryFile()
+    copied = _copy_to_file(b, self._file, num_bytes)
+    self._spilled.append((stroke, self._size, copied))
+    self._size += copied
+    return copied
+
+  def map(self):
+    """Memory-maps the file, and points each stroke at its data."""
+    if self._file is None:
+      return
+    with self._file as tmpf:
+      tmpf.flush()
+      data = _map_file(tmpf)
+    for (stroke, offset, length) in self._spilled:
+      (cp_decode, num_cp, _) = stroke._controlpoints
+      stroke._controlpoints = (cp_decode, num_cp, buffer(data, offset, length))
+    (self._file, self._spilled) = (None, [])
+
+
+def _zip_member_data_offset(inf, info):
+  """Returns the position of the data of zip member *info* in *inf*.
+  The data follows the member's local header. ZipInfo.header_offset
+  already accounts for the .tilt header in front of the zip."""
+  import zipfile
+  inf.seek(info.header_offset)
+  local_header = struct.unpack(zipfile.structFileHeader, inf.read(zipfile.sizeFileHeader))
+  if local_header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+    raise BadTilt('Bad zip member header for %s' % info.filename)
+  return (info.header_offset + zipfile.sizeFileHeader +
+          local_header[zipfile._FH_FILENAME_LENGTH] +
+          local_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+
+def _replace_file(src, dst):
+  if os.name == 'nt' and os.path.exists(dst):
+    os.unlink(dst)
+  os.rename(src, dst)
+
+
+@contextlib.contextmanager
+def _replacing_file(filename):
+  """Yields a file to write the new contents of *filename* to; it replaces
+  filename when the context manager exits. Until then, filename is left
+  alone, so it can still be read from; even if it is memory-mapped."""
+  tmp_filename = filename + '.part'
+  try:
+    with file(tmp_filename, 'wb') as outf:
+      yield outf
+  except:
+    os.unlink(tmp_filename)
+    raise
+  _replace_file(tmp_filename, filename)
+
+
 class BadTilt(Exception): pass
 class BadMetadata(BadTilt): pass
 class MissingKey(BadMetadata): pass
@@ -153,7 +360,17 @@ class Tilt(object):
     .metadata   A dictionary of data.
 
   To modify the sketch, see XXX.
-  To modify the metadata, see mutable_metadata()."""
+  To modify the metadata, see mutable_metadata().
+
+  Reading the metadata in __init__ doesn't keep a packed .tilt open, unless
+  keep_open is passed. After that, it is kept open from the first read of a
+  subfile until close(), so each Tilt holds a file descriptor (and, on
+  Windows, a lock on the file) until then. It is reopened if the .tilt has
+  been replaced or modified since. Close Tilts you are done with, or use
+  them as context managers:
+    with Tilt(filename, keep_open=True) as tilt:
+      ...
+  Tilt.iter() closes each Tilt it yields."""
   @staticmethod
   @contextlib.contextmanager
   def as_directory(tilt_file):
@@ -174,19 +391,83 @@ class Tilt(object):
       for f in ds+fs:
         if f.endswith('.tilt'):
           try:
-            yield Tilt(os.path.join(r,f))
+            tilt = Tilt(os.path.join(r,f), keep_open=True)
           except BadTilt:
-            pass
-
-  def __init__(self, filename):
+            continue
+          try:
+            yield tilt
+          finally:
+            # Don't accumulate open files; it will reopen if used again
+            tilt.close()
+
+  def __init__(self, filename, keep_open=False):
+    """If keep_open is true, a packed .tilt is left open after its metadata
+    is read, so that reading the sketch doesn't reopen it; see close()."""
     self.filename = filename
     self._sketch = None          # lazily-loaded
-    with self.subfile_reader('metadata.json') as inf:
-      self.metadata = json.load(inf)
+    self._staged = None          # subfile -> temp file; see transaction()
+    self._zip = None             # ZipFile, if packed and open; see _zip_file()
+    self._zip_stat = None        # _stat_key() of the file self._zip reads
+    self._zip_file_busy = False
+    try:
+      with self.subfile_reader('metadata.json') as inf:
+        self.metadata = json.load(inf)
+        try:
+          validate_metadata(self.metadata)
+        except BadMetadata as e:
+          print 'WARNING: %s' % e
+    except:
+      self.close()
+      raise
+    if not keep_open:
+      self.close()
+
+  def close(self):
+    """Closes the .tilt file, if it is open. Tilt keeps a packed .tilt open
+    so that reading subfiles doesn't reopen it and re-parse the zip
+    directory; it is reopened if needed. Tilt is also a context manager."""
+    if self._zip is not None:
+      inzip, self._zip, self._zip_stat = self._zip, None, None
+      inf = inzip.fp
+      inzip.close()
+      inf.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @contextlib.contextmanager
+  def _zip_file(self):
+    """Yields (ZipFile, file) for a packed .tilt. The file is the one
+    the ZipFile was opened with, unless that one is already in use. The
+    ZipFile is reopened if the .tilt has changed since it was opened."""
+    from zipfile import ZipFile
+    if (self._zip is not None and not self._zip_file_busy and
+        _stat_key(os.stat(self.filename)) != self._zip_stat):
+      self.close()
+    if self._zip is None:
+      inf = file(self.filename, 'rb')
+      try:
+        self._zip_stat = _stat_key(os.fstat(inf.fileno()))
+        self._zip = ZipFile(inf, 'r')
+      except:
+        inf.close()
+        raise
+    inzip = self._zip
+    if self._zip_file_busy:
+      with file(self.filename, 'rb') as inf:
+        if _stat_key(os.fstat(inf.fileno())) != self._zip_stat:
+          # Changed while the open one is in use; read the new directory
+          inzip = ZipFile(inf, 'r')
+        yield (inzip, inf)
+    else:
+      self._zip_file_busy = True
       try:
-        validate_metadata(self.metadata)
-      except BadMetadata as e:
-        print 'WARNING: %s' % e
+        yield (inzip, inzip.fp)
+      finally:
+        self._zip_file_busy = False
 
   def write_sketch(self):
     if False:
@@ -207,25 +488,115 @@ class Tilt(object):
 
   @contextlib.contextmanager
   def subfile_reader(self, subfile):
-    if os.path.isdir(self.filename):
-      with file(os.path.join(self.filename, subfile), 'rb') as inf:
+    loose_filename = self._loose_subfile(subfile)
+    if loose_filename is not None:
+      with file(loose_filename, 'rb') as inf:
         yield inf
     else:
-      from zipfile import ZipFile
-      with ZipFile(self.filename, 'r') as inzip:
-        with inzip.open(subfile) as inf:
-          yield inf
+      import zipfile
+      with self._zip_file() as (inzip, inf):
+        info = inzip.getinfo(subfile)
+        if info.flag_bits & 0x1:
+          raise BadTilt('Encrypted zip member %s' % subfile)
+        inf.seek(_zip_member_data_offset(inf, info))
+        with zipfile.ZipExtFile(inf, 'r', info) as member_inf:
+          yield member_inf
+
+  def subfile_buffer(self, subfile):
+    """Returns the contents of *subfile* as a read-only buffer that is
+    memory-mapped from disk, or None if the subfile cannot be mapped
+    (because it is compressed, or MMAP_SUBFILES is off)."""
+    if not MMAP_SUBFILES:
+      return None
+    loose_filename = self._loose_subfile(subfile)
+    if loose_filename is not None:
+      with file(loose_filename, 'rb') as inf:
+        return _map_file(inf)
+    else:
+      import zipfile
+      with self._zip_file() as (inzip, inf):
+        info = inzip.getinfo(subfile)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+          return None
+        return _map_file(inf, _zip_member_data_offset(inf, info), info.file_size)
+
+  def _loose_subfile(self, subfile):
+    """Returns the name of a plain file holding the current contents of
+    *subfile*, or None if it is only available inside the zip."""
+    if self._staged is not None and subfile in self._staged:
+      return self._staged[subfile]
+    elif os.path.isdir(self.filename):
+      return os.path.join(self.filename, subfile)
+    else:
+      return None
 
   @contextlib.contextmanager
   def subfile_writer(self, subfile):
-    # Kind of a large hammer, but it works
+    """Yields a file to write the new contents of *subfile* to. The subfile
+    is replaced when the context manager exits, or at the end of the
+    enclosing transaction()."""
+    import tempfile
+    with self.transaction():
+      # Stage the new contents next to the .tilt. Reads of the subfile see
+      # them from now on.
+      (fd, tmp_filename) = tempfile.mkstemp(
+        suffix='.part', dir=os.path.dirname(os.path.abspath(self.filename)))
+      try:
+        with os.fdopen(fd, 'wb') as outf:
+          yield outf
+      except:
+        os.unlink(tmp_filename)
+        raise
+      prev_tmp_filename = self._staged.get(subfile)
+      self._staged[subfile] = tmp_filename
+      if prev_tmp_filename is not None:
+        os.unlink(prev_tmp_filename)
+      if subfile == 'data.sketch':
+        self.__dict__.pop('stroke_index', None)
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Collects the subfile writes made inside it (by write_sketch(),
+    mutable_metadata(), subfile_writer(), ...) and applies them together
+    when it exits. A packed .tilt is then rewritten once, rather than once
+    per write. If an exception escapes, none of the writes are applied.
+    Transactions may be nested; only the outermost one applies the writes."""
+    if self._staged is not None:
+      yield
+      return
+    self._staged = {}
+    try:
+      yield
+      self._commit_staged()
+    finally:
+      staged, self._staged = self._staged, None
+      for tmp_filename in staged.itervalues():
+        if os.path.exists(tmp_filename):
+          os.unlink(tmp_filename)
+
+  def _commit_staged(self):
+    if not self._staged:
+      return
+    self.close()  # The file is about to be replaced
     if os.path.isdir(self.filename):
-      with file(os.path.join(self.filename, subfile), 'wb') as outf:
-        yield outf
+      # Replace rather than overwrite; a Sketch may still have the old
+      # contents mapped.
+      for (subfile, tmp_filename) in self._staged.iteritems():
+        _replace_file(tmp_filename, os.path.join(self.filename, subfile))
     else:
-      with Tilt.as_directory(self.filename) as tilt2:
-        with tilt2.subfile_writer(subfile) as outf:
-          yield outf
+      # Other members are copied without being recompressed
+      import tiltbrush.unpack as unpack
+      unpack.replace_zip_members(self.filename, self._staged)
+
+  def save(self):
+    """Writes .metadata, and .sketch if it has been loaded, in one pass.
+    Unlike mutable_metadata(), this also picks up changes made directly
+    to .metadata."""
+    with self.transaction():
+      validate_metadata(self.metadata)
+      self._write_metadata(self.metadata)
+      if 'sketch' in self.__dict__:
+        self.write_sketch()
 
   @contextlib.contextmanager
   def mutable_metadata(self):
@@ -242,12 +613,71 @@ class Tilt(object):
         del self.metadata[k]
       for k,v in mutable_dct.iteritems():
         self.metadata[k] = copy.deepcopy(v)
-        
-      new_contents = json.dumps(
-        mutable_dct, ensure_ascii=True, allow_nan=False,
-        indent=2, sort_keys=True, separators=(',', ': '))
-      with self.subfile_writer('metadata.json') as outf:
-        outf.write(new_contents)
+      self._write_metadata(mutable_dct)
+
+  def _write_metadata(self, dct):
+    new_contents = json.dumps(
+      dct, ensure_ascii=True, allow_nan=False,
+      indent=2, sort_keys=True, separators=(',', ': '))
+    with self.subfile_writer('metadata.json') as outf:
+      outf.write(new_contents)
+
+  @memoized_property
+  def stroke_index(self):
+    """A StrokeIndex of the sketch. It is cached in a file next to the .tilt
+    (see STROKE_INDEX_SUFFIX), which is rebuilt if the sketch has changed."""
+    index_filename = os.path.normpath(self.filename) + STROKE_INDEX_SUFFIX
+    key = self._subfile_key('data.sketch')
+    try:
+      index = StrokeIndex.load(index_filename)
+      if index.key == key:
+        return index
+    except (IOError, ValueError, struct.error):
+      pass
+    index = StrokeIndex.build(self, key)
+    try:
+      index.save(index_filename)
+    except (IOError, OSError):
+      pass  # It's only a cache
+    return index
+
+  def read_strokes(self, start, stop):
+    """Returns strokes [start, stop) of the sketch. Uses stroke_index to parse
+    only those strokes, rather than the whole sketch."""
+    index = self.stroke_index
+    (start, stop, _) = slice(start, stop).indices(len(index))
+    if start >= stop:
+      return []
+    with _sketch_reader(self) as b:
+      b.skip(index[start].offset - b.pos)
+      return [Stroke.from_file(b) for i in xrange(start, stop)]
+
+  def read_stroke(self, n):
+    """Returns stroke n of the sketch. See read_strokes()."""
+    num_strokes = len(self.stroke_index)
+    if n < 0:
+      n += num_strokes
+    if not 0 <= n < num_strokes:
+      raise IndexError('stroke index out of range')
+    return self.read_strokes(n, n + 1)[0]
+
+  def _subfile_key(self, subfile):
+    """Returns a key that changes when *subfile* does, without reading it:
+    (crc32, size, 0) of a zip member, from the zip directory; or
+    (modification time in ns, size, inode) of a loose file."""
+    loose_filename = self._loose_subfile(subfile)
+    if loose_filename is not None:
+      st = os.stat(loose_filename)
+      return (int(st.st_mtime * 1e9), st.st_size, st.st_ino)
+    else:
+      with self._zip_file() as (inzip, _):
+        info = inzip.getinfo(subfile)
+        return (info.CRC, info.file_size, 0)
+
+  def iter_strokes(self):
+    """Returns a SketchStream over the strokes of this .tilt.
+    Unlike .sketch, this doesn't keep every stroke in memory."""
+    return Sketch.iter(self)
 
   @memoized_property
   def sketch(self):
@@ -256,13 +686,8 @@ class Tilt(object):
     return Sketch(self)
 
 
-def _make_ext_reader(ext_bits, ext_mask):
-  """Helper for Stroke and ControlPoint parsing.
-  Returns:
-  - function reader(file) -> list<extension values>
-  - function writer(file, values)
-  - dict mapping extension_name -> extension_index
-  """
+def _get_ext_infos(ext_bits, ext_mask):
+  """Returns a list of (extension_name, format) tuples, in file order."""
   infos = []
   while ext_mask:
     bit = ext_mask & ~(ext_mask-1)
@@ -270,31 +695,69 @@ def _make_ext_reader(ext_bits, ext_mask):
     try: info = ext_bits[bit]
     except KeyError: info = ext_bits['unknown'](bit)
     infos.append(info)
+  return infos
 
+def _make_ext_reader(ext_bits, ext_mask):
+  """Helper for Stroke and ControlPoint parsing.
+  Returns:
+  - function reader(file) -> list<extension values>
+  - function writer(file, values)
+  - dict mapping extension_name -> extension_index
+  """
+  infos = _get_ext_infos(ext_bits, ext_mask)
   if len(infos) == 0:
     return (lambda f: [], lambda f,vs: None, {})
 
   fmt = '<' + ''.join(info[1] for info in infos)
   names = [info[0] for info in infos]
   if '@' in fmt:
-    # struct.unpack isn't general enough to do the job
-    print fmt, names, infos
-    fmts = ['<'+info[1] for info in infos]
-    def reader(f, fmts=fmts):
-      values = [None] * len(fmts)
-      for i,fmt in enumerate(fmts):
-        if fmt == '<@':
-          nbytes, = struct.unpack('<I', f.read(4))
-          values[i] = f.read(nbytes)
+    # struct isn't general enough to do the job on its own. The blobs split
+    # the extensions into runs of fixed-size fields; each run is compiled
+    # into a Struct, so there's one unpack per run rather than per field.
+    # A step is (Struct, number of fields), or (None, 1) for a blob.
+    steps = []
+    run = ''
+    for (_, ext_fmt) in infos:
+      if ext_fmt == '@':
+        if run:
+          steps.append((struct.Struct('<' + run), len(run)))
+          run = ''
+        steps.append((None, 1))
+      else:
+        run += ext_fmt
+    if run:
+      steps.append((struct.Struct('<' + run), len(run)))
+    length = struct.Struct('<I')
+
+    def reader(f, steps=steps, unpack_length=length.unpack):
+      values = []
+      for (step, _) in steps:
+        if step is None:
+          (nbytes, ) = unpack_length(f.read(4))
+          values.append(f.read(nbytes))
+        else:
+          values.extend(step.unpack(f.read(step.size)))
+      return values
+
+    def writer(f, values, steps=steps, pack_length=length.pack):
+      parts = []
+      i = 0
+      for (step, count) in steps:
+        if step is None:
+          blob = str(values[i])
+          parts.append(pack_length(len(blob)))
+          parts.append(blob)
         else:
-          values[i], = struct.unpack(fmt, f.read(4))
+          parts.append(step.pack(*values[i : i + count]))
+        i += count
+      return f.write(''.join(parts))
   else:
     def reader(f, fmt=fmt, nbytes=len(infos)*4):
       values = list(struct.unpack(fmt, f.read(nbytes)))
       return values
 
-  def writer(f, values, fmt=fmt):
-    return f.write(struct.pack(fmt, *values))
+    def writer(f, values, fmt=fmt):
+      return f.write(struct.pack(fmt, *values))
 
   lookup = dict( (name,i) for (i,name) in enumerate(names) )
   return reader, writer, lookup
@@ -313,57 +776,1231 @@ def _make_cp_ext_reader(ext_mask, memo={}):
     ret = memo[ext_mask] = _make_ext_reader(CONTROLPOINT_EXTENSION_BITS, ext_mask)
   return ret
 
+def _make_cp_codec(ext_mask, memo={}):
+  """Helper for ControlPoint parsing. Returns:
+  - function decode(raw_data, num_cp) -> list<ControlPoint>
+  - function encode(controlpoints) -> string
+  Both handle whole strokes' worth of control points at a time."""
+  try:
+    return memo[ext_mask]
+  except KeyError:
+    pass
+
+  infos = _get_ext_infos(CONTROLPOINT_EXTENSION_BITS, ext_mask)
+  names = [name for (name, _) in infos]
+  record = struct.Struct('<7f' + ''.join(fmt for (_, fmt) in infos))
+  make_cp = ControlPoint._from_values
+
+  def decode(raw_data, num_cp):
+    if numpy is not None:
+      records = numpy.frombuffer(raw_data, dtype=_make_cp_dtype(ext_mask), count=num_cp)
+      positions = records['position'].tolist()
+      orientations = records['orientation'].tolist()
+      if names:
+        extensions = map(list, zip(*[records[name].tolist() for name in names]))
+      else:
+        extensions = [[] for i in xrange(num_cp)]
+      return map(make_cp, positions, orientations, extensions)
+    else:
+      unpack_from = record.unpack_from
+      cps = []
+      for offset in xrange(0, num_cp * record.size, record.size):
+        values = unpack_from(raw_data, offset)
+        cps.append(make_cp(list(values[0:3]), list(values[3:7]), list(values[7:])))
+      return cps
+
+  def encode(controlpoints):
+    pack = record.pack
+    chunks = []
+    for cp in controlpoints:
+      p = cp.position; o = cp.orientation
+      chunks.append(pack(p[0], p[1], p[2], o[0], o[1], o[2], o[3], *cp.extension))
+    return ''.join(chunks)
+
+  ret = memo[ext_mask] = (decode, encode)
+  return ret
+
+def _make_cp_dtype(ext_mask, memo={}):
+  """Returns a numpy record dtype with the same layout as a serialized
+  control point (position, orientation, extensions)."""
+  try:
+    ret = memo[ext_mask]
+  except KeyError:
+    fields = [('position', '<f4', (3,)), ('orientation', '<f4', (4,))]
+    fields.extend((name, NUMPY_EXTENSION_TYPES[fmt]) for (name, fmt)
+                  in _get_ext_infos(CONTROLPOINT_EXTENSION_BITS, ext_mask))
+    ret = memo[ext_mask] = numpy.dtype(fields)
+  return ret
+
+def _concatenate_records(raw_datas, dtype, num_records):
+  """Returns a numpy record array of *dtype*, with the concatenation of
+  *raw_datas* (strings or buffers, num_records records in all) as its data."""
+  records = numpy.empty(num_records, dtype=dtype)
+  records_bytes = records.view(numpy.uint8)
+  pos = 0
+  for raw_data in raw_datas:
+    if len(raw_data):
+      records_bytes[pos : pos + len(raw_data)] = numpy.frombuffer(raw_data, numpy.uint8)
+      pos += len(raw_data)
+  return records
+
+def _quaternion_multiply(q0, q1):
+  """Returns the products of the (x, y, z, w) quaternions in numpy arrays
+  *q0* and *q1*, which broadcast against each other."""
+  (x0, y0, z0, w0) = (q0[..., i] for i in range(4))
+  (x1, y1, z1, w1) = (q1[..., i] for i in range(4))
+  return numpy.stack([
+    w0*x1 + x0*w1 + y0*z1 - z0*y1,
+    w0*y1 + y0*w1 + z0*x1 - x0*z1,
+    w0*z1 + z0*w1 + x0*y1 - y0*x1,
+    w0*w1 - x0*x1 - y0*y1 - z0*z1], axis=-1)
+
+def _transform_columns(positions, orientations, translation, rotation, scale):
+  """Returns (positions, orientations), transformed as described in
+  Sketch.apply_transform(). Arguments are numpy arrays, except scale."""
+  # Same as q * v * conjugate(q), with v as a quaternion with w=0
+  (u, w) = (rotation[:3], rotation[3])
+  v = positions * scale
+  v = ((w*w - u.dot(u)) * v + 2 * v.dot(u)[:, numpy.newaxis] * u +
+       2 * w * numpy.cross(u, v))
+  return (v + translation, _quaternion_multiply(rotation, orientations))
+
+
+@contextlib.contextmanager
+def _sketch_reader(source):
+  """Yields a binfile for reading the sketch data in *source*.
+  source is as for Sketch(). Archived sketch data (see tiltbrush.archive)
+  is decoded in full, and read as if it were in the standard format."""
+  with _raw_sketch_reader(source) as b:
+    magic = b.read(len(_ARCHIVE_MAGIC))
+    if magic == _ARCHIVE_MAGIC:
+      import tiltbrush.archive as archive
+      (header, additional_header, strokes) = archive.decode(magic + b.read(-1))
+      tmpf = StringIO()
+      Sketch._write_iter(tmpf, strokes, header, additional_header)
+      yield binfile(bufferfile(tmpf.getvalue()))
+      return
+    # Put back what was read
+    try:
+      b.inf.seek(-len(magic), 1)
+    except (AttributeError, IOError):
+      b.inf = _PrefixedFile(magic, b.inf)
+    b.pos = 0
+    yield b
+
+
+class _PrefixedFile(object):
+  # Read-only file-like object: *prefix*, followed by the rest of *inf*
+  def __init__(self, prefix, inf):
+    self.prefix = prefix
+    self.inf = inf
+
+  def read(self, n=-1):
+    (prefix, self.prefix) = (self.prefix, '')
+    if n < 0:
+      return prefix + self.inf.read()
+    if len(prefix) >= n:
+      (prefix, self.prefix) = (prefix[:n], prefix[n:])
+      return prefix
+    return prefix + self.inf.read(n - len(prefix))
+
+
+@contextlib.contextmanager
+def _raw_sketch_reader(source):
+  # As for _sketch_reader(), but archived data isn't decoded
+  if isinstance(source, Tilt):
+    data = source.subfile_buffer('data.sketch')
+    if data is not None:
+      yield binfile(bufferfile(data))
+    else:
+      with source.subfile_reader('data.sketch') as inf:
+        yield binfile(inf)
+  elif hasattr(source, 'read'):
+    yield binfile(source)
+  else:
+    with file(source, 'rb') as inf:
+      if MMAP_SUBFILES:
+        yield binfile(bufferfile(_map_file(inf)))
+      else:
+        yield binfile(inf)
+
+def _read_sketch_header(b):
+  """Returns (header, additional_header, num_strokes)."""
+  header = list(b.unpack("<3I"))
+  additional_header = b.read_length_prefixed()
+  (num_strokes, ) = b.unpack("<i")
+  if num_strokes < 0:
+    raise BadTilt('Bad stroke count %d' % num_strokes)
+  return (header, additional_header, num_strokes)
+
+
+def _iter_stroke_headers(b, num_strokes, bounds=False):
+  """Reads the strokes in binfile *b*, skipping their control point data.
+  Yields (offset, brush_idx, brush_color, brush_size, stroke_mask, cp_mask,
+  stroke_extension, num_cp, bounds) per stroke; offset is relative to b's
+  start. If *bounds* is true, each stroke's control point data is read, one
+  stroke at a time, to get its bounds (see Stroke.bounds); otherwise the
+  yielded bounds are None."""
+  for i in xrange(num_strokes):
+    offset = b.pos
+    (brush_idx, r, g, b_, a, brush_size, stroke_mask, cp_mask) = b.unpack("<i4ffII")
+    extension = _make_stroke_ext_reader(stroke_mask)[0](b)
+    (num_cp, ) = b.unpack("<i")
+    bytes_per_cp = 4 * (3 + 4 + len(_make_cp_ext_reader(cp_mask)[2]))
+    if bounds:
+      stroke_bounds = _raw_bounds(b.read_buffer(num_cp * bytes_per_cp), num_cp, cp_mask)
+    else:
+      stroke_bounds = None
+      b.skip(num_cp * bytes_per_cp)
+    yield (offset, brush_idx, (r, g, b_, a), brush_size, stroke_mask, cp_mask,
+           extension, num_cp, stroke_bounds)
+
+
+def _raw_bounds(raw_data, num_cp, cp_mask):
+  """Returns the bounds (see Stroke.bounds) of serialized control points."""
+  if num_cp == 0:
+    return None
+  if numpy is not None:
+    positions = numpy.frombuffer(raw_data, _make_cp_dtype(cp_mask), num_cp)['position']
+    return (tuple(positions.min(axis=0).tolist()), tuple(positions.max(axis=0).tolist()))
+  stride = len(raw_data) // num_cp
+  unpack_from = struct.Struct('<3f').unpack_from
+  return _positions_bounds([unpack_from(raw_data, i * stride) for i in xrange(num_cp)])
+
+
+def _positions_bounds(positions):
+  """Returns the bounds (see Stroke.bounds) of a sequence of positions."""
+  if len(positions) == 0:
+    return None
+  if numpy is not None:
+    positions = numpy.asarray(positions)
+    return (tuple(positions.min(axis=0).tolist()), tuple(positions.max(axis=0).tolist()))
+  return (tuple(map(min, *positions)), tuple(map(max, *positions)))
+
+
+def _union_bounds(all_bounds):
+  """Returns the bounds that contain every one of *all_bounds* (an iterable
+  of bounds, or Nones). The iterable is consumed one item at a time."""
+  union = None
+  for bounds in all_bounds:
+    if bounds is None:
+      continue
+    elif union is None:
+      union = bounds
+    else:
+      union = (tuple(map(min, union[0], bounds[0])), tuple(map(max, union[1], bounds[1])))
+  return union
+
+
+class StrokeIndex(object):
+  """Location and header summary of every stroke in a sketch, which allows
+  strokes to be read without parsing the strokes before them.
+
+  len(index) is the number of strokes. index[i] is a StrokeIndex.Entry with
+  fields (offset, brush_idx, num_cp, stroke_mask, cp_mask), where offset is
+  the position of stroke i in the sketch data.
+  .key identifies the sketch data the index was built from; see Tilt.stroke_index."""
+  Entry = namedtuple('Entry', 'offset brush_idx num_cp stroke_mask cp_mask')
+  HEADER = struct.Struct('<4sI3QI')   # sentinel, version, key, num_strokes
+  ENTRY = struct.Struct('<QiiII')
+  SENTINEL = 'tiSI'
+  VERSION = 2
+
+  def __init__(self, data):
+    """data is the serialized index, as returned by tostring()."""
+    (sentinel, version, key0, key1, key2, num_strokes) = StrokeIndex.HEADER.unpack_from(data)
+    if sentinel != StrokeIndex.SENTINEL or version != StrokeIndex.VERSION:
+      raise ValueError('Not a stroke index')
+    if len(data) != StrokeIndex.HEADER.size + num_strokes * StrokeIndex.ENTRY.size:
+      raise ValueError('Truncated stroke index')
+    self.key = (key0, key1, key2)
+    self._data = data
+    self._num_strokes = num_strokes
+
+  @classmethod
+  def build(cls, source, key=(0, 0, 0)):
+    """Reads the stroke headers in *source*, which is as for Sketch(), and
+    returns a StrokeIndex. Control point data is skipped, not read.
+    key is a tuple of three ints; see Tilt._subfile_key()."""
+    chunks = []
+    with _sketch_reader(source) as b:
+      (_, _, num_strokes) = _read_sketch_header(b)
+      chunks.append(StrokeIndex.HEADER.pack(
+        StrokeIndex.SENTINEL, StrokeIndex.VERSION, key[0], key[1], key[2], num_strokes))
+      for header in _iter_stroke_headers(b, num_strokes):
+        (offset, brush_idx, _, _, stroke_mask, cp_mask, _, num_cp, _) = header
+        chunks.append(StrokeIndex.ENTRY.pack(offset, brush_idx, num_cp, stroke_mask, cp_mask))
+    return cls(''.join(chunks))
+
+  @classmethod
+  def load(cls, filename):
+    with file(filename, 'rb') as inf:
+      return cls(inf.read())
+
+  def save(self, filename):
+    tmp_filename = filename + '.part'
+    with file(tmp_filename, 'wb') as outf:
+      outf.write(self._data)
+    _replace_file(tmp_filename, filename)
+
+  def tostring(self):
+    return self._data
+
+  def __len__(self):
+    return self._num_strokes
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self._num_strokes
+    if not 0 <= i < self._num_strokes:
+      raise IndexError('stroke index out of range')
+    return StrokeIndex.Entry._make(StrokeIndex.ENTRY.unpack_from(
+      self._data, StrokeIndex.HEADER.size + i * StrokeIndex.ENTRY.size))
+
+  def __iter__(self):
+    for i in xrange(self._num_strokes):
+      yield self[i]
+
+
+class SketchProbe(object):
+  """Everything about a sketch's strokes except their control points;
+  see Sketch.probe(). Attributes:
+    .header             As for Sketch
+    .additional_header  As for Sketch
+    .strokes            List of SketchProbe.StrokeHeader, one per stroke
+
+  A StrokeHeader has fields (brush_idx, brush_color, brush_size, stroke_mask,
+  cp_mask, extension, num_cp, bounds), and attributes stroke_ext_lookup,
+  cp_ext_lookup and num_controlpoints; these are all as for Stroke.
+  bounds is None unless Sketch.probe() was asked for them."""
+  class StrokeHeader(namedtuple('StrokeHeader', 'brush_idx brush_color brush_size '
+                                'stroke_mask cp_mask extension num_cp bounds')):
+    __slots__ = ()
+
+    @property
+    def stroke_ext_lookup(self):
+      return _make_stroke_ext_reader(self.stroke_mask)[2]
+
+    @property
+    def cp_ext_lookup(self):
+      return _make_cp_ext_reader(self.cp_mask)[2]
+
+    @property
+    def num_controlpoints(self):
+      return self.num_cp
+
+  def __init__(self, header, additional_header, strokes):
+    self.header = header
+    self.additional_header = additional_header
+    self.strokes = strokes
+
+  @property
+  def num_controlpoints(self):
+    """Total number of control points in the sketch."""
+    return sum(s.num_cp for s in self.strokes)
+
+  @property
+  def bounds(self):
+    """As for Sketch.bounds; requires Sketch.probe(bounds=True)."""
+    return _union_bounds(s.bounds for s in self.strokes)
+
+  def brush_counts(self):
+    """Returns a dict mapping brush_idx to the number of strokes using it."""
+    counts = defaultdict(int)
+    for s in self.strokes:
+      counts[s.brush_idx] += 1
+    return dict(counts)
+
 
 class Sketch(object):
   """Stroke data from a .tilt file. Attributes:
     .strokes    List of tilt.Stroke instances
     .filename   Filename if loaded from file, but usually None
-    .header     Opaque header data"""
-  def __init__(self, source):
-    """source is either a file name, a file-like instance, or a Tilt instance."""
-    if isinstance(source, Tilt):
-      with source.subfile_reader('data.sketch') as inf:
-        self.filename = None
-        self._parse(binfile(inf))
-    elif hasattr(source, 'read'):
+    .header     Opaque header data
+
+  Sketches loaded with layout='columnar' (requires numpy) also have:
+    .positions     float32 array of shape (num_cp, 3), for every control point
+    .orientations  float32 array of shape (num_cp, 4), for every control point
+    .cp_offsets    int64 array of length len(strokes)+1. The control points of
+                   strokes[i] are rows cp_offsets[i] to cp_offsets[i+1].
+    .cp_extensions Dict mapping cp_mask to a record array of control point
+                   extension data, for the strokes with that cp_mask.
+
+  Columnar strokes still have .controlpoints, but the ControlPoints are
+  views: reading and writing them (their values are lists, as usual) reads
+  and writes the arrays. The arrays
+  describe the strokes as loaded; they do not track strokes added to or
+  removed from .strokes.
+
+  Sketches with more than LARGE_SKETCH_STROKES strokes are loaded lazily,
+  unless the layout is columnar: .strokes is then a list-like sequence that
+  parses each stroke on first use, and keeps it from then on. Until then a
+  stroke costs only its position in the sketch data, which is memory-mapped
+  (copied to a temporary file first, if need be). Writing, bounds, select(),
+  timeline, stroke_column(), cp_column() and dedupe() read the strokes
+  without keeping them. apply_transform(), set_cp_column() and
+  set_stroke_column() modify strokes, so they parse and keep every stroke
+  they touch; on a sketch this large, that takes as much memory as a sketch
+  loaded in full."""
+  LAYOUTS = ('objects', 'columnar')
+
+  def __init__(self, source, layout='objects'):
+    """source is either a file name, a file-like instance, or a Tilt instance.
+    layout is 'objects' (the default) or 'columnar'."""
+    if layout not in Sketch.LAYOUTS:
+      raise ValueError('Unknown layout %r' % (layout,))
+    if layout == 'columnar':
+      _require_numpy("layout='columnar'")
+    self.layout = layout
+    if isinstance(source, Tilt) or hasattr(source, 'read'):
       self.filename = None
-      self._parse(binfile(source))
     else:
       self.filename = source
-      with file(source, 'rb') as inf:
-        self._parse(binfile(inf))
+    with _sketch_reader(source) as b:
+      self._parse(b)
 
-  def write(self, destination):
-    """destination is either a file name, a file-like instance, or a Tilt instance."""
-    tmpf = StringIO()
-    self._write(binfile(tmpf))
-    data = tmpf.getvalue()
+  @staticmethod
+  def probe(source, bounds=False):
+    """Reads only the stroke headers in *source*, which is as for Sketch(),
+    and returns a SketchProbe. Control point data is skipped: if the source
+    is seekable (eg, a filename, or a Tilt whose sketch is stored
+    uncompressed), it isn't read at all.
+    If *bounds* is true, the control points are read, but only to get each
+    stroke's bounds; they're never all in memory at once."""
+    with _sketch_reader(source) as b:
+      (header, additional_header, num_strokes) = _read_sketch_header(b)
+      make_header = SketchProbe.StrokeHeader
+      strokes = [make_header(*stroke_header[1:])
+                 for stroke_header in _iter_stroke_headers(b, num_strokes, bounds)]
+    return SketchProbe(header, additional_header, strokes)
 
+  @staticmethod
+  def iter(source):
+    """Returns a SketchStream that yields the strokes of *source* one at
+    a time. source is as for Sketch()."""
+    return SketchStream(source)
+
+  def write(self, destination, archival=False):
+    """destination is either a file name, a file-like instance, or a Tilt instance.
+    If archival is true, the data is written in the compact, lossy format
+    of tiltbrush.archive; see there. Requires numpy."""
+    if archival:
+      import tiltbrush.archive as archive
+      data = archive.encode(self)
+    elif isinstance(self.strokes, _LazyStrokeList):
+      data = None   # Written straight out, rather than built in memory
+    else:
+      tmpf = StringIO()
+      self._write(binfile(tmpf))
+      data = tmpf.getvalue()
+
+    def write_to(outf):
+      if data is None:
+        self._write(binfile(outf))
+      else:
+        outf.write(data)
     if isinstance(destination, Tilt):
       with destination.subfile_writer('data.sketch') as outf:
-        outf.write(data)
+        write_to(outf)
     elif hasattr(destination, 'write'):
-      destination.write(data)
+      write_to(destination)
     else:
-      with file(destination, 'wb') as outf:
-        outf.write(data)
+      with _replacing_file(destination) as outf:
+        write_to(outf)
+
+  @staticmethod
+  def write_iter(destination, strokes, header, additional_header=''):
+    """Writes a sketch containing *strokes*, which may be any iterable of
+    tilt.Stroke instances; they need not all be in memory at once.
+    destination is as for write(). header and additional_header are as for
+    Sketch; a SketchStream has them too.
+    Returns the number of strokes written."""
+    if isinstance(destination, Tilt):
+      with destination.subfile_writer('data.sketch') as outf:
+        return Sketch._write_iter(outf, strokes, header, additional_header)
+    elif hasattr(destination, 'write'):
+      return Sketch._write_iter(destination, strokes, header, additional_header)
+    else:
+      with _replacing_file(destination) as outf:
+        return Sketch._write_iter(outf, strokes, header, additional_header)
+
+  @staticmethod
+  def _write_iter(outf, strokes, header, additional_header):
+    # The stroke count comes before the strokes, but isn't known until
+    # they've all been written, so the output needs to be seekable.
+    try:
+      outf.seek(0, 1)
+    except (AttributeError, IOError):
+      import shutil, tempfile
+      tmpf = tempfile.TemporaryFile()
+      try:
+        num_strokes = Sketch._write_iter(tmpf, strokes, header, additional_header)
+        tmpf.seek(0)
+        shutil.copyfileobj(tmpf, outf)
+      finally:
+        tmpf.close()
+      return num_strokes
+
+    b = binfile(outf)
+    b.pack("<3I", *header)
+    b.write_length_prefixed(additional_header)
+    num_strokes_pos = outf.tell()
+    b.pack("<i", 0)
+    num_strokes = 0
+    for stroke in strokes:
+      stroke._write(b)
+      num_strokes += 1
+    end_pos = outf.tell()
+    outf.seek(num_strokes_pos)
+    b.pack("<i", num_strokes)
+    outf.seek(end_pos)
+    return num_strokes
+
+  @property
+  def bounds(self):
+    """((min x, y, z), (max x, y, z)) of every control point position, or
+    None if there are none. See Stroke.bounds."""
+    if self.layout == 'columnar':
+      slices = set(id(s._controlpoints) for s in self.strokes
+                   if 'controlpoints' not in s.__dict__ and
+                   isinstance(s._controlpoints, _ColumnSlice) and s._controlpoints.sketch is self)
+      if len(slices) == len(self.strokes) == len(self.cp_offsets) - 1:
+        # Every row of the arrays belongs to exactly one stroke
+        return _positions_bounds(self.positions)
+    return _union_bounds(s.bounds for s in _iter_for_reading(self.strokes))
+
+  @memoized_property
+  def timeline(self):
+    """A Timeline of the strokes, built on first use. It describes the strokes
+    as they were then; del sketch.timeline to have it rebuilt.
+    Requires numpy."""
+    return Timeline(self.strokes)
+
+  def dedupe(self, tolerance=0):
+    """Removes strokes that duplicate an earlier stroke. Returns (number of
+    strokes removed, number of bytes of sketch data they took up).
+
+    With tolerance=0, duplicates are identical in every respect; see
+    Stroke.fingerprint(). Otherwise, they have the same brush, color, size,
+    stroke extensions (eg scale and group), control point extension layout
+    and number of control points, and each control point position is within
+    *tolerance* of the earlier stroke's in x, y and z; orientations and
+    control point extension data aren't compared. Requires numpy if
+    tolerance isn't 0.
+
+    Strokes are only compared with strokes that share their fingerprint or
+    header, and (if tolerance isn't 0) whose first control points are
+    within tolerance in x, so this takes about linear time. Strokes of a
+    lazily loaded sketch are not kept; see Sketch."""
+    if tolerance:
+      _require_numpy('Sketch.dedupe(tolerance=...)')
+    import hashlib
+    seen = {}
+    kept = []     # Indices of the strokes kept
+    num_bytes = 0
+    for (i, stroke) in enumerate(_iter_for_reading(self.strokes)):
+      if not tolerance:
+        data = stroke._tostring()
+        key = hashlib.sha1(data).digest()
+        if key in seen:
+          num_bytes += len(data)
+        else:
+          seen[key] = i
+          kept.append(i)
+        continue
+
+      # Earlier strokes with this header, as parallel lists sorted by the x
+      # of their first control point: [xs, positions]
+      key = (stroke.brush_idx, tuple(stroke.brush_color), stroke.brush_size,
+             stroke.stroke_mask, tuple(stroke.extension), stroke.cp_mask,
+             stroke.num_controlpoints)
+      (xs, others) = seen.setdefault(key, ([], []))
+      positions = stroke.controlpoint_array()['position']
+      x = positions[0, 0] if len(positions) else 0
+      (lo, hi) = (bisect.bisect_left(xs, x - tolerance), bisect.bisect_right(xs, x + tolerance))
+      if lo < hi and (len(positions) == 0 or
+                      (numpy.abs(numpy.array(others[lo:hi]) - positions)
+                       .reshape(hi - lo, -1).max(1) <= tolerance).any()):
+        num_bytes += len(stroke._tostring())
+      else:
+        j = bisect.bisect_right(xs, x)
+        xs.insert(j, x)
+        others.insert(j, positions)
+        kept.append(i)
+
+    num_removed = len(self.strokes) - len(kept)
+    if num_removed:
+      if isinstance(self.strokes, _LazyStrokeList):
+        self.strokes._keep(kept)
+      else:
+        self.strokes = [self.strokes[i] for i in kept]
+      self.__dict__.pop('timeline', None)
+    return (num_removed, num_bytes)
+
+  def select(self, brush=None, brush_index=None, color=None, size=None, group=None,
+             time=None, bbox=None):
+    """Returns a SketchView of the strokes that match all the given criteria:
+      brush   A brush_idx or brush GUID, or a collection of them. To use GUIDs,
+              also pass brush_index, which is Tilt.metadata['BrushIndex'].
+      color   (lo, hi): RGBA colors; each component must be within range.
+              RGB colors may also be used, to ignore alpha.
+      size    (lo, hi): brush_size must be within range.
+      group   A value of the 'group' stroke extension, or a collection of
+              them. Strokes without a group are in group 0.
+      time    (t0, t1): strokes drawn at least partly within this range, in
+              the units of the 'timestamp' control point extension.
+      bbox    (lo, hi): strokes whose bounds (see Stroke.bounds) intersect
+              this box.
+    The strokes aren't copied; see SketchView."""
+    return SketchView(self, _select(self.strokes, xrange(len(self.strokes)), brush, brush_index,
+                                    color, size, group, time, bbox))
+
+  def cp_column(self, name):
+    """Returns (values, offsets): control point field *name* of every stroke
+    that has it, as one array. name is 'position', 'orientation', or a control
+    point extension such as 'pressure' or 'timestamp'. The values of
+    strokes[i] are values[offsets[i]:offsets[i+1]]; that range is empty if
+    the stroke doesn't have the extension. values is a copy; to change the
+    strokes, pass it to set_cp_column(). Doesn't decode .controlpoints.
+    Requires numpy."""
+    _require_numpy('Sketch.cp_column()')
+    dtype = _cp_field_dtype(name)
+    offsets = numpy.zeros(len(self.strokes) + 1, dtype=numpy.int64)
+    columns = []
+    for (i, stroke) in enumerate(_iter_for_reading(self.strokes)):
+      if name in ('position', 'orientation') or stroke.has_cp_extension(name):
+        columns.append(stroke.controlpoint_array()[name])
+        offsets[i + 1] = len(columns[-1])
+    numpy.cumsum(offsets, out=offsets)
+    if not columns:
+      return (numpy.empty(0, dtype=dtype), offsets)
+    return (numpy.concatenate(columns), offsets)
+
+  def set_cp_column(self, name, values):
+    """Sets control point field *name* of every stroke that has it from
+    *values*, which is laid out as cp_column() returns it. Strokes are
+    re-encoded (see Stroke.set_controlpoint_array()), except columnar ones,
+    whose arrays are written to. Every stroke of a lazily loaded sketch is
+    parsed and kept; see Sketch. Requires numpy."""
+    _require_numpy('Sketch.set_cp_column()')
+    _cp_field_dtype(name)
+    strokes = [stroke for stroke in self.strokes
+               if name in ('position', 'orientation') or stroke.has_cp_extension(name)]
+    counts = [stroke.num_controlpoints for stroke in strokes]
+    if sum(counts) != len(values):
+      raise ValueError('Expected %d values, got %d' % (sum(counts), len(values)))
+    start = 0
+    for (stroke, count) in zip(strokes, counts):
+      stroke_values = values[start : start + count]
+      start += count
+      if 'controlpoints' not in stroke.__dict__ and isinstance(stroke._controlpoints, _ColumnSlice):
+        stroke._controlpoints.set_field(name, stroke_values)
+      else:
+        records = stroke.controlpoint_array()
+        records[name] = stroke_values
+        stroke.set_controlpoint_array(records)
+    if name == 'timestamp':
+      self.__dict__.pop('timeline', None)
+
+  def stroke_column(self, name, default=None):
+    """Returns an array of the stroke extension *name* (eg 'scale', 'group'
+    or 'flags') of every stroke; name may also be 'brush_idx', 'brush_color'
+    or 'brush_size'. Strokes without the extension get *default*, or raise
+    LookupError if it is None. Requires numpy."""
+    _require_numpy('Sketch.stroke_column()')
+    dtype = _stroke_field_dtype(name)
+    if name in _STROKE_ATTRIBUTES:
+      values = [getattr(stroke, name) for stroke in _iter_for_reading(self.strokes)]
+    else:
+      values = []
+      for (i, stroke) in enumerate(_iter_for_reading(self.strokes)):
+        idx = stroke.stroke_ext_lookup.get(name)
+        if idx is not None:
+          values.append(stroke.extension[idx])
+        elif default is not None:
+          values.append(default)
+        else:
+          raise LookupError('Stroke %d has no %s extension' % (i, name))
+    return numpy.array(values, dtype=dtype.base).reshape((len(values), ) + dtype.shape)
+
+  def set_stroke_column(self, name, values):
+    """Sets stroke extension (or attribute) *name* of every stroke from
+    *values*, which is laid out as stroke_column() returns it. Strokes without
+    the extension get it added. Every stroke of a lazily loaded sketch is
+    parsed and kept; see Sketch. Requires numpy."""
+    _require_numpy('Sketch.set_stroke_column()')
+    values = numpy.asarray(values, dtype=_stroke_field_dtype(name).base)
+    if len(values) != len(self.strokes):
+      raise ValueError('Expected %d values, got %d' % (len(self.strokes), len(values)))
+    values = values.tolist()
+    if name in _STROKE_ATTRIBUTES:
+      if name == 'brush_color':
+        values = map(tuple, values)
+      for (stroke, value) in zip(self.strokes, values):
+        setattr(stroke, name, value)
+      return
+
+    # Adding the extension changes the layout of Stroke.extension; work out
+    # the new layout once per stroke_mask rather than once per stroke.
+    bit = STROKE_EXTENSION_BY_NAME[name][0]
+    layouts = {}
+    for (stroke, value) in zip(self.strokes, values):
+      idx = stroke.stroke_ext_lookup.get(name)
+      if idx is not None:
+        stroke.extension[idx] = value
+        continue
+      layout = layouts.get(stroke.stroke_mask)
+      if layout is None:
+        stroke_mask = stroke.stroke_mask | bit
+        (_, writer, lookup) = _make_stroke_ext_reader(stroke_mask)
+        # Index in the old extension list of each new one; None for *name*
+        sources = [None] * len(lookup)
+        for (ext_name, old_idx) in stroke.stroke_ext_lookup.iteritems():
+          sources[lookup[ext_name]] = old_idx
+        layout = layouts[stroke.stroke_mask] = (stroke_mask, writer, lookup, sources)
+      (stroke.stroke_mask, stroke.stroke_ext_writer, stroke.stroke_ext_lookup, sources) = layout
+      stroke.extension = [value if i is None else stroke.extension[i] for i in sources]
+
+  def apply_transform(self, translation=(0, 0, 0), rotation_quat=(0, 0, 0, 1), scale=1,
+                      strokes=None):
+    """Scales, rotates, then translates the strokes. Each control point
+    position p becomes translation + rotation_quat * (scale * p), and each
+    orientation q becomes rotation_quat * q. rotation_quat is (x, y, z, w).
+    If scale isn't 1, each stroke's 'scale' extension is multiplied by it
+    (and added, if missing), so brush sizes scale too.
+
+    strokes, if passed, is the subset of self.strokes to transform; they
+    are all parsed and kept, if self.strokes is lazily loaded (see Sketch).
+    Requires numpy; the control points are transformed in batches, and are
+    not decoded if they haven't been already."""
+    _require_numpy('Sketch.apply_transform()')
+    if strokes is None:
+      strokes = self.strokes
+    translation = numpy.asarray(translation, dtype=numpy.float64)
+    rotation = numpy.asarray(rotation_quat, dtype=numpy.float64)
+    def transform(positions, orientations):
+      return _transform_columns(positions, orientations, translation, rotation, scale)
+
+    columns = defaultdict(list)   # Sketch -> column slices, for columnar strokes
+    encoded = defaultdict(list)   # cp_mask -> strokes with undecoded control points
+    decoded = []
+    for stroke in strokes:
+      if scale != 1:
+        if stroke.has_stroke_extension('scale'):
+          stroke.scale *= scale
+        else:
+          stroke.scale = scale
+      if 'controlpoints' in stroke.__dict__:
+        decoded.append(stroke)
+      elif isinstance(stroke._controlpoints, _ColumnSlice):
+        columns[stroke._controlpoints.sketch].append(stroke._controlpoints)
+      elif stroke._controlpoints[0] is _make_cp_codec(stroke.cp_mask)[0]:
+        encoded[stroke.cp_mask].append(stroke)
+      else:
+        decoded.append(stroke)
+
+    for (sketch, slices) in columns.iteritems():
+      starts = numpy.array([sl.start for sl in slices], dtype=numpy.int64)
+      counts = numpy.array([len(sl) for sl in slices], dtype=numpy.int64)
+      if counts.sum() == len(sketch.positions):
+        rows = slice(None)
+      else:
+        firsts = numpy.zeros(len(slices), dtype=numpy.int64)
+        numpy.cumsum(counts[:-1], out=firsts[1:])
+        rows = numpy.repeat(starts - firsts, counts) + numpy.arange(counts.sum())
+      (sketch.positions[rows], sketch.orientations[rows]) = transform(
+        sketch.positions[rows], sketch.orientations[rows])
+
+    for (cp_mask, group) in encoded.iteritems():
+      # Keep them encoded, so that they're still written without re-encoding
+      records = _concatenate_records([s._controlpoints[2] for s in group],
+                                     _make_cp_dtype(cp_mask),
+                                     sum(s._controlpoints[1] for s in group))
+      (records['position'], records['orientation']) = transform(
+        records['position'], records['orientation'])
+      data = records.tostring()
+      pos = 0
+      for stroke in group:
+        (cp_decode, num_cp, raw_data) = stroke._controlpoints
+        stroke._controlpoints = (cp_decode, num_cp, buffer(data, pos, len(raw_data)))
+        pos += len(raw_data)
+
+    cps = [cp for stroke in decoded for cp in stroke.controlpoints]
+    if cps:
+      (positions, orientations) = transform(
+        numpy.array([cp.position for cp in cps], dtype=numpy.float64),
+        numpy.array([cp.orientation for cp in cps], dtype=numpy.float64))
+      for (cp, position, orientation) in zip(cps, positions.tolist(), orientations.tolist()):
+        cp.position = position
+        cp.orientation = orientation
 
   def _parse(self, b):
     # b is a binfile instance
     # mutates self
-    self.header = list(b.unpack("<3I"))
-    self.additional_header = b.read_length_prefixed()
-    (num_strokes, ) = b.unpack("<i")
-    assert 0 <= num_strokes < 300000, num_strokes
-    self.strokes = [Stroke.from_file(b) for i in xrange(num_strokes)]
+    (self.header, self.additional_header, num_strokes) = _read_sketch_header(b)
+    if num_strokes > LARGE_SKETCH_STROKES and self.layout == 'objects':
+      self.strokes = _LazyStrokeList.from_file(b, num_strokes)
+    else:
+      # Large strokes are spilled to disk if b is a stream
+      spill = _SpillFile()
+      self.strokes = [Stroke.from_file(b, spill) for i in xrange(num_strokes)]
+      spill.map()
+    if self.layout == 'columnar':
+      self._make_columns()
+
+  def _make_columns(self):
+    # Moves the raw control point data of every stroke into contiguous
+    # arrays, and points the strokes at them.
+    strokes = self.strokes
+    counts = numpy.array([s._controlpoints[1] for s in strokes], dtype=numpy.int64)
+    self.cp_offsets = numpy.zeros(len(strokes) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=self.cp_offsets[1:])
+    num_cp = self.cp_offsets[-1]
+    self.positions = numpy.empty((num_cp, 3), dtype=numpy.float32)
+    self.orientations = numpy.empty((num_cp, 4), dtype=numpy.float32)
+    self.cp_extensions = {}
+
+    stroke_idxs_by_mask = defaultdict(list)
+    for (i, stroke) in enumerate(strokes):
+      stroke_idxs_by_mask[stroke.cp_mask].append(i)
+
+    for (cp_mask, stroke_idxs) in stroke_idxs_by_mask.iteritems():
+      # Strokes with the same mask have identical layouts, so their
+      # data can be decoded in one go.
+      stroke_idxs = numpy.array(stroke_idxs, dtype=numpy.int64)
+      mask_counts = counts[stroke_idxs]
+      records = _concatenate_records([strokes[i]._controlpoints[2] for i in stroke_idxs.tolist()],
+                                     _make_cp_dtype(cp_mask), mask_counts.sum())
+      mask_starts = numpy.zeros(len(stroke_idxs), dtype=numpy.int64)
+      numpy.cumsum(mask_counts[:-1], out=mask_starts[1:])
+      if len(stroke_idxs) == len(strokes):
+        rows = slice(None)
+      else:
+        # Row of each record in the sketch-wide arrays
+        rows = (numpy.repeat(self.cp_offsets[stroke_idxs] - mask_starts, mask_counts) +
+                numpy.arange(len(records)))
+      self.positions[rows] = records['position']
+      self.orientations[rows] = records['orientation']
+
+      ext_names = records.dtype.names[2:]
+      extensions = numpy.empty(len(records), dtype=[(name, records.dtype[name])
+                                                   for name in ext_names])
+      for name in ext_names:
+        extensions[name] = records[name]
+      self.cp_extensions[cp_mask] = extensions
+
+      offsets = self.cp_offsets.tolist()
+      for (i, ext_start) in zip(stroke_idxs.tolist(), mask_starts.tolist()):
+        strokes[i]._controlpoints = _ColumnSlice(
+          self, offsets[i], offsets[i+1], extensions, ext_start)
 
   def _write(self, b):
     # b is a binfile instance.
     b.pack("<3I", *self.header)
     b.write_length_prefixed(self.additional_header)
     b.pack("<i", len(self.strokes))
-    for stroke in self.strokes:
-      stroke._write(b)
+    if isinstance(self.strokes, _LazyStrokeList):
+      self.strokes._write(b)
+    else:
+      for stroke in self.strokes:
+        stroke._write(b)
+
+
+class _LazyStrokeList(MutableSequence):
+  # The .strokes of a large sketch; see Sketch. Each item of _items is
+  # either a Stroke, or the offset in _data of a stroke not yet parsed.
+  # _extents is the offset of every stroke in _data, and then the end of
+  # the last one.
+  def __init__(self, data, offsets, end):
+    self._data = data
+    self._items = offsets
+    self._extents = array.array('L', offsets)
+    self._extents.append(end)
+
+  @classmethod
+  def from_file(cls, b, num_strokes):
+    """Reads the next *num_strokes* strokes of binfile *b*, which may be
+    a stream; only the stroke headers are parsed."""
+    if hasattr(b.inf, 'read_buffer'):
+      data = b.read_buffer(-1)
+    elif MMAP_SUBFILES:
+      data = _read_to_disk(b)
+    else:
+      data = b.read(-1)
+    strokes_b = binfile(bufferfile(data))
+    offsets = [header[0] for header in _iter_stroke_headers(strokes_b, num_strokes)]
+    if strokes_b.pos > len(data):
+      raise BadTilt('Truncated sketch data')
+    return cls(data, offsets, strokes_b.pos)
+
+  def _peek(self, i):
+    # Returns stroke i, without keeping it if it wasn't already
+    item = self._items[i]
+    if isinstance(item, (int, long)):
+      inf = bufferfile(self._data)
+      inf.seek(item)
+      item = Stroke.from_file(binfile(inf))
+    return item
+
+  def _iter_peek(self):
+    for i in xrange(len(self._items)):
+      yield self._peek(i)
+
+  def __len__(self):
+    return len(self._items)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self._items)))]
+    stroke = self._items[i] = self._peek(i)
+    return stroke
+
+  def __iter__(self):
+    for i in xrange(len(self._items)):
+      yield self[i]
+
+  def __setitem__(self, i, value):
+    if isinstance(i, slice):
+      value = list(value)
+    self._items[i] = value
+
+  def __delitem__(self, i):
+    del self._items[i]
+
+  def insert(self, i, stroke):
+    self._items.insert(i, stroke)
+
+  def _keep(self, indices):
+    # Removes all but the items at *indices*, which are in order
+    items = self._items
+    self._items = [items[i] for i in indices]
+
+  def _write(self, b):
+    # Strokes not yet parsed are copied from _data; runs of them that are
+    # still adjacent there are copied in one go.
+    extents = self._extents
+    (run_start, run_end) = (0, 0)
+    for item in self._items:
+      if isinstance(item, (int, long)):
+        end = extents[bisect.bisect_right(extents, item)]
+        if item != run_end:
+          b.write(self._data[run_start : run_end])
+          run_start = item
+        run_end = end
+      else:
+        b.write(self._data[run_start : run_end])
+        (run_start, run_end) = (0, 0)
+        item._write(b)
+    b.write(self._data[run_start : run_end])
+
+
+def _iter_for_reading(strokes):
+  """Iterates over *strokes*, without keeping the strokes of a lazily loaded
+  sketch that it has to parse; see Sketch."""
+  if isinstance(strokes, _LazyStrokeList):
+    return strokes._iter_peek()
+  return iter(strokes)
+
+
+class SketchView(object):
+  """Some of the strokes of a Sketch; see Sketch.select(). Attributes:
+    .sketch             The Sketch
+    .indices            Indices of the strokes in sketch.strokes, in order
+    .strokes            The strokes themselves
+    .header             As for Sketch
+    .additional_header  As for Sketch
+
+  The strokes are shared with the sketch, not copied, so selecting is cheap
+  and writing reuses their raw data where possible (see Stroke). Changing a
+  stroke changes it in the sketch too; clone() it first to avoid that.
+  A view describes the sketch's strokes as they were when it was made."""
+  def __init__(self, sketch, indices):
+    self.sketch = sketch
+    self.indices = list(indices)
+
+  @property
+  def strokes(self):
+    strokes = self.sketch.strokes
+    return [strokes[i] for i in self.indices]
+
+  @property
+  def header(self):
+    return self.sketch.header
+
+  @property
+  def additional_header(self):
+    return self.sketch.additional_header
+
+  @property
+  def bounds(self):
+    """As for Sketch.bounds."""
+    return _union_bounds(s.bounds for s in self.strokes)
+
+  def __len__(self):
+    return len(self.indices)
+
+  def select(self, **criteria):
+    """Returns a SketchView of the strokes in this view that also match
+    *criteria*, which are as for Sketch.select()."""
+    return SketchView(self.sketch, _select(self.sketch.strokes, self.indices, **criteria))
+
+  def write(self, destination):
+    """Writes a sketch of just these strokes. destination is as for
+    Sketch.write(). To make a new .tilt, copy the original and write the
+    view into the copy. Returns the number of strokes written."""
+    return Sketch.write_iter(destination, self.strokes, self.header, self.additional_header)
+
+
+def _select(strokes, indices, brush=None, brush_index=None, color=None, size=None,
+            group=None, time=None, bbox=None):
+  """Returns the indices (from *indices*) of the strokes that match; see
+  Sketch.select()."""
+  def as_set(value):
+    if isinstance(value, (int, long, basestring)):
+      return set([value])
+    return set(value)
+
+  if brush is not None:
+    brush_idxs = set()
+    for b in as_set(brush):
+      if isinstance(b, basestring):
+        if brush_index is None:
+          raise ValueError('Selecting by brush GUID requires brush_index')
+        brush_idxs.update(i for (i, guid) in enumerate(brush_index) if guid.lower() == b.lower())
+      else:
+        brush_idxs.add(b)
+  if group is not None:
+    groups = as_set(group)
+
+  # Cheapest tests first; the time and bbox tests look at control points
+  if isinstance(strokes, _LazyStrokeList):
+    get_stroke = strokes._peek
+  else:
+    get_stroke = strokes.__getitem__
+  selected = []
+  for i in indices:
+    stroke = get_stroke(i)
+    if brush is not None and stroke.brush_idx not in brush_idxs:
+      continue
+    if color is not None and not all(lo <= c <= hi for (lo, c, hi)
+                                     in zip(color[0], stroke.brush_color, color[1])):
+      continue
+    if size is not None and not size[0] <= stroke.brush_size <= size[1]:
+      continue
+    if group is not None:
+      if stroke.has_stroke_extension('group'):
+        stroke_group = stroke.get_stroke_extension('group')
+      else:
+        stroke_group = 0
+      if stroke_group not in groups:
+        continue
+    if time is not None:
+      time_range = _stroke_time_range(stroke)
+      if time_range is None or time_range[1] < time[0] or time_range[0] > time[1]:
+        continue
+    if bbox is not None:
+      bounds = stroke.bounds
+      if bounds is None or not all(blo <= hi and bhi >= lo for (lo, hi, blo, bhi)
+                                   in zip(bbox[0], bbox[1], bounds[0], bounds[1])):
+        continue
+    selected.append(i)
+  return selected
+
+
+# Stroke attributes that Sketch.stroke_column() supports, and their dtypes
+_STROKE_ATTRIBUTES = {
+  'brush_idx': '<i4',
+  'brush_color': ('<f4', (4, )),
+  'brush_size': '<f4',
+}
+
+
+def _stroke_field_dtype(name):
+  """Returns the numpy dtype of stroke_column(name)."""
+  if name in _STROKE_ATTRIBUTES:
+    return numpy.dtype(_STROKE_ATTRIBUTES[name])
+  try:
+    return numpy.dtype(NUMPY_EXTENSION_TYPES[STROKE_EXTENSION_BY_NAME[name][1]])
+  except KeyError:
+    raise ValueError('Unknown stroke extension %r' % (name, ))
+
+
+def _cp_field_dtype(name):
+  """Returns the numpy dtype of cp_column(name)."""
+  if name in ('position', 'orientation'):
+    return _make_cp_dtype(0)[name]
+  for (bit, info) in CONTROLPOINT_EXTENSION_BITS.iteritems():
+    if bit != 'unknown' and info[0] == name:
+      return _make_cp_dtype(bit)[name]
+  if name.startswith('cp_ext_') and name[7:].isdigit():
+    return _make_cp_dtype(1 << int(name[7:]))[name]
+  raise ValueError('Unknown control point field %r' % (name, ))
+
+
+def _stroke_time_range(stroke):
+  """Returns (earliest, latest) control point timestamp of *stroke*, or None
+  if it has none."""
+  if not stroke.has_cp_extension('timestamp') or stroke.num_controlpoints == 0:
+    return None
+  if numpy is not None:
+    timestamps = stroke.controlpoint_array()['timestamp']
+    return (timestamps.min().item(), timestamps.max().item())
+  i = stroke.cp_ext_lookup['timestamp']
+  timestamps = [cp.extension[i] for cp in stroke.controlpoints]
+  return (min(timestamps), max(timestamps))
+
+
+class Timeline(object):
+  """When each stroke of a sketch was drawn, indexed by time; see
+  Sketch.timeline. Times are values of the 'timestamp' control point
+  extension, which Tilt Brush writes in milliseconds. Strokes without
+  timestamps are left out of the queries. Attributes:
+    .start, .end   int64 arrays of length len(strokes): the earliest and latest
+                   timestamp of each stroke, or -1 if it has none
+  Requires numpy."""
+  def __init__(self, strokes):
+    _require_numpy('Timeline')
+    num_strokes = len(strokes)
+    self.start = numpy.full(num_strokes, -1, dtype=numpy.int64)
+    self.end = numpy.full(num_strokes, -1, dtype=numpy.int64)
+    # The time each control point appears, for replay(): the running maximum
+    # of the timestamps, so a stroke is always revealed from its beginning.
+    reveal = []
+    self._cp_offsets = numpy.zeros(num_strokes + 1, dtype=numpy.int64)
+    for (i, stroke) in enumerate(_iter_for_reading(strokes)):
+      if stroke.has_cp_extension('timestamp') and stroke.num_controlpoints > 0:
+        timestamps = stroke.controlpoint_array()['timestamp']
+        self.start[i] = timestamps.min()
+        self.end[i] = timestamps.max()
+        reveal.append(numpy.maximum.accumulate(timestamps))
+        self._cp_offsets[i + 1] = len(timestamps)
+    numpy.cumsum(self._cp_offsets, out=self._cp_offsets)
+    self._reveal = numpy.concatenate(reveal) if reveal else numpy.empty(0, dtype=numpy.int64)
+
+    timed = numpy.flatnonzero(self.start >= 0)
+    self._by_start = timed[numpy.argsort(self.start[timed], kind='mergesort')]
+    self._sorted_starts = self.start[self._by_start]
+    self._by_end = timed[numpy.argsort(self.end[timed], kind='mergesort')]
+    self._sorted_ends = self.end[self._by_end]
+    # Bounds how far before t0 a stroke overlapping (t0, t1) can start
+    self._max_duration = (self.end[timed] - self.start[timed]).max() if len(timed) else 0
+
+  def __len__(self):
+    """The number of strokes with timestamps."""
+    return len(self._by_start)
+
+  @property
+  def time_range(self):
+    """(earliest, latest) timestamp in the sketch, or None if there are none."""
+    if len(self) == 0:
+      return None
+    return (self._sorted_starts[0].item(), self._sorted_ends[-1].item())
+
+  def between(self, t0, t1):
+    """Returns the indices of the strokes drawn at least partly within
+    [t0, t1], in stroke order, as an int64 array."""
+    lo = numpy.searchsorted(self._sorted_starts, t0 - self._max_duration, 'left')
+    hi = numpy.searchsorted(self._sorted_starts, t1, 'right')
+    candidates = self._by_start[lo:hi]
+    return numpy.sort(candidates[self.end[candidates] >= t0])
+
+  def started_by(self, t):
+    """Returns the indices of the strokes begun at or before time t, in order
+    of starting time."""
+    return self._by_start[:numpy.searchsorted(self._sorted_starts, t, 'right')]
+
+  def finished_by(self, t):
+    """Returns the indices of the strokes completed at or before time t, in
+    order of finishing time."""
+    return self._by_end[:numpy.searchsorted(self._sorted_ends, t, 'right')]
+
+  def replay(self, fps, start=None, stop=None, units_per_second=1000):
+    """Generates the sketch being drawn, one frame at a time, as
+    (time, increments). increments is a list of (stroke index, cp_start,
+    cp_stop), in stroke order: control points [cp_start, cp_stop) of that
+    stroke appeared since the previous frame.
+
+    Frames are *fps* per second, where a second is *units_per_second*
+    timestamp units. They run from time *start* (default: the first
+    timestamp) to *stop* (default: the last); the first frame includes
+    everything drawn up to *start*. Each frame only looks at the strokes
+    being drawn at the time, so the cost of a replay is proportional to its
+    length plus the size of the sketch, not their product."""
+    if len(self) == 0:
+      return
+    if start is None:
+      start = self._sorted_starts[0].item()
+    if stop is None:
+      stop = self._sorted_ends[-1].item()
+    step = float(units_per_second) / fps
+    revealed = {}     # Stroke index -> control points revealed so far, for partly-drawn strokes
+    num_started = 0
+    frame = 0
+    while True:
+      t = start + frame * step
+      if t >= stop:
+        t = stop
+      started = numpy.searchsorted(self._sorted_starts, t, 'right')
+      for i in self._by_start[num_started:started].tolist():
+        revealed[i] = 0
+      num_started = started
+
+      increments = []
+      for i in sorted(revealed):
+        reveal = self._reveal[self._cp_offsets[i] : self._cp_offsets[i + 1]]
+        n = int(numpy.searchsorted(reveal, t, 'right'))
+        if n > revealed[i]:
+          increments.append((i, revealed[i], n))
+        if n == len(reveal):
+          del revealed[i]
+        else:
+          revealed[i] = n
+      yield (t, increments)
+      if t >= stop:
+        break
+      frame += 1
+
+
+class SketchStream(object):
+  """Reads the strokes of a sketch one at a time, so that only the current
+  stroke needs to be in memory. Attributes:
+    .header             As for Sketch
+    .additional_header  As for Sketch
+    .num_strokes        Number of strokes in the sketch
+
+  Iterating yields tilt.Stroke instances, and can only be done once.
+  The source is released when iteration finishes, or on close().
+  SketchStream is also a context manager."""
+  def __init__(self, source):
+    """source is as for Sketch()."""
+    self._reader = _sketch_reader(source)
+    self._b = self._reader.__enter__()
+    try:
+      (self.header, self.additional_header, self.num_strokes) = \
+          _read_sketch_header(self._b)
+    except:
+      self.close()
+      raise
+    self._num_unread = self.num_strokes
+
+  def __iter__(self):
+    try:
+      while self._num_unread > 0 and self._b is not None:
+        self._num_unread -= 1
+        yield Stroke.from_file(self._b)
+    finally:
+      self.close()
+
+  def close(self):
+    if self._reader is not None:
+      reader, self._reader, self._b = self._reader, None, None
+      reader.__exit__(None, None, None)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
 
 
 class Stroke(object):
@@ -372,7 +2009,9 @@ class Stroke(object):
     .brush_color    RGBA color, as 4 floats in the range [0, 1]
     .brush_size     Brush size, in decimeters, as a float. Multiply by
                     get_stroke_extension('scale') to get a true size.
-    .controlpoints  List of tilt.ControlPoint instances.
+    .controlpoints  List of tilt.ControlPoint instances. These are decoded
+                    on first access; strokes whose control points were never
+                    decoded are written back out without re-encoding them.
 
     .flags          Wrapper around get/set_stroke_extension('flags')
     .scale          Wrapper around get/set_stroke_extension('scale')
@@ -393,15 +2032,27 @@ class Stroke(object):
   #   stroke.cp_ext_lookup, not in the control point.
 
   @classmethod
-  def from_file(cls, b):
+  def from_file(cls, b, spill=None):
     inst = cls()
-    inst._parse(b)
+    inst._parse(b, spill)
     return inst
 
   def clone(self):
-    """Returns a deep copy of the stroke."""
-    inst = self.shallow_clone()
-    inst.controlpoints = map(ControlPoint.clone, inst.controlpoints)
+    """Returns a deep copy of the stroke. Control points that haven't been
+    decoded aren't copied: the clone shares their raw data, which is never
+    modified, and decodes its own ControlPoints from it if they're used.
+    Columnar control points are copied as raw data, without decoding them."""
+    inst = self._clone_header()
+    if 'controlpoints' in self.__dict__:
+      inst.controlpoints = [cp.clone() for cp in self.controlpoints]
+    elif isinstance(self._controlpoints, _ColumnSlice):
+      cp_decode = _make_cp_codec(self.cp_mask)[0]
+      inst._controlpoints = (cp_decode, len(self._controlpoints),
+                             buffer(self._controlpoints.tostring(self.cp_mask)))
+    else:
+      inst._controlpoints = self._controlpoints
+      if '_bounds' in self.__dict__:
+        inst._bounds = self._bounds
     return inst
 
   def __getattr__(self, name):
@@ -428,16 +2079,46 @@ class Stroke(object):
 
   def shallow_clone(self):
     """Clone everything but the control points themselves."""
+    inst = self._clone_header()
+    inst.controlpoints = list(self.controlpoints)
+    return inst
+
+  def _clone_header(self):
+    # Returns a copy of everything but the control points
     inst = self.__class__()
     for attr in ('brush_idx', 'brush_color', 'brush_size', 'stroke_mask', 'cp_mask',
                  'stroke_ext_writer', 'stroke_ext_lookup', 'cp_ext_writer', 'cp_ext_lookup'):
       setattr(inst, attr, getattr(self, attr))
     inst.extension = list(self.extension)
-    inst.controlpoints = list(self.controlpoints)
     return inst
 
-  def _parse(self, b):
+  def _parse(self, b, spill=None):
     # b is a binfile instance
+    # spill, if passed, is the _SpillFile for large strokes; otherwise they
+    # each get a temporary file of their own.
+    num_cp = self._parse_header(b)
+
+    # Read the raw data up front, but parse it lazily. If the file is
+    # memory-mapped, this doesn't copy or even touch the data.
+    num_bytes = num_cp * 4 * (3 + 4 + len(self.cp_ext_lookup))
+    cp_decode = _make_cp_codec(self.cp_mask)[0]
+    if (num_cp > LARGE_STROKE_CONTROLPOINTS and MMAP_SUBFILES and
+        not hasattr(b.inf, 'read_buffer')):
+      if spill is not None:
+        self._controlpoints = (cp_decode, num_cp, None)
+        if spill.add(self, b, num_bytes) != num_bytes:
+          raise BadTilt('Truncated control point data')
+        return
+      raw_data = _read_to_disk(b, num_bytes)
+    else:
+      raw_data = b.read_buffer(num_bytes)
+    if len(raw_data) != num_bytes:
+      raise BadTilt('Truncated control point data')
+    self._controlpoints = (cp_decode, num_cp, raw_data)
+
+  def _parse_header(self, b):
+    # Parses everything but the control point data; returns the number of
+    # control points that follow.
     (self.brush_idx, ) = b.unpack("<i")
     self.brush_color = b.unpack("<4f")
     (self.brush_size, self.stroke_mask, self.cp_mask) = b.unpack("<fII")
@@ -445,21 +2126,102 @@ class Stroke(object):
         _make_stroke_ext_reader(self.stroke_mask)
     self.extension = stroke_ext_reader(b)
 
-    cp_ext_reader, self.cp_ext_writer, self.cp_ext_lookup = \
-        _make_cp_ext_reader(self.cp_mask)
+    _, self.cp_ext_writer, self.cp_ext_lookup = _make_cp_ext_reader(self.cp_mask)
     
     (num_cp, ) = b.unpack("<i")
-    assert num_cp < 10000, num_cp
-
-    # Read the raw data up front, but parse it lazily
-    bytes_per_cp = 4 * (3 + 4 + len(self.cp_ext_lookup))
-    self._controlpoints = (cp_ext_reader, num_cp, b.inf.read(num_cp * bytes_per_cp))
+    if num_cp < 0:
+      raise BadTilt('Bad control point count %d' % num_cp)
+    return num_cp
 
   @memoized_property
   def controlpoints(self):
-    (cp_ext_reader, num_cp, raw_data) = self.__dict__.pop('_controlpoints')
-    b = binfile(StringIO(raw_data))
-    return [ControlPoint.from_file(b, cp_ext_reader) for i in xrange(num_cp)]
+    if isinstance(self._controlpoints, _ColumnSlice):
+      # Leave the slice in place; the views write through to it
+      return self._controlpoints.controlpoints()
+    (cp_decode, num_cp, raw_data) = self.__dict__.pop('_controlpoints')
+    return cp_decode(raw_data, num_cp)
+
+  @property
+  def num_controlpoints(self):
+    """Same as len(self.controlpoints), but doesn't decode them."""
+    if 'controlpoints' in self.__dict__:
+      return len(self.controlpoints)
+    elif isinstance(self._controlpoints, _ColumnSlice):
+      return len(self._controlpoints)
+    else:
+      return self._controlpoints[1]
+
+  @property
+  def bounds(self):
+    """((min x, y, z), (max x, y, z)) of the control point positions, or
+    None if there are none. Doesn't decode .controlpoints.
+
+    Bounds of control points that haven't been decoded are cached; the
+    cache is dropped whenever the control points are replaced (eg by
+    Sketch.apply_transform()). Decoded and columnar control points can be
+    changed in place, so their bounds are recomputed every time."""
+    if 'controlpoints' in self.__dict__:
+      return _positions_bounds([cp.position for cp in self.controlpoints])
+    cps = self._controlpoints
+    if isinstance(cps, _ColumnSlice):
+      return _positions_bounds(cps.sketch.positions[cps.start:cps.stop])
+    cached = self.__dict__.get('_bounds')
+    if cached is not None and cached[0] is cps:
+      return cached[1]
+    (cp_decode, num_cp, raw_data) = cps
+    if cp_decode is _make_cp_codec(self.cp_mask)[0]:
+      bounds = _raw_bounds(raw_data, num_cp, self.cp_mask)
+    else:
+      bounds = _positions_bounds([cp.position for cp in cp_decode(raw_data, num_cp)])
+    self._bounds = (cps, bounds)
+    return bounds
+
+  def controlpoint_array(self):
+    """Returns a copy of the control points as a numpy record array, with
+    fields 'position', 'orientation', and one per control point extension.
+    Doesn't decode .controlpoints if they haven't been already.
+    Requires numpy."""
+    _require_numpy('Stroke.controlpoint_array()')
+    dtype = _make_cp_dtype(self.cp_mask)
+    if 'controlpoints' not in self.__dict__:
+      if isinstance(self._controlpoints, _ColumnSlice):
+        return self._controlpoints.records(self.cp_mask)
+      (cp_decode, num_cp, raw_data) = self._controlpoints
+      if cp_decode is _make_cp_codec(self.cp_mask)[0]:
+        return _concatenate_records([raw_data], dtype, num_cp)
+    cps = self.controlpoints
+    records = numpy.empty(len(cps), dtype=dtype)
+    if cps:
+      records['position'] = [cp.position for cp in cps]
+      records['orientation'] = [cp.orientation for cp in cps]
+      for (name, i) in self.cp_ext_lookup.iteritems():
+        records[name] = [cp.extension[i] for cp in cps]
+    return records
+
+  def fingerprint(self):
+    """Returns a digest (as a hex string) of the whole stroke, as written to
+    a .tilt: header, extension data and control points. Strokes with equal
+    fingerprints are identical. Doesn't decode .controlpoints."""
+    import hashlib
+    return hashlib.sha1(self._tostring()).hexdigest()
+
+  def _tostring(self):
+    # Returns the stroke, serialized as for a .tilt
+    tmpf = StringIO()
+    self._write(binfile(tmpf))
+    return tmpf.getvalue()
+
+  def set_controlpoint_array(self, records):
+    """Replaces the control points with *records*, a numpy record array like
+    the ones controlpoint_array() returns. They're kept encoded, so they
+    aren't decoded until .controlpoints is used, and are written as-is.
+    Columnar strokes stop sharing the sketch's arrays.
+    Requires numpy."""
+    _require_numpy('Stroke.set_controlpoint_array()')
+    records = numpy.asarray(records, dtype=_make_cp_dtype(self.cp_mask))
+    self.__dict__.pop('controlpoints', None)
+    cp_decode = _make_cp_codec(self.cp_mask)[0]
+    self._controlpoints = (cp_decode, len(records), buffer(records.tostring()))
 
   def has_stroke_extension(self, name):
     """Returns true if this stroke has the requested extension data.
@@ -537,13 +2299,32 @@ class Stroke(object):
     cp.extension[idx] = value
 
   def _write(self, b):
+    self._write_header(b)
+    if 'controlpoints' not in self.__dict__:
+      # The control points were never decoded, so can't have been modified.
+      if isinstance(self._controlpoints, _ColumnSlice):
+        column_slice = self._controlpoints
+        b.pack("<i", len(column_slice))
+        b.write(column_slice.tostring(self.cp_mask))
+        return
+      (cp_decode, num_cp, raw_data) = self._controlpoints
+      if cp_decode is _make_cp_codec(self.cp_mask)[0]:
+        # Same layout as when read, so the original bytes can be reused
+        b.pack("<i", num_cp)
+        b.write(raw_data)
+        return
+    b.pack("<i", len(self.controlpoints))
+    b.write(_make_cp_codec(self.cp_mask)[1](self.controlpoints))
+
+  def _write_header(self, b, num_cp=None):
+    # Writes everything before the control points; with num_cp, the number
+    # of control points too. The inverse of _parse_header().
     b.pack("<i", self.brush_idx)
     b.pack("<4f", *self.brush_color)
     b.pack("<fII", self.brush_size, self.stroke_mask, self.cp_mask)
     self.stroke_ext_writer(b, self.extension)
-    b.pack("<i", len(self.controlpoints))
-    for cp in self.controlpoints:
-      cp._write(b, self.cp_ext_writer)
+    if num_cp is not None:
+      b.pack("<i", num_cp)
 
 
 class ControlPoint(object):
@@ -551,6 +2332,14 @@ class ControlPoint(object):
     .position    Position as 3 floats. Units are decimeters.
     .orientation Orientation of controller as a quaternion (x, y, z, w)."""
   @classmethod
+  def _from_values(cls, position, orientation, extension):
+    inst = cls()
+    inst.position = position
+    inst.orientation = orientation
+    inst.extension = extension
+    return inst
+
+  @classmethod
   def from_file(cls, b, cp_ext_reader):
     # b is a binfile instance
     # reader reads controlpoint extension data from the binfile
@@ -570,3 +2359,115 @@ class ControlPoint(object):
     p = self.position; o = self.orientation
     b.pack("<7f", p[0], p[1], p[2], o[0], o[1], o[2], o[3])
     cp_ext_writer(b, self.extension)
+
+
+class _ColumnSlice(object):
+  """The control points of one stroke in a columnar Sketch."""
+  __slots__ = ('sketch', 'start', 'stop', 'extensions', 'ext_start')
+
+  def __init__(self, sketch, start, stop, extensions, ext_start):
+    self.sketch = sketch
+    self.start = start
+    self.stop = stop
+    self.extensions = extensions  # record array; rows are relative to ext_start
+    self.ext_start = ext_start
+
+  def __len__(self):
+    return self.stop - self.start
+
+  def controlpoints(self):
+    return [_ControlPointView(self, i) for i in xrange(len(self))]
+
+  def records(self, cp_mask):
+    """Returns a copy of the control points, as a record array of
+    _make_cp_dtype(cp_mask)."""
+    records = numpy.empty(len(self), dtype=_make_cp_dtype(cp_mask))
+    records['position'] = self.sketch.positions[self.start:self.stop]
+    records['orientation'] = self.sketch.orientations[self.start:self.stop]
+    extensions = self.extensions[self.ext_start : self.ext_start + len(self)]
+    for name in records.dtype.names[2:]:
+      records[name] = extensions[name]
+    return records
+
+  def tostring(self, cp_mask):
+    """Returns the control points, serialized as for a .tilt file."""
+    return self.records(cp_mask).tostring()
+
+  def set_field(self, name, values):
+    """Writes *values* to field *name* (as for records()) of the control
+    points."""
+    if name == 'position':
+      self.sketch.positions[self.start:self.stop] = values
+    elif name == 'orientation':
+      self.sketch.orientations[self.start:self.stop] = values
+    else:
+      self.extensions[name][self.ext_start : self.ext_start + len(self)] = values
+
+
+class _RowList(list):
+  # The values of one row of a columnar Sketch's arrays, as a list; setting
+  # an item sets it in the row too. See _ControlPointView.
+  def __init__(self, values, write_row):
+    list.__init__(self, values)
+    self._write_row = write_row
+
+  def __setitem__(self, i, value):
+    list.__setitem__(self, i, value)
+    self._write_row(self)
+
+  def __setslice__(self, i, j, values):
+    list.__setslice__(self, i, j, values)
+    self._write_row(self)
+
+
+class _ControlPointView(ControlPoint):
+  """A ControlPoint whose data lives in the arrays of a columnar Sketch.
+  Like other ControlPoints, its position, orientation and extension are
+  lists; they are read from the arrays each time, and setting them, or
+  an item of them, writes to the arrays."""
+  def __init__(self, column_slice, i):
+    self._slice = column_slice
+    self._i = i
+
+  def _row_list(self, array, row):
+    def write_row(values):
+      array[row] = values
+    return _RowList(array[row].tolist(), write_row)
+
+  @property
+  def position(self):
+    return self._row_list(self._slice.sketch.positions, self._slice.start + self._i)
+
+  @position.setter
+  def position(self, value):
+    self._slice.sketch.positions[self._slice.start + self._i] = value
+
+  @property
+  def orientation(self):
+    return self._row_list(self._slice.sketch.orientations, self._slice.start + self._i)
+
+  @orientation.setter
+  def orientation(self, value):
+    self._slice.sketch.orientations[self._slice.start + self._i] = value
+
+  @property
+  def extension(self):
+    extensions = self._slice.extensions
+    if not extensions.dtype.names:
+      return []
+    row = self._slice.ext_start + self._i
+    def write_row(values):
+      extensions[row] = tuple(values)
+    return _RowList(extensions[row].item(), write_row)
+
+  @extension.setter
+  def extension(self, value):
+    extensions = self._slice.extensions
+    if extensions.dtype.names:
+      extensions[self._slice.ext_start + self._i] = tuple(value)
+
+  def clone(self):
+    inst = ControlPoint()
+    for attr in ('position', 'orientation', 'extension'):
+      setattr(inst, attr, list(getattr(self, attr)))
+    return inst
@@ -16,12 +16,14 @@
 and vice versa. Applies sanity checks when packing."""
 
 from cStringIO import StringIO
+import copy
 import os
 import sys
 import struct
 import zipfile
 
-__all__ = ('ConversionError', 'convert_zip_to_dir', 'convert_dir_to_zip')
+__all__ = ('ConversionError', 'convert_zip_to_dir', 'convert_dir_to_zip',
+           'replace_zip_members')
 
 HEADER_FMT = '<4sHH'
 HEADER_V1_FMT = HEADER_FMT + 'II'
@@ -180,3 +182,108 @@ def convert_dir_to_zip(in_name, compress):
 
   finally:
     _destroy(out_name)
+
+
+class _OffsetFile(object):
+  """Makes a file look like it starts *base* bytes in.
+  Lets zipfile write a zip that follows the .tilt header."""
+  def __init__(self, outf, base):
+    self.outf = outf
+    self.base = base
+
+  def write(self, data):
+    self.outf.write(data)
+
+  def tell(self):
+    return self.outf.tell() - self.base
+
+  def seek(self, pos, whence=0):
+    if whence == 0:
+      pos += self.base
+    self.outf.seek(pos, whence)
+
+  def flush(self):
+    self.outf.flush()
+
+
+def _member_span(inf, member):
+  """Returns (offset, length) of the raw bytes of zip member *member*:
+  local header, (possibly compressed) data, and data descriptor."""
+  inf.seek(member.header_offset)
+  fheader = struct.unpack(zipfile.structFileHeader, inf.read(zipfile.sizeFileHeader))
+  if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+    raise ConversionError("Bad local header for %s" % member.filename)
+  length = (zipfile.sizeFileHeader + fheader[zipfile._FH_FILENAME_LENGTH] +
+            fheader[zipfile._FH_EXTRA_FIELD_LENGTH] + member.compress_size)
+  if member.flag_bits & 0x08:
+    # Data descriptor, with optional signature
+    inf.seek(member.header_offset + length)
+    length += 16 if inf.read(4) == 'PK\x07\x08' else 12
+  return (member.header_offset, length)
+
+
+def _copy_bytes(inf, outf, offset, length):
+  inf.seek(offset)
+  while length > 0:
+    data = inf.read(min(length, 1 << 20))
+    if not data:
+      raise ConversionError("Unexpected end of file")
+    outf.write(data)
+    length -= len(data)
+
+
+def replace_zip_members(in_name, replacements, compress=None):
+  """Rewrites the packed .tilt *in_name*, replacing or adding members.
+  replacements maps member name to the name of a file holding its new contents.
+  Other members are copied over as-is, without recompressing them.
+  New contents are compressed if *compress* is true; if it is None, they
+  are compressed if any existing member is.
+  The result is written next to *in_name* and then renamed over it."""
+  out_name = in_name + '.part'
+  if os.path.exists(out_name):
+    raise ConversionError("Remove %s first" % out_name)
+
+  def by_standard_order(filename):
+    return STANDARD_FILE_ORDER.get(filename.lower(), len(STANDARD_FILE_ORDER))
+
+  try:
+    with file(in_name, 'rb') as inf:
+      header_bytes = _read_and_check_header(inf)
+      with zipfile.ZipFile(inf) as inzip:
+        members = inzip.infolist()
+      if compress is None:
+        compress = any(m.compress_type != zipfile.ZIP_STORED for m in members)
+      members_by_name = dict((m.filename, m) for m in members)
+      names = [m.filename for m in members]
+      names.extend(sorted(set(replacements) - set(names)))
+      names.sort(key=by_standard_order)
+
+      with file(out_name, 'wb') as outf:
+        outf.write(header_bytes)
+        # Member offsets are relative to the start of the zip, as for
+        # convert_dir_to_zip()
+        with zipfile.ZipFile(_OffsetFile(outf, len(header_bytes)), 'w') as outzip:
+          for name in names:
+            old_member = members_by_name.get(name)
+            if name in replacements:
+              if old_member is not None:
+                compress_type = old_member.compress_type
+              elif compress:
+                compress_type = zipfile.ZIP_DEFLATED
+              else:
+                compress_type = zipfile.ZIP_STORED
+              outzip.write(replacements[name], name, compress_type)
+            else:
+              (offset, length) = _member_span(inf, old_member)
+              new_member = copy.copy(old_member)
+              new_member.header_offset = outzip.fp.tell()
+              _copy_bytes(inf, outf, offset, length)
+              outzip.filelist.append(new_member)
+              outzip.NameToInfo[name] = new_member
+              outzip._didModify = True
+
+    if os.name == 'nt':
+      _destroy(in_name)
+    os.rename(out_name, in_name)
+  finally:
+    _destroy(out_name)
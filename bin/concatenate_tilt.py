@@ -14,11 +14,19 @@ def destroy(filename):
     pass
 
 
-def increment_timestamp(stroke, increment):
-  """Adds *increment* to all control points in stroke."""
-  timestamp_idx = stroke.cp_ext_lookup['timestamp']
-  for cp in stroke.controlpoints:
-    cp.extension[timestamp_idx] += increment
+def increment_timestamps(sketch, increment):
+  """Adds *increment* to the timestamp of every control point in sketch.
+  Uses numpy if it's available, and is much slower if not."""
+  if tilt.numpy is not None:
+    (timestamps, _) = sketch.cp_column('timestamp')
+    sketch.set_cp_column('timestamp', timestamps + increment)
+    return
+  for stroke in sketch.strokes:
+    timestamp_idx = stroke.cp_ext_lookup.get('timestamp')
+    if timestamp_idx is not None:
+      for cp in stroke.controlpoints:
+        # Timestamps are integers; truncate, as set_cp_column() does
+        cp.extension[timestamp_idx] = int(cp.extension[timestamp_idx] + increment)
 
 
 def merge_metadata_from_tilt(tilt_dest, tilt_source):
@@ -30,13 +38,11 @@ def merge_metadata_from_tilt(tilt_dest, tilt_source):
     to_append = set(tilt_source.metadata['BrushIndex']) - set(md['BrushIndex'])
     md['BrushIndex'].extend(sorted(to_append))
 
-  if 'ImageIndex' in tilt_source.metadata:
-    tilt_dest.metadata['ImageIndex'] = tilt_dest.metadata.get('ImageIndex', []) + \
-                                       tilt_source.metadata['ImageIndex']
+    if 'ImageIndex' in tilt_source.metadata:
+      md['ImageIndex'] = md.get('ImageIndex', []) + tilt_source.metadata['ImageIndex']
 
-  if 'ModelIndex' in tilt_source.metadata:
-    tilt_dest.metadata['ModelIndex'] = tilt_dest.metadata.get('ModelIndex', []) + \
-                                       tilt_source.metadata['ModelIndex']
+    if 'ModelIndex' in tilt_source.metadata:
+      md['ModelIndex'] = md.get('ModelIndex', []) + tilt_source.metadata['ModelIndex']
 
 
 def concatenate(file_1, file_2, file_out):
@@ -45,33 +51,39 @@ def concatenate(file_1, file_2, file_out):
   file_tmp = file_out + "__tmp"
   destroy(file_tmp)
   shutil.copyfile(file_1, file_tmp)
-  tilt_out = tilt.Tilt(file_tmp)
-  tilt_2 = tilt.Tilt(file_2)
-
-  merge_metadata_from_tilt(tilt_out, tilt_2)
+  # Both are closed before file_out is replaced; it may be one of them
+  with tilt.Tilt(file_tmp) as tilt_out, tilt.Tilt(file_2) as tilt_2:
+    concatenate_into(tilt_out, tilt_2)
+  destroy(file_out)
+  os.rename(file_tmp, file_out)
 
-  tilt_out._guid_to_idx = dict(
-    (guid, index)
-    for (index, guid) in enumerate(tilt_out.metadata['BrushIndex']))
 
-  final_stroke = tilt_out.sketch.strokes[-1]
-  final_timestamp = final_stroke.get_cp_extension(final_stroke.controlpoints[-1], 'timestamp')
-  timestamp_offset = final_timestamp + .03
+def concatenate_into(tilt_out, tilt_2):
+  """Appends the strokes of tilt_2 to those of tilt_out, and writes tilt_out."""
+  # Write the metadata and sketch changes in a single pass
+  with tilt_out.transaction():
+    merge_metadata_from_tilt(tilt_out, tilt_2)
 
-  for stroke in tilt_2.sketch.strokes:
-    copy = stroke.clone()
+    tilt_out._guid_to_idx = dict(
+      (guid, index)
+      for (index, guid) in enumerate(tilt_out.metadata['BrushIndex']))
 
-    # Convert brush index to one that works for tilt_out
-    stroke_guid = tilt_2.metadata['BrushIndex'][stroke.brush_idx]
-    copy.brush_idx = tilt_out._guid_to_idx[stroke_guid]
-    tilt_out.sketch.strokes.append(copy)
+    final_stroke = tilt_out.sketch.strokes[-1]
+    final_timestamp = final_stroke.get_cp_extension(final_stroke.controlpoints[-1], 'timestamp')
+    timestamp_offset = final_timestamp + .03
 
     # Adjust timestamps to keep stroke times from overlapping.
-    increment_timestamp(stroke, timestamp_offset)
+    increment_timestamps(tilt_2.sketch, timestamp_offset)
 
-  tilt_out.write_sketch()
-  destroy(file_out)
-  os.rename(file_tmp, file_out)
+    for stroke in tilt_2.sketch.strokes:
+      copy = stroke.clone()
+
+      # Convert brush index to one that works for tilt_out
+      stroke_guid = tilt_2.metadata['BrushIndex'][stroke.brush_idx]
+      copy.brush_idx = tilt_out._guid_to_idx[stroke_guid]
+      tilt_out.sketch.strokes.append(copy)
+
+    tilt_out.write_sketch()
 
 
 def main():
@@ -24,7 +24,7 @@ import sys
 try:
   sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__))), 'Python'))
-  from tiltbrush.tilt import Tilt
+  from tiltbrush.tilt import Tilt, Sketch
 except ImportError:
   print >>sys.stderr, "Please put the 'Python' directory in your PYTHONPATH"
   sys.exit(1)
@@ -32,7 +32,7 @@ except ImportError:
 
 def dump_sketch(sketch):
   """Prints out some rough information about the strokes.
-  Pass a tiltbrush.tilt.Sketch instance."""
+  Pass a tiltbrush.tilt.Sketch or tiltbrush.tilt.SketchProbe instance."""
   cooky, version, unused = sketch.header[0:3]
   print 'Cooky:0x%08x  Version:%s  Unused:%s  Extra:(%d bytes)' % (
     cooky, version, unused, len(sketch.additional_header))
@@ -54,8 +54,11 @@ def dump_sketch(sketch):
 
 
 def dump_stroke(stroke):
-  """Prints out some information about the stroke."""
-  if len(stroke.controlpoints) and 'timestamp' in stroke.cp_ext_lookup:
+  """Prints out some information about the stroke.
+  Pass a tiltbrush.tilt.Stroke or tiltbrush.tilt.SketchProbe.StrokeHeader
+  instance; only a Stroke has the start time."""
+  if (hasattr(stroke, 'controlpoints') and stroke.num_controlpoints and
+      'timestamp' in stroke.cp_ext_lookup):
     cp = stroke.controlpoints[0]
     timestamp = stroke.cp_ext_lookup['timestamp']
     start_ts = ' t:%6.1f' % (cp.extension[timestamp] * .001)
@@ -83,13 +86,16 @@ def dump_stroke(stroke):
     #stroke.brush_color[3],
     group, seed,
     start_ts,
-    len(stroke.controlpoints))
+    stroke.num_controlpoints)
 
 
 def main():
   import argparse
   parser = argparse.ArgumentParser(description="View information about a .tilt")
   parser.add_argument('--strokes', action='store_true', help="Dump the sketch strokes")
+  parser.add_argument('--fast', action='store_true',
+                      help="With --strokes, read only the stroke headers. Faster, "
+                      "but the start time of each stroke isn't shown")
   parser.add_argument('--metadata', action='store_true', help="Dump the metadata")
   parser.add_argument('files', type=str, nargs='+', help="Files to examine")
 
@@ -98,11 +104,11 @@ def main():
     print "You should pass at least one of --strokes or --metadata"
 
   for filename in args.files:
-    t = Tilt(filename)
-    if args.strokes:
-      dump_sketch(t.sketch)
-    if args.metadata:
-      pprint.pprint(t.metadata)
+    with Tilt(filename, keep_open=args.strokes) as t:
+      if args.strokes:
+        dump_sketch(Sketch.probe(t) if args.fast else t.sketch)
+      if args.metadata:
+        pprint.pprint(t.metadata)
 
 if __name__ == '__main__':
   main()
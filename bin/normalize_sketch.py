@@ -27,6 +27,7 @@ import sys
 try:
   sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__))), 'Python'))
+  import tiltbrush.tilt
   from tiltbrush.tilt import Tilt
 except ImportError:
   print >>sys.stderr, "Please put the 'Python' directory in your PYTHONPATH"
@@ -55,6 +56,17 @@ def _transform_point(scene_translation, scene_rotation, scene_scale, pos):
   pos = [i+j for i,j in zip(scene_translation, pos)]
   return pos
 
+def _transform_strokes(scene_translation, scene_rotation, scene_scale, strokes):
+  """Like Sketch.apply_transform(), for when numpy isn't available. Much slower."""
+  for stroke in strokes:
+    if stroke.has_stroke_extension('scale'):
+      stroke.scale *= scene_scale
+    else:
+      stroke.scale = scene_scale
+    for cp in stroke.controlpoints:
+      cp.position = _transform_point(scene_translation, scene_rotation, scene_scale, cp.position)
+      cp.orientation = _quaternion_multiply_quaternion(scene_rotation, cp.orientation)
+
 def _adjust_guide(scene_translation, scene_rotation, scene_scale, guide):
   guide[u'Extents'] = [scene_scale * b for b in guide[u'Extents']]
   _adjust_transform(scene_translation, scene_rotation, scene_scale, guide[u'Transform'])
@@ -74,16 +86,11 @@ def normalize_tilt_file(tilt_file):
   scene_scale = tilt_file.metadata[u'SceneTransformInRoomSpace'][2]
 
   # Normalize strokes
-  for stroke in tilt_file.sketch.strokes:
-    if stroke.has_stroke_extension('scale'):
-      stroke.scale *= scene_scale
-    else:
-      stroke.scale = scene_scale
-    for cp in stroke.controlpoints:
-      pos = cp.position
-      pos = _transform_point(scene_translation, scene_rotation, scene_scale, pos)
-      cp.position = pos
-      cp.orientation = _quaternion_multiply_quaternion(scene_rotation, cp.orientation)
+  if tiltbrush.tilt.numpy is not None:
+    tilt_file.sketch.apply_transform(scene_translation, scene_rotation, scene_scale)
+  else:
+    _transform_strokes(scene_translation, scene_rotation, scene_scale,
+                       tilt_file.sketch.strokes)
 
   with tilt_file.mutable_metadata() as metadata:
     # Reset scene transform to be identity.
@@ -136,11 +143,16 @@ def main():
     name, ext = os.path.splitext(filename)
     filename_normalized = name + 'Normalized' + ext
     shutil.copy(filename, filename_normalized)
-    tilt_file = Tilt(filename_normalized)
-
-    normalize_tilt_file(tilt_file)
-
-    tilt_file.write_sketch()
+    try:
+      with Tilt(filename_normalized, keep_open=True) as tilt_file:
+        # Rewrite the .tilt once, with both the sketch and the metadata
+        with tilt_file.transaction():
+          normalize_tilt_file(tilt_file)
+          tilt_file.write_sketch()
+    except:
+      # Don't leave a copy that isn't normalized
+      os.unlink(filename_normalized)
+      raise
     print 'WARNING: Environment position has changed in ' + filename + '.'
 
 if __name__ == '__main__':
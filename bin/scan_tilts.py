@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summarizes every .tilt file in a directory tree, using multiple
+processes. Uses the tiltbrush.library module."""
+
+import json
+import os
+import sys
+
+try:
+  sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'Python'))
+  import tiltbrush.library
+except ImportError:
+  print >>sys.stderr, "Please put the 'Python' directory in your PYTHONPATH"
+  sys.exit(1)
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description="Summarize the .tilt files in a directory tree")
+  parser.add_argument('root', type=str, help="Directory to scan")
+  parser.add_argument('--workers', type=int, default=None,
+                      help="Number of processes (default: one per CPU)")
+  parser.add_argument('--cache', type=str, default=None,
+                      help="Cache summaries in this file, and reuse them for unchanged .tilts")
+  parser.add_argument('--json', action='store_true',
+                      help="Print each summary as a line of json")
+  args = parser.parse_args()
+
+  num_errors = 0
+  for summary in tiltbrush.library.scan(args.root, args.workers, args.cache):
+    if summary['error'] is not None:
+      num_errors += 1
+    if args.json:
+      print json.dumps(summary, sort_keys=True)
+    elif summary['error'] is not None:
+      print "%s  ERROR: %s" % (summary['filename'], summary['error'])
+    else:
+      print "%s  strokes:%d  brushes:%d" % (
+        summary['filename'], summary['num_strokes'], len(summary['brush_counts']))
+  if num_errors:
+    print >>sys.stderr, "%d file(s) could not be read" % num_errors
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Removes redundant control points from .tilt files, using multiple
+processes. Uses the tiltbrush.simplify module."""
+
+import os
+import shutil
+import sys
+
+try:
+  sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'Python'))
+  import tiltbrush.library
+  import tiltbrush.simplify
+except ImportError:
+  print >>sys.stderr, "Please put the 'Python' directory in your PYTHONPATH"
+  print >>sys.stderr, "tiltbrush.simplify also requires numpy"
+  sys.exit(1)
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description=
+    "Simplify strokes, keeping them within a tolerance of their original paths.\
+    Writes copies with 'Simplified' appended to the file name, unless --in-place.")
+  parser.add_argument('files', type=str, nargs='+',
+                      help="Sketches to simplify, or directories to search for them")
+  parser.add_argument('--tolerance', type=float, default=0.01,
+                      help="Maximum distance from the original path (default: %(default)s)")
+  parser.add_argument('--angle', type=float, default=5,
+                      help="Maximum change in orientation, in degrees (default: %(default)s)")
+  parser.add_argument('--pressure', type=float, default=None,
+                      help="Maximum change in pressure (default: not limited)")
+  parser.add_argument('--workers', type=int, default=None,
+                      help="Number of processes (default: one per CPU)")
+  parser.add_argument('--in-place', action='store_true', help="Overwrite the sketches")
+  args = parser.parse_args()
+
+  filenames = []
+  for name in args.files:
+    if os.path.isdir(name) and not name.endswith('.tilt'):
+      filenames.extend(tiltbrush.library.find_tilts(name))
+    else:
+      filenames.append(name)
+  if not args.in_place:
+    copies = []
+    for filename in filenames:
+      name, ext = os.path.splitext(filename)
+      copies.append(name + 'Simplified' + ext)
+      if os.path.isdir(filename):
+        shutil.copytree(filename, copies[-1])
+      else:
+        shutil.copy(filename, copies[-1])
+    filenames = copies
+
+  reductions = []
+  for (filename, reduction) in tiltbrush.simplify.simplify_files(
+      filenames, args.tolerance, args.angle, args.pressure, args.workers):
+    print "%s  %s" % (filename, reduction)
+    reductions.append(reduction)
+  if len(reductions) > 1:
+    print "Total  %s" % tiltbrush.simplify.Reduction.total(reductions)
+
+
+if __name__ == '__main__':
+  main()
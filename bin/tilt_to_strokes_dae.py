@@ -222,12 +222,12 @@ def main(args):
   args = parser.parse_args(args)
 
   for filename in args.files:
-    t = Tilt(filename)
     outf_name = os.path.splitext(os.path.basename(filename))[0] + '.dae'
 
     dae = ColladaFile()
-    for stroke in t.sketch.strokes:
-      dae.add_stroke(stroke)
+    with Tilt(filename) as t:
+      for stroke in t.sketch.strokes:
+        dae.add_stroke(stroke)
 
     dae.write(outf_name)
     print 'Wrote', outf_name
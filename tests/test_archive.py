@@ -0,0 +1,111 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from cStringIO import StringIO
+
+import tiltbrush.library
+from tiltbrush.tilt import Tilt, Sketch, _make_cp_ext_reader
+
+try:
+  import numpy
+  import tiltbrush.archive as archive
+except ImportError:
+  numpy = None
+
+from test_tilt import copy_of_tilt
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestArchive(unittest.TestCase):
+  def check_close(self, original, restored):
+    self.assertEqual(original.header, restored.header)
+    self.assertEqual(original.additional_header, restored.additional_header)
+    self.assertEqual(len(original.strokes), len(restored.strokes))
+    for (a, b) in zip(original.strokes, restored.strokes):
+      for attr in ('brush_idx', 'brush_color', 'brush_size', 'stroke_mask', 'cp_mask',
+                   'extension'):
+        self.assertEqual(getattr(a, attr), getattr(b, attr))
+      (ra, rb) = (a.controlpoint_array(), b.controlpoint_array())
+      self.assertEqual(len(ra), len(rb))
+      if len(ra) == 0:
+        continue
+      self.assertLessEqual(abs(ra['position'] - rb['position']).max(),
+                           archive.POSITION_STEP / 2 + 1e-5)
+      qa = ra['orientation'] / numpy.linalg.norm(ra['orientation'], axis=1)[:, None]
+      cos = numpy.clip(abs((qa * rb['orientation']).sum(1)), 0, 1)
+      self.assertLessEqual(numpy.degrees(2 * numpy.arccos(cos)).max(), archive.MAX_ANGLE_ERROR)
+      if 'pressure' in ra.dtype.names:
+        self.assertLessEqual(abs(ra['pressure'] - rb['pressure']).max(), 0.5 / 65535 + 1e-7)
+      if 'timestamp' in ra.dtype.names:
+        self.assertEqual(ra['timestamp'].tolist(), rb['timestamp'].tolist())
+
+  def test_round_trip(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      # Add an empty stroke, and one without pressure
+      empty = sketch.strokes[1].clone()
+      empty.set_controlpoint_array(empty.controlpoint_array()[:0])
+      no_pressure = sketch.strokes[2].clone()
+      records = no_pressure.controlpoint_array()
+      no_pressure.cp_mask &= ~0x1
+      (_, no_pressure.cp_ext_writer, no_pressure.cp_ext_lookup) = \
+          _make_cp_ext_reader(no_pressure.cp_mask)
+      no_pressure.set_controlpoint_array(records[['position', 'orientation', 'timestamp']])
+      sketch.strokes[2:2] = [empty, no_pressure]
+
+      archived = StringIO()
+      sketch.write(archived, archival=True)
+      standard = StringIO()
+      sketch.write(standard)
+      self.assertLess(len(archived.getvalue()), len(standard.getvalue()) / 3)
+      restored = Sketch(StringIO(archived.getvalue()))
+      self.check_close(sketch, restored)
+      self.check_close(sketch, Sketch(StringIO(archived.getvalue()), layout='columnar'))
+
+  def test_empty_strokes(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      for stroke in sketch.strokes:
+        stroke.set_controlpoint_array(stroke.controlpoint_array()[:0])
+      for strokes in (sketch.strokes, []):
+        sketch.strokes = strokes
+        archived = StringIO()
+        sketch.write(archived, archival=True)
+        self.check_close(sketch, Sketch(StringIO(archived.getvalue())))
+
+  def test_tilt(self):
+    with copy_of_tilt() as tilt:
+      original = Tilt(tilt.filename).sketch
+      (old_size, new_size) = archive.archive_tilt(tilt.filename)
+      self.assertLess(new_size, old_size)
+      self.check_close(original, Tilt(tilt.filename).sketch)
+      # Other readers decode it too
+      with Tilt(tilt.filename) as archived:
+        probe = Sketch.probe(archived, bounds=True)
+        self.assertEqual([s.num_cp for s in probe.strokes],
+                         [s.num_controlpoints for s in original.strokes])
+        self.assertEqual(len(list(archived.iter_strokes())), len(original.strokes))
+        self.assertEqual(archived.read_stroke(-1).fingerprint(),
+                         archived.sketch.strokes[-1].fingerprint())
+      summary = tiltbrush.library.summarize(tilt.filename)
+      self.assertIsNone(summary['error'])
+      self.assertEqual(summary['num_strokes'], len(original.strokes))
+      archive.restore_tilt(tilt.filename)
+      self.assertEqual(len(Sketch.probe(Tilt(tilt.filename)).strokes), len(original.strokes))
+      self.check_close(original, Tilt(tilt.filename).sketch)
+
+
+if __name__ == '__main__':
+  unittest.main()
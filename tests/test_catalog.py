@@ -0,0 +1,84 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import unittest
+
+import tiltbrush.library
+from tiltbrush.catalog import Catalog
+from tiltbrush.tilt import Tilt
+
+from test_library import sketch_library
+
+NEW_ENVIRONMENT = 'e2e7d7b1-3d9c-4d6e-9a34-0b5b53c1b8a1'
+
+
+class TestCatalog(unittest.TestCase):
+  def test_queries(self):
+    with sketch_library() as root:
+      with Catalog(os.path.join(root, 'index.db')) as catalog:
+        self.assertEqual(catalog.update(root, workers=1), (4, 0))
+        good = [os.path.join(root, f) for f in ('a.tilt', 'sub/b.tilt', 'sub/c.tilt')]
+        self.assertEqual(catalog.filenames(), sorted(good + [os.path.join(root, 'bad.tilt')]))
+        self.assertEqual(catalog.errors().keys(), [os.path.join(root, 'bad.tilt')])
+
+        tilt = Tilt(good[0])
+        summary = tiltbrush.library.summarize(good[0])
+        self.assertEqual(catalog.summary(good[0]), summary)
+        for guid in summary['brush_counts']:
+          self.assertEqual(catalog.with_brush(guid), good)
+          self.assertEqual(catalog.with_brush(guid.upper()), good)
+        self.assertEqual(catalog.with_brush('no such brush'), [])
+        self.assertEqual(catalog.with_environment(tilt.metadata['EnvironmentPreset'].upper()),
+                         good)
+        self.assertEqual(catalog.with_environment(tilt.metadata['EnvironmentPreset']), good)
+        self.assertEqual(catalog.brush_usage(),
+                         dict((guid, (3, 3 * count))
+                              for (guid, count) in summary['brush_counts'].items()))
+
+  def test_incremental_update(self):
+    with sketch_library() as root:
+      db_filename = os.path.join(root, 'index.db')
+      with Catalog(db_filename) as catalog:
+        catalog.update(root, workers=1)
+      with Tilt(os.path.join(root, 'a.tilt')).mutable_metadata() as dct:
+        dct['EnvironmentPreset'] = NEW_ENVIRONMENT
+      shutil.rmtree(os.path.join(root, 'sub', 'c.tilt'))
+      with Catalog(db_filename) as catalog:
+        self.assertEqual(catalog.update(root, workers=1), (1, 1))
+        self.assertEqual(catalog.with_environment(NEW_ENVIRONMENT),
+                         [os.path.join(root, 'a.tilt')])
+        self.assertEqual(len(catalog.filenames()), 3)
+        self.assertEqual(catalog.update(root, workers=1), (0, 0))
+
+  def test_guid_case(self):
+    with sketch_library() as root:
+      filename = os.path.join(root, 'a.tilt')
+      tilt = Tilt(filename)
+      brush_index = tilt.metadata['BrushIndex']
+      guid = tiltbrush.library.summarize(filename)['brush_counts'].keys()[0]
+      with tilt.mutable_metadata() as dct:
+        dct['EnvironmentPreset'] = NEW_ENVIRONMENT.upper()
+        dct['BrushIndex'] = [g.upper() if g == guid else g for g in brush_index]
+      with Catalog(os.path.join(root, 'index.db')) as catalog:
+        catalog.update(root, workers=1)
+        self.assertEqual(catalog.with_environment(NEW_ENVIRONMENT), [filename])
+        self.assertEqual(len(catalog.with_brush(guid.lower())), 3)
+        self.assertEqual(len(catalog.with_brush(guid.upper())), 3)
+        self.assertEqual(catalog.brush_usage()[guid.lower()][0], 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import tiltbrush.library
+import tiltbrush.unpack
+from tiltbrush.tilt import Tilt
+
+
+@contextlib.contextmanager
+def sketch_library():
+  """Yields a temporary directory with a few .tilts in it, one of them bad."""
+  base = os.path.abspath(os.path.dirname(__file__))
+  sketch1 = os.path.join(base, 'data/sketch1.tilt')
+  root = tempfile.mkdtemp()
+  try:
+    os.makedirs(os.path.join(root, 'sub'))
+    shutil.copy(sketch1, os.path.join(root, 'a.tilt'))
+    shutil.copy(sketch1, os.path.join(root, 'sub', 'b.tilt'))
+    shutil.copy(sketch1, os.path.join(root, 'sub', 'c.tilt'))
+    tiltbrush.unpack.convert_zip_to_dir(os.path.join(root, 'sub', 'c.tilt'))
+    with file(os.path.join(root, 'bad.tilt'), 'wb') as outf:
+      outf.write('not a tilt')
+    yield root
+  finally:
+    shutil.rmtree(root)
+
+
+class TestScan(unittest.TestCase):
+  def test_find_tilts(self):
+    with sketch_library() as root:
+      self.assertEqual(tiltbrush.library.find_tilts(root),
+                       [os.path.join(root, f) for f in
+                        ('a.tilt', 'bad.tilt', 'sub/b.tilt', 'sub/c.tilt')])
+
+  def test_summarize(self):
+    with sketch_library() as root:
+      summary = tiltbrush.library.summarize(os.path.join(root, 'a.tilt'))
+      tilt = Tilt(os.path.join(root, 'a.tilt'))
+      self.assertIsNone(summary['error'])
+      self.assertEqual(summary['metadata'], tilt.metadata)
+      self.assertEqual(summary['num_strokes'], len(tilt.sketch.strokes))
+      self.assertEqual(sum(summary['brush_counts'].values()), summary['num_strokes'])
+      positions = [cp.position for s in tilt.sketch.strokes for cp in s.controlpoints]
+      self.assertEqual(summary['bounds'], [map(min, *positions), map(max, *positions)])
+
+  def test_scan_in_parallel(self):
+    with sketch_library() as root:
+      serial = list(tiltbrush.library.scan(root, workers=1))
+      parallel = list(tiltbrush.library.scan(root, workers=3))
+      self.assertEqual(serial, parallel)
+      self.assertEqual([s['filename'] for s in parallel], tiltbrush.library.find_tilts(root))
+      self.assertEqual([s['error'] is None for s in parallel], [True, False, True, True])
+      self.assertEqual(parallel[3]['bounds'], parallel[0]['bounds'])
+
+  def test_cache(self):
+    summarized = []
+    real_summarize = tiltbrush.library.summarize
+    def counting_summarize(filename):
+      summarized.append(os.path.basename(filename))
+      return real_summarize(filename)
+    tiltbrush.library.summarize = counting_summarize
+    try:
+      with sketch_library() as root:
+        cache_filename = os.path.join(root, 'cache.json')
+        first = list(tiltbrush.library.scan(root, 1, cache_filename))
+        self.assertEqual(len(summarized), 4)
+        del summarized[:]
+        with Tilt(os.path.join(root, 'a.tilt')).mutable_metadata() as dct:
+          dct['Authors'] = ['someone']
+        second = list(tiltbrush.library.scan(root, 1, cache_filename))
+        self.assertEqual(summarized, ['a.tilt'])
+        self.assertEqual(second[0]['metadata']['Authors'], ['someone'])
+        self.assertEqual(second[1:], first[1:])
+    finally:
+      tiltbrush.library.summarize = real_summarize
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,95 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+from tiltbrush.tilt import Tilt
+
+try:
+  import numpy
+  from tiltbrush.simplify import Reduction, simplify_points, simplify_sketch, simplify_files
+except ImportError:
+  numpy = None
+
+from test_library import sketch_library
+from test_tilt import copy_of_tilt
+
+
+def segment_distance(p, a, b):
+  ab = b - a
+  t = numpy.clip(numpy.dot(p - a, ab) / max(numpy.dot(ab, ab), 1e-30), 0, 1)
+  return numpy.linalg.norm(a + t * ab - p)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestSimplify(unittest.TestCase):
+  TOLERANCE = 0.05
+
+  def test_straight_line(self):
+    positions = numpy.zeros((50, 3))
+    positions[:, 0] = numpy.linspace(0, 1, 50)
+    positions[10, 1] = 0.5   # A spike, which must stay, along with its neighbours
+    orientations = numpy.tile([0, 0, 0, 1.0], (50, 1))
+    keep = simplify_points(positions, orientations, [0, 30, 30, 50], self.TOLERANCE)
+    self.assertEqual(numpy.flatnonzero(keep).tolist(), [0, 9, 10, 11, 29, 30, 49])
+
+  def test_orientation_tolerance(self):
+    positions = numpy.zeros((3, 3))
+    positions[:, 0] = [0, 1, 2]
+    angle = numpy.radians(20)
+    orientations = numpy.array([[0, 0, 0, 1], [0, 0, numpy.sin(angle / 2), numpy.cos(angle / 2)],
+                                [0, 0, 0, 1]])
+    self.assertEqual(simplify_points(positions, orientations, [0, 3], 1).tolist(),
+                     [True, True, True])
+    self.assertEqual(simplify_points(positions, orientations, [0, 3], 1, None).tolist(),
+                     [True, False, True])
+
+  def test_sketch_within_tolerance(self):
+    with copy_of_tilt() as tilt:
+      before = [s.controlpoint_array() for s in Tilt(tilt.filename).sketch.strokes]
+      reduction = simplify_sketch(tilt.sketch, self.TOLERANCE, workers=2)
+      after = [s.controlpoint_array() for s in tilt.sketch.strokes]
+      self.assertEqual(reduction.points_before, sum(map(len, before)))
+      self.assertEqual(reduction.points_after, sum(map(len, after)))
+      self.assertLess(reduction.points_after, reduction.points_before * 0.6)
+      itemsize = before[0].itemsize
+      self.assertEqual(reduction.bytes_before - reduction.bytes_after,
+                       itemsize * (reduction.points_before - reduction.points_after))
+
+      for (old, new) in zip(before, after):
+        # The kept control points are unchanged, in order, extensions and all
+        kept = numpy.searchsorted(old['timestamp'], new['timestamp'])
+        self.assertEqual(old[kept].tostring(), new.tostring())
+        self.assertEqual(kept[[0, -1]].tolist(), [0, len(old) - 1])
+        for (i, p) in enumerate(old['position']):
+          j = min(numpy.searchsorted(kept, i), len(kept) - 1)
+          a, b = old['position'][kept[max(j - 1, 0)]], old['position'][kept[j]]
+          self.assertLessEqual(segment_distance(p, a, b), self.TOLERANCE * 1.0001)
+
+  def test_files_in_parallel(self):
+    with sketch_library() as root:
+      filenames = [os.path.join(root, f) for f in ('a.tilt', 'sub/b.tilt', 'sub/c.tilt')]
+      results = list(simplify_files(filenames, self.TOLERANCE, workers=2))
+      self.assertEqual([f for (f, _) in results], filenames)
+      self.assertEqual(len(set(r for (_, r) in results)), 1)
+      total = Reduction.total(r for (_, r) in results)
+      self.assertEqual(total.num_strokes, 15)
+      for filename in filenames:
+        strokes = Tilt(filename).sketch.strokes
+        self.assertEqual(sum(len(s.controlpoints) for s in strokes), results[0][1].points_after)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,113 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import random
+import unittest
+
+from tiltbrush.tilt import Tilt, STROKE_INDEX_SUFFIX
+
+try:
+  import numpy
+  from tiltbrush.spatial import SpatialIndex, SPATIAL_INDEX_SUFFIX
+except ImportError:
+  numpy = None
+
+from test_tilt import copy_of_tilt
+
+
+def surface_distance(stroke, point):
+  """Distance from point to stroke, done the slow way."""
+  positions = [cp.position for cp in stroke.controlpoints]
+  def distance(a, b):
+    ab = [y - x for (x, y) in zip(a, b)]
+    length2 = sum(c * c for c in ab)
+    t = sum((p - x) * c for (p, x, c) in zip(point, a, ab)) / length2 if length2 else 0
+    t = min(max(t, 0), 1)
+    return math.sqrt(sum((x + t * c - p) ** 2 for (x, c, p) in zip(a, ab, point)))
+  d = min(distance(a, b) for (a, b) in zip(positions, positions[1:] or positions))
+  scale = stroke.scale if stroke.has_stroke_extension('scale') else 1
+  return max(d - stroke.brush_size * scale / 2, 0)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestSpatialIndex(unittest.TestCase):
+  def setUp(self):
+    # Scattered copies of the strokes in sketch1
+    rng = random.Random(1)
+    with copy_of_tilt() as tilt:
+      self.sketch = tilt.sketch
+    strokes = []
+    for i in xrange(12):
+      for stroke in self.sketch.strokes:
+        stroke = stroke.clone()
+        offset = [c + rng.uniform(-5, 5) for c in (-14, -5, 3)]   # Roughly centered
+        self.sketch.apply_transform(offset, strokes=[stroke])
+        strokes.append(stroke)
+    self.sketch.strokes = strokes
+    self.index = SpatialIndex.build(self.sketch)
+
+  def test_in_box(self):
+    (lo, hi) = ([-1, -2, -1], [2, 1, 3])
+    found = self.index.in_box(lo, hi)
+    for (i, stroke) in enumerate(self.sketch.strokes):
+      inside = any(all(l <= c <= h for (l, c, h) in zip(lo, cp.position, hi))
+                   for cp in stroke.controlpoints)
+      if inside:
+        self.assertIn(i, found)
+    self.assertEqual(self.index.in_box([100] * 3, [101] * 3), [])
+
+  def test_in_sphere(self):
+    for (center, radius) in [([0, 0, 0], 1.5), ([3, -1, 2], 0.7), ([20, 20, 20], 1)]:
+      expected = [i for (i, stroke) in enumerate(self.sketch.strokes)
+                  if surface_distance(stroke, center) <= radius]
+      self.assertEqual(self.index.in_sphere(center, radius), expected)
+
+  def test_nearest(self):
+    point = [1, 2, -1]
+    distances = sorted((surface_distance(stroke, point), i)
+                       for (i, stroke) in enumerate(self.sketch.strokes))
+    self.assertEqual(self.index.nearest(point, 5), [i for (d, i) in distances[:5]])
+    self.assertEqual(len(self.index.nearest(point, 1000)), len(self.sketch.strokes))
+
+  def test_on_ray(self):
+    target = self.sketch.strokes[7].controlpoints[10].position
+    origin = [target[0], target[1], target[2] - 100]
+    found = self.index.on_ray(origin, [0, 0, 1])
+    self.assertIn(7, found)
+    self.assertNotIn(7, self.index.on_ray(origin, [0, 0, -1]))
+    self.assertNotIn(7, self.index.on_ray(origin, [0, 0, 1], max_distance=50))
+
+  def test_cached_next_to_tilt(self):
+    with copy_of_tilt() as tilt:
+      index_filename = tilt.filename + SPATIAL_INDEX_SUFFIX
+      try:
+        index = SpatialIndex.for_tilt(tilt)
+        self.assertTrue(os.path.exists(index_filename))
+        # Only the spatial index is written
+        self.assertFalse(os.path.exists(tilt.filename + STROKE_INDEX_SUFFIX))
+        loaded = SpatialIndex.load(index_filename)
+        self.assertEqual(loaded.key, index.key)
+        self.assertEqual(loaded.in_sphere([0, 0, 0], 5), index.in_sphere([0, 0, 0], 5))
+        del tilt.sketch.strokes[0]
+        tilt.write_sketch()
+        self.assertEqual(SpatialIndex.for_tilt(Tilt(tilt.filename)).num_strokes, 4)
+      finally:
+        if os.path.exists(index_filename):
+          os.unlink(index_filename)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -13,11 +13,19 @@
 # limitations under the License.
 
 import contextlib
+import json
 import os
 import shutil
 import unittest
+from cStringIO import StringIO
 
-from tiltbrush.tilt import Tilt
+import tiltbrush.tilt
+from tiltbrush.tilt import Tilt, Sketch, StrokeIndex, ControlPoint, STROKE_INDEX_SUFFIX
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 
 @contextlib.contextmanager
@@ -33,8 +41,9 @@ def copy_of_tilt(tilt_file='data/sketch1.tilt', as_filename=False):
     else:
       yield Tilt(tmp_filename)
   finally:
-    if os.path.exists(tmp_filename):
-      os.unlink(tmp_filename)
+    for filename in (tmp_filename, tmp_filename + STROKE_INDEX_SUFFIX):
+      if os.path.exists(filename):
+        os.unlink(filename)
 
 
 def as_float32(f):
@@ -50,6 +59,136 @@ class TestTiltMutations(unittest.TestCase):
         self.assertTrue(os.path.isdir(tilt_filename))
         self.assertTrue(os.path.exists(os.path.join(tilt_filename, 'metadata.json')))
 
+  def test_writes_stay_packed(self):
+    import zipfile
+    import tiltbrush.unpack
+    for compress in (False, True):
+      with copy_of_tilt() as tilt:
+        tiltbrush.unpack.convert_zip_to_dir(tilt.filename)
+        tiltbrush.unpack.convert_dir_to_zip(tilt.filename, compress)
+        with file(tilt.filename, 'rb') as inf:
+          header = inf.read(16)
+        before = zipfile.ZipFile(tilt.filename).infolist()
+        with tilt.mutable_metadata() as dct:
+          dct['EnvironmentPreset'] = '00000000-0000-0000-0000-000000000000'
+        self.assertTrue(os.path.isfile(tilt.filename))
+        with file(tilt.filename, 'rb') as inf:
+          self.assertEqual(inf.read(16), header)
+        after = zipfile.ZipFile(tilt.filename).infolist()
+        self.assertEqual([m.filename for m in before], [m.filename for m in after])
+        for (old, new) in zip(before, after):
+          if old.filename != 'metadata.json':
+            self.assertEqual((old.CRC, old.compress_size, old.compress_type),
+                             (new.CRC, new.compress_size, new.compress_type))
+        self.assertEqual(zipfile.ZipFile(tilt.filename).testzip(), None)
+        self.assertEqual(len(Tilt(tilt.filename).sketch.strokes), 5)
+
+  def test_transaction_rewrites_once(self):
+    import tiltbrush.unpack
+    real_replace = tiltbrush.unpack.replace_zip_members
+    calls = []
+    def counting_replace(in_name, replacements, *args):
+      calls.append(sorted(replacements))
+      return real_replace(in_name, replacements, *args)
+    tiltbrush.unpack.replace_zip_members = counting_replace
+    try:
+      with copy_of_tilt() as tilt:
+        with tilt.transaction():
+          with tilt.mutable_metadata() as dct:
+            dct['Authors'] = ['someone']
+          del tilt.sketch.strokes[0]
+          tilt.write_sketch()
+          # Reads see the staged data
+          self.assertEqual(len(Sketch(tilt).strokes), 4)
+          self.assertEqual(len(Tilt(tilt.filename).sketch.strokes), 5)
+        self.assertEqual(calls, [['data.sketch', 'metadata.json']])
+        tilt2 = Tilt(tilt.filename)
+        self.assertEqual(tilt2.metadata['Authors'], ['someone'])
+        self.assertEqual(len(tilt2.sketch.strokes), 4)
+    finally:
+      tiltbrush.unpack.replace_zip_members = real_replace
+
+  def test_failed_transaction_writes_nothing(self):
+    with copy_of_tilt() as tilt:
+      try:
+        with tilt.transaction():
+          del tilt.sketch.strokes[0]
+          tilt.write_sketch()
+          raise ValueError
+      except ValueError:
+        pass
+      self.assertEqual(len(Tilt(tilt.filename).sketch.strokes), 5)
+      self.assertEqual(sorted(os.listdir(os.path.dirname(tilt.filename))),
+                       ['sketch1.tilt', os.path.basename(tilt.filename)])
+
+  def test_save(self):
+    with copy_of_tilt() as tilt:
+      tilt.metadata['Authors'] = ['someone']
+      tilt.sketch.strokes[0].brush_size = 0.5
+      tilt.save()
+      tilt2 = Tilt(tilt.filename)
+      self.assertEqual(tilt2.metadata['Authors'], ['someone'])
+      self.assertEqual(tilt2.sketch.strokes[0].brush_size, 0.5)
+
+  def test_zip_is_opened_once(self):
+    import zipfile
+    import tiltbrush.tilt
+    real_parse = zipfile.ZipFile._RealGetContents
+    opened, parsed = [], []
+    def counting_file(*args):
+      opened.append(args[0])
+      return file(*args)
+    def counting_parse(self):
+      parsed.append(self)
+      return real_parse(self)
+    tiltbrush.tilt.file = counting_file
+    zipfile.ZipFile._RealGetContents = counting_parse
+    try:
+      with copy_of_tilt(as_filename=True) as tilt_filename:
+        with Tilt(tilt_filename, keep_open=True) as tilt:
+          self.assertEqual(len(tilt.sketch.strokes), 5)
+          with tilt.subfile_reader('thumbnail.png') as inf:
+            with tilt.subfile_reader('metadata.json') as inf2:
+              self.assertEqual(inf.read(4), '\x89PNG')
+              self.assertEqual(inf2.read(1), '{')
+        self.assertEqual(len(parsed), 1)
+        # The nested reader needs a second handle
+        self.assertEqual(opened, [tilt_filename] * 2)
+        self.assertIsNone(tilt._zip)
+    finally:
+      del tiltbrush.tilt.file
+      zipfile.ZipFile._RealGetContents = real_parse
+
+  def test_reopens_replaced_file(self):
+    with copy_of_tilt(as_filename=True) as tilt_filename:
+      with Tilt(tilt_filename) as tilt:
+        self.assertIsNone(tilt._zip)
+        self.assertEqual(len(tilt.sketch.strokes), 5)
+        self.assertIsNotNone(tilt._zip)
+        with Tilt(tilt_filename) as tilt2:
+          with tilt2.mutable_metadata() as dct:
+            dct['Authors'] = ['someone']
+        with tilt.subfile_reader('metadata.json') as inf:
+          self.assertEqual(json.load(inf)['Authors'], ['someone'])
+
+  def test_closes_on_bad_metadata(self):
+    import zipfile
+    with copy_of_tilt(as_filename=True) as tilt_filename:
+      with zipfile.ZipFile(tilt_filename, 'w') as outzip:
+        outzip.writestr('metadata.json', 'not json')
+      opened = []
+      def recording_file(*args):
+        opened.append(file(*args))
+        return opened[-1]
+      tiltbrush.tilt.file = recording_file
+      try:
+        for keep_open in (False, True):
+          self.assertRaises(ValueError, Tilt, tilt_filename, keep_open=keep_open)
+      finally:
+        del tiltbrush.tilt.file
+      self.assertEqual(len(opened), 2)
+      self.assertTrue(all(inf.closed for inf in opened))
+
   def test_can_mutate_metadata(self):
     import uuid
     random_guid = str(uuid.uuid4())
@@ -103,5 +242,770 @@ class TestTiltMutations(unittest.TestCase):
       self.assertRaises(AttributeError (lambda: stroke2.flags))
 
 
+class TestRawPassthrough(unittest.TestCase):
+  def test_untouched_strokes_are_not_decoded(self):
+    with copy_of_tilt() as tilt:
+      strokes = tilt.sketch.strokes
+      strokes[1].brush_color = (1, 0, 0, 1)
+      strokes[2].controlpoints[0].position[0] += 1
+      self.assertEqual(strokes[3].num_controlpoints, tilt.stroke_index[3].num_cp)
+      tilt.write_sketch()
+      self.assertEqual([('controlpoints' in s.__dict__) for s in strokes],
+                       [False, False, True, False, False])
+      expected = Tilt(tilt.filename).sketch
+      self.assertEqual(expected.strokes[1].brush_color, (1, 0, 0, 1))
+      for (stroke, written) in zip(strokes, expected.strokes):
+        self.assertEqual([cp.position for cp in stroke.controlpoints],
+                         [cp.position for cp in written.controlpoints])
+        self.assertEqual([cp.extension for cp in stroke.controlpoints],
+                         [cp.extension for cp in written.controlpoints])
+
+  def test_clone_shares_raw_data(self):
+    with copy_of_tilt() as tilt:
+      stroke = tilt.sketch.strokes[0]
+      clone = stroke.clone()
+      self.assertIs(clone._controlpoints, stroke._controlpoints)
+      self.assertNotIn('controlpoints', stroke.__dict__)
+      fingerprint = stroke.fingerprint()
+      self.assertEqual(clone.fingerprint(), fingerprint)
+      clone.controlpoints[0].position[0] += 1
+      clone.extension[0] = 7
+      self.assertNotIn('controlpoints', stroke.__dict__)
+      self.assertEqual(stroke.fingerprint(), fingerprint)
+      self.assertNotEqual(stroke.controlpoints[0].position, clone.controlpoints[0].position)
+      # Decoded strokes are copied
+      clone2 = stroke.clone()
+      clone2.controlpoints[0].position[0] += 1
+      self.assertEqual(stroke.fingerprint(), fingerprint)
+
+
+class TestMappedReading(unittest.TestCase):
+  def test_stored_member_is_mapped(self):
+    with copy_of_tilt() as tilt:
+      data = tilt.subfile_buffer('data.sketch')
+      self.assertIsInstance(data, buffer)
+      with tilt.subfile_reader('data.sketch') as inf:
+        self.assertEqual(str(data), inf.read())
+
+  def test_compressed_member_is_not_mapped(self):
+    import tiltbrush.unpack
+    with copy_of_tilt(as_filename=True) as tilt_filename:
+      tiltbrush.unpack.convert_zip_to_dir(tilt_filename)
+      tiltbrush.unpack.convert_dir_to_zip(tilt_filename, True)
+      tilt = Tilt(tilt_filename)
+      self.assertIsNone(tilt.subfile_buffer('data.sketch'))
+      self.assertEqual(len(tilt.sketch.strokes), 5)
+
+  def test_mapped_sketch_survives_rewrite(self):
+    with copy_of_tilt(as_filename=True) as tilt_filename:
+      with Tilt.as_directory(tilt_filename) as tilt:
+        position = tilt.sketch.strokes[0].controlpoints[0].position
+        sketch = Sketch(tilt)
+        del tilt.sketch.strokes[0]
+        tilt.write_sketch()
+        # Not yet decoded, and its data was overwritten on disk
+        self.assertEqual(sketch.strokes[0].controlpoints[0].position, position)
+        self.assertEqual(len(Tilt(tilt_filename).sketch.strokes), 4)
+
+  def test_write_to_the_mapped_file(self):
+    import tempfile
+    with copy_of_tilt() as tilt:
+      expected = [[cp.position for cp in s.controlpoints] for s in tilt.sketch.strokes]
+      (fd, filename) = tempfile.mkstemp(suffix='.sketch')
+      os.close(fd)
+      try:
+        tilt.sketch.write(filename)
+        sketch = Sketch(filename)
+        del sketch.strokes[0]
+        sketch.write(filename)
+        self.assertEqual([[cp.position for cp in s.controlpoints] for s in sketch.strokes],
+                         expected[1:])
+        sketch = Sketch(filename)
+        Sketch.write_iter(filename, sketch.strokes[1:], sketch.header)
+        self.assertEqual([[cp.position for cp in s.controlpoints] for s in sketch.strokes],
+                         expected[1:])
+        self.assertEqual([[cp.position for cp in s.controlpoints]
+                          for s in Sketch(filename).strokes], expected[2:])
+      finally:
+        os.unlink(filename)
+
+
+class TestSketchStream(unittest.TestCase):
+  def test_iter_matches_sketch(self):
+    with copy_of_tilt() as tilt:
+      with tilt.iter_strokes() as stream:
+        self.assertEqual(stream.header, tilt.sketch.header)
+        self.assertEqual(stream.num_strokes, len(tilt.sketch.strokes))
+        strokes = list(stream)
+      self.assertEqual(len(strokes), len(tilt.sketch.strokes))
+      for (stroke, expected) in zip(strokes, tilt.sketch.strokes):
+        self.assertEqual(stroke.brush_idx, expected.brush_idx)
+        self.assertEqual([cp.position for cp in stroke.controlpoints],
+                         [cp.position for cp in expected.controlpoints])
+
+  def test_write_iter(self):
+    with copy_of_tilt() as tilt:
+      expected = [s for s in tilt.sketch.strokes if s.brush_idx != 0]
+      self.assertNotEqual(len(expected), len(tilt.sketch.strokes))
+      stream = tilt.iter_strokes()
+      num_written = Sketch.write_iter(
+        tilt, (s for s in stream if s.brush_idx != 0),
+        stream.header, stream.additional_header)
+      self.assertEqual(num_written, len(expected))
+      strokes = Tilt(tilt.filename).sketch.strokes
+      self.assertEqual([s.brush_color for s in strokes],
+                       [s.brush_color for s in expected])
+
+  def test_write_iter_unseekable(self):
+    class Unseekable(object):
+      def __init__(self):
+        self.data = StringIO()
+      def write(self, data):
+        self.data.write(data)
+    with copy_of_tilt() as tilt:
+      expected, actual = StringIO(), Unseekable()
+      tilt.sketch.write(expected)
+      with tilt.iter_strokes() as stream:
+        Sketch.write_iter(actual, stream, stream.header, stream.additional_header)
+      self.assertEqual(expected.getvalue(), actual.data.getvalue())
+
+
+class TestStrokeIndex(unittest.TestCase):
+  def test_index_matches_sketch(self):
+    with copy_of_tilt() as tilt:
+      index = tilt.stroke_index
+      self.assertEqual(len(index), len(tilt.sketch.strokes))
+      for (entry, stroke) in zip(index, tilt.sketch.strokes):
+        self.assertEqual(entry.brush_idx, stroke.brush_idx)
+        self.assertEqual(entry.num_cp, len(stroke.controlpoints))
+        self.assertEqual(entry.cp_mask, stroke.cp_mask)
+
+  def test_read_strokes(self):
+    with copy_of_tilt() as tilt:
+      expected = tilt.sketch.strokes
+      for (start, stop) in [(0, 5), (2, 4), (4, 10), (3, 3)]:
+        strokes = tilt.read_strokes(start, stop)
+        self.assertEqual([s.controlpoints[0].position for s in strokes],
+                         [s.controlpoints[0].position for s in expected[start:stop]])
+      self.assertEqual(tilt.read_stroke(-1).brush_color, expected[-1].brush_color)
+      self.assertRaises(IndexError, lambda: tilt.read_stroke(5))
+
+  def test_index_is_cached_and_invalidated(self):
+    with copy_of_tilt() as tilt:
+      index_filename = tilt.filename + STROKE_INDEX_SUFFIX
+      index = tilt.stroke_index
+      self.assertEqual(StrokeIndex.load(index_filename).tostring(), index.tostring())
+      del tilt.sketch.strokes[0]
+      tilt.write_sketch()
+      self.assertEqual(len(tilt.stroke_index), 4)
+      self.assertEqual(len(Tilt(tilt.filename).stroke_index), 4)
+
+  def test_unpacked_key_is_from_stat(self):
+    with copy_of_tilt(as_filename=True) as tilt_filename:
+      with Tilt.as_directory(tilt_filename) as tilt:
+        st = os.stat(os.path.join(tilt_filename, 'data.sketch'))
+        self.assertEqual(tilt.stroke_index.key, (int(st.st_mtime * 1e9), st.st_size, st.st_ino))
+        del tilt.sketch.strokes[0]
+        tilt.write_sketch()
+        self.assertEqual(len(Tilt(tilt_filename).stroke_index), 4)
+        os.unlink(tilt_filename + STROKE_INDEX_SUFFIX)
+
+  def test_unseekable_source(self):
+    import tiltbrush.unpack
+    with copy_of_tilt() as tilt:
+      expected = StrokeIndex.build(tilt).tostring()
+      tiltbrush.unpack.convert_zip_to_dir(tilt.filename)
+      tiltbrush.unpack.convert_dir_to_zip(tilt.filename, True)
+      self.assertEqual(StrokeIndex.build(tilt).tostring(), expected)
+      self.assertEqual(tilt.read_stroke(3).brush_color,
+                       tilt.sketch.strokes[3].brush_color)
+
+
+class TestSketchProbe(unittest.TestCase):
+  def test_probe_matches_sketch(self):
+    with copy_of_tilt() as tilt:
+      probe = Sketch.probe(tilt)
+      sketch = tilt.sketch
+      self.assertEqual(probe.header, sketch.header)
+      self.assertEqual(len(probe.strokes), len(sketch.strokes))
+      for (header, stroke) in zip(probe.strokes, sketch.strokes):
+        self.assertEqual(header.brush_idx, stroke.brush_idx)
+        self.assertEqual(header.brush_color, stroke.brush_color)
+        self.assertEqual(header.extension, stroke.extension)
+        self.assertEqual(header.cp_ext_lookup, stroke.cp_ext_lookup)
+        self.assertEqual(header.num_controlpoints, len(stroke.controlpoints))
+      self.assertEqual(sum(probe.brush_counts().values()), len(sketch.strokes))
+
+  def test_control_points_are_not_read(self):
+    class CountingFile(object):
+      def __init__(self, data):
+        self.inf = StringIO(data)
+        self.num_read = 0
+      def read(self, n):
+        data = self.inf.read(n)
+        self.num_read += len(data)
+        return data
+      def seek(self, offset, whence=0):
+        self.inf.seek(offset, whence)
+    with copy_of_tilt() as tilt:
+      with tilt.subfile_reader('data.sketch') as inf:
+        data = inf.read()
+      inf = CountingFile(data)
+      probe = Sketch.probe(inf)
+      self.assertEqual(len(probe.strokes), 5)
+      self.assertLess(inf.num_read, 50 * len(probe.strokes))
+
+
+class TestBounds(unittest.TestCase):
+  def expected(self, strokes):
+    positions = [cp.position for s in strokes for cp in s.controlpoints]
+    return (tuple(map(min, *positions)), tuple(map(max, *positions)))
+
+  def test_stroke_bounds(self):
+    with copy_of_tilt() as tilt:
+      for (stroke, decoded) in zip(tilt.sketch.strokes, Tilt(tilt.filename).sketch.strokes):
+        self.assertEqual(stroke.bounds, self.expected([decoded]))
+        self.assertNotIn('controlpoints', stroke.__dict__)
+      decoded.controlpoints[0].position = [100, 0, 0]
+      self.assertEqual(decoded.bounds[1][0], 100)
+
+  @unittest.skipIf(numpy is None, 'requires numpy')
+  def test_cache_is_invalidated(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      stroke = sketch.strokes[0]
+      bounds = stroke.bounds
+      self.assertIs(stroke.bounds, bounds)
+      sketch.apply_transform([1, 0, 0], strokes=[stroke])
+      self.assertAlmostEqual(stroke.bounds[0][0], bounds[0][0] + 1, places=5)
+
+  def test_sketch_bounds(self):
+    with copy_of_tilt() as tilt:
+      expected = self.expected(tilt.sketch.strokes)
+      self.assertEqual(tilt.sketch.bounds, expected)
+      self.assertEqual(Sketch.probe(tilt, bounds=True).bounds, expected)
+      self.assertIsNone(Sketch.probe(tilt).bounds)
+      if numpy is not None:
+        sketch = Sketch(tilt, layout='columnar')
+        self.assertEqual(sketch.bounds, expected)
+        del sketch.strokes[0]
+        self.assertEqual(sketch.bounds, self.expected(sketch.strokes))
+
+
+class TestControlPointDecoding(unittest.TestCase):
+  @staticmethod
+  def scaled_up_sketch(factor=40):
+    """Returns sketch1's data.sketch with every stroke repeated *factor* times."""
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      sketch.strokes = sketch.strokes * factor
+      outf = StringIO()
+      sketch.write(outf)
+      return outf.getvalue()
+
+  def test_decodings_agree(self):
+    import tiltbrush.tilt
+    data = self.scaled_up_sketch(2)
+    def decode_all():
+      return [[(cp.position, cp.orientation, cp.extension) for cp in stroke.controlpoints]
+              for stroke in Sketch(StringIO(data)).strokes]
+    expected = []
+    for stroke in Sketch(StringIO(data)).strokes:
+      (_, num_cp, raw_data) = stroke._controlpoints
+      b = tiltbrush.tilt.binfile(StringIO(raw_data))
+      reader = tiltbrush.tilt._make_cp_ext_reader(stroke.cp_mask)[0]
+      expected.append([(cp.position, cp.orientation, cp.extension) for cp in
+                       (ControlPoint.from_file(b, reader) for i in xrange(num_cp))])
+    self.assertEqual(decode_all(), expected)
+    saved_numpy, tiltbrush.tilt.numpy = tiltbrush.tilt.numpy, None
+    try:
+      self.assertEqual(decode_all(), expected)
+    finally:
+      tiltbrush.tilt.numpy = saved_numpy
+
+  @unittest.skipUnless(os.environ.get('TILTBRUSH_BENCHMARKS'),
+                       'set TILTBRUSH_BENCHMARKS=1 to run benchmarks')
+  def test_batched_decoding_benchmark(self):
+    import sys
+    import timeit
+    import tiltbrush.tilt
+    data = self.scaled_up_sketch()
+    strokes = Sketch(StringIO(data)).strokes
+    raw = [(stroke.cp_mask,) + stroke._controlpoints[1:] for stroke in strokes]
+    def per_point():
+      decoded = []
+      for (cp_mask, num_cp, raw_data) in raw:
+        b = tiltbrush.tilt.binfile(StringIO(raw_data))
+        reader = tiltbrush.tilt._make_cp_ext_reader(cp_mask)[0]
+        decoded.append([ControlPoint.from_file(b, reader) for i in xrange(num_cp)])
+      return decoded
+    def batched():
+      return [tiltbrush.tilt._make_cp_codec(cp_mask)[0](raw_data, num_cp)
+              for (cp_mask, num_cp, raw_data) in raw]
+    def values(decoded):
+      return [[(cp.position, cp.orientation, cp.extension) for cp in cps] for cps in decoded]
+    self.assertEqual(values(batched()), values(per_point()))
+    per_point_time = min(timeit.repeat(per_point, number=1, repeat=3))
+    batched_time = min(timeit.repeat(batched, number=1, repeat=3))
+    sys.stderr.write('\n%d control points: per-point %.3fs, batched %.3fs (%.1fx)\n' % (
+      sum(r[1] for r in raw), per_point_time, batched_time, per_point_time / batched_time))
+
+
+class TestSelect(unittest.TestCase):
+  def test_filters(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      strokes = sketch.strokes
+      brush_index = tilt.metadata['BrushIndex']
+      def selected(**criteria):
+        view = sketch.select(**criteria)
+        self.assertTrue(all(a is b for (a, b) in zip(view.strokes, [strokes[i] for i in view.indices])))
+        return view.indices
+
+      self.assertEqual(selected(), range(len(strokes)))
+      brush_idx = strokes[2].brush_idx
+      by_idx = [i for (i, s) in enumerate(strokes) if s.brush_idx == brush_idx]
+      self.assertEqual(selected(brush=brush_idx), by_idx)
+      self.assertEqual(selected(brush=brush_index[brush_idx].upper(), brush_index=brush_index),
+                       by_idx)
+      self.assertRaises(ValueError, sketch.select, brush=brush_index[brush_idx])
+      self.assertEqual(selected(size=(strokes[1].brush_size,) * 2),
+                       [i for (i, s) in enumerate(strokes) if s.brush_size == strokes[1].brush_size])
+      color = strokes[0].brush_color
+      self.assertEqual(selected(color=(color, color))[0], 0)
+      self.assertEqual(selected(group=0), range(len(strokes)))
+      self.assertEqual(selected(group=[1, 2]), [])
+
+      i = strokes[3].cp_ext_lookup['timestamp']
+      timestamps = [cp.extension[i] for cp in strokes[3].controlpoints]
+      in_window = selected(time=(min(timestamps), min(timestamps)))
+      self.assertIn(3, in_window)
+      for j in in_window:
+        stamps = [cp.extension[i] for cp in strokes[j].controlpoints]
+        self.assertTrue(min(stamps) <= min(timestamps) <= max(stamps))
+
+      (lo, hi) = strokes[4].bounds
+      in_box = selected(bbox=(lo, hi))
+      self.assertIn(4, in_box)
+      self.assertEqual(sketch.select(bbox=(lo, hi)).select(brush=brush_idx).indices,
+                       [j for j in in_box if j in by_idx])
+
+  def test_write_view(self):
+    with copy_of_tilt() as tilt:
+      view = tilt.sketch.select(bbox=tilt.sketch.strokes[4].bounds)
+      self.assertFalse(any('controlpoints' in s.__dict__ for s in view.strokes))
+      expected = StringIO()
+      Sketch.write_iter(expected, [s.clone() for s in view.strokes], tilt.sketch.header)
+      self.assertEqual(view.write(tilt), len(view))
+      written = Tilt(tilt.filename).sketch
+      actual = StringIO()
+      written.write(actual)
+      self.assertEqual(actual.getvalue(), expected.getvalue())
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestTimeline(unittest.TestCase):
+  def stroke_times(self, sketch):
+    times = []
+    for stroke in sketch.strokes:
+      i = stroke.cp_ext_lookup['timestamp']
+      times.append([cp.extension[i] for cp in stroke.controlpoints])
+    return times
+
+  def test_between(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      timeline = sketch.timeline
+      self.assertIs(sketch.timeline, timeline)
+      times = self.stroke_times(sketch)
+      (first, last) = timeline.time_range
+      self.assertEqual((first, last), (min(map(min, times)), max(map(max, times))))
+      for t0 in numpy.linspace(first - 10, last + 10, 13):
+        for t1 in numpy.linspace(t0, last + 10, 5):
+          expected = [i for (i, ts) in enumerate(times) if min(ts) <= t1 and max(ts) >= t0]
+          self.assertEqual(timeline.between(t0, t1).tolist(), expected)
+      middle = (first + last) / 2
+      self.assertEqual(sorted(timeline.started_by(middle).tolist()),
+                       [i for (i, ts) in enumerate(times) if min(ts) <= middle])
+      self.assertEqual(sorted(timeline.finished_by(middle).tolist()),
+                       [i for (i, ts) in enumerate(times) if max(ts) <= middle])
+
+  def test_replay(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      times = self.stroke_times(sketch)
+      frames = list(sketch.timeline.replay(fps=30))
+      frame_times = [t for (t, _) in frames]
+      self.assertEqual(frame_times, sorted(set(frame_times)))
+      self.assertEqual(frame_times[-1], sketch.timeline.time_range[1])
+      drawn = [0] * len(times)
+      for (t, increments) in frames:
+        for (i, cp_start, cp_stop) in increments:
+          self.assertEqual(cp_start, drawn[i])
+          self.assertTrue(max(times[i][:cp_stop]) <= t)
+          drawn[i] = cp_stop
+      self.assertEqual(drawn, map(len, times))
+
+
+class TestBlobExtensions(unittest.TestCase):
+  # Stroke extension bits above 0xffff are length-prefixed blobs
+  BLOBS = {0x10000: 'some bytes', 0x40000: ''}
+
+  def make_sketch(self, tilt):
+    sketch = tilt.sketch
+    for (i, stroke) in enumerate(sketch.strokes):
+      values = dict((name, stroke.get_stroke_extension(name)) for name in stroke.stroke_ext_lookup)
+      stroke.stroke_mask |= 0x4 | sum(self.BLOBS)
+      values.update(group=i, stroke_ext_16=self.BLOBS[0x10000] * i, stroke_ext_18='')
+      (_, stroke.stroke_ext_writer, stroke.stroke_ext_lookup) = \
+          tiltbrush.tilt._make_stroke_ext_reader(stroke.stroke_mask)
+      stroke.extension = [None] * len(values)
+      for (name, value) in values.iteritems():
+        stroke.extension[stroke.stroke_ext_lookup[name]] = value
+    return sketch
+
+  def test_round_trip(self):
+    with copy_of_tilt() as tilt:
+      sketch = self.make_sketch(tilt)
+      data = StringIO()
+      sketch.write(data)
+      read = Sketch(StringIO(data.getvalue()))
+      for (i, stroke) in enumerate(read.strokes):
+        self.assertEqual(stroke.get_stroke_extension('stroke_ext_16'), self.BLOBS[0x10000] * i)
+        self.assertEqual(stroke.get_stroke_extension('stroke_ext_18'), '')
+        self.assertEqual(stroke.group, i)
+        self.assertEqual(stroke.extension, sketch.strokes[i].extension)
+      again = StringIO()
+      read.write(again)
+      self.assertEqual(again.getvalue(), data.getvalue())
+      probe = Sketch.probe(StringIO(data.getvalue()))
+      self.assertEqual([s.extension for s in probe.strokes], [s.extension for s in read.strokes])
+
+
+class TestDedupe(unittest.TestCase):
+  def test_exact(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      originals = list(sketch.strokes)
+      copies = [originals[3].clone(), originals[1].shallow_clone()]
+      sketch.strokes.extend(copies)
+      self.assertEqual(copies[0].fingerprint(), originals[3].fingerprint())
+      self.assertNotEqual(originals[0].fingerprint(), originals[3].fingerprint())
+      expected_bytes = StringIO()
+      Sketch.write_iter(expected_bytes, copies, sketch.header)
+      empty = StringIO()
+      Sketch.write_iter(empty, [], sketch.header)
+      self.assertEqual(sketch.dedupe(), (2, len(expected_bytes.getvalue()) - len(empty.getvalue())))
+      self.assertEqual(sketch.strokes, originals)
+      self.assertEqual(sketch.dedupe(), (0, 0))
+
+  @unittest.skipIf(numpy is None, 'requires numpy')
+  def test_tolerance(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      originals = list(sketch.strokes)
+      for (i, offset) in ((2, 0.004), (4, 0.02)):
+        copy = originals[i].clone()
+        records = copy.controlpoint_array()
+        records['position'] += offset
+        records['timestamp'] += 1000
+        copy.set_controlpoint_array(records)
+        sketch.strokes.append(copy)
+      self.assertEqual(sketch.dedupe()[0], 0)
+      self.assertEqual(sketch.dedupe(tolerance=0.01)[0], 1)
+      self.assertEqual(sketch.strokes[:-1], originals)
+      self.assertEqual(sketch.dedupe(tolerance=0.05)[0], 1)
+      self.assertEqual(sketch.strokes, originals)
+      # Strokes that render differently aren't duplicates
+      for (name, value) in (('scale', 2.0), ('group', 3)):
+        copy = originals[1].clone()
+        copy.set_stroke_extension(name, value)
+        sketch.strokes.append(copy)
+        self.assertEqual(sketch.dedupe(tolerance=0.05)[0], 0)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestColumns(unittest.TestCase):
+  def test_cp_column(self):
+    for layout in Sketch.LAYOUTS:
+      with copy_of_tilt() as tilt:
+        sketch = Sketch(tilt, layout=layout)
+        (timestamps, offsets) = sketch.cp_column('timestamp')
+        (positions, _) = sketch.cp_column('position')
+        self.assertEqual(timestamps.dtype, numpy.uint32)
+        self.assertEqual(positions.shape, (offsets[-1], 3))
+        for (i, stroke) in enumerate(Tilt(tilt.filename).sketch.strokes):
+          idx = stroke.cp_ext_lookup['timestamp']
+          self.assertEqual(timestamps[offsets[i]:offsets[i+1]].tolist(),
+                           [cp.extension[idx] for cp in stroke.controlpoints])
+        self.assertEqual(sketch.cp_column('cp_ext_5')[0].tolist(), [])
+        self.assertRaises(ValueError, sketch.cp_column, 'colour')
+
+        sketch.set_cp_column('timestamp', timestamps + 1000)
+        sketch.set_cp_column('position', positions * 2)
+        self.assertRaises(ValueError, sketch.set_cp_column, 'timestamp', timestamps[1:])
+        if layout == 'columnar':
+          self.assertEqual(sketch.positions.tolist(), (positions * 2).tolist())
+        sketch.write(tilt)
+        written = Sketch(tilt)
+        self.assertEqual(written.cp_column('timestamp')[0].tolist(), (timestamps + 1000).tolist())
+        self.assertEqual(written.cp_column('position')[0].tolist(), (positions * 2).tolist())
+
+  def test_stroke_column(self):
+    with copy_of_tilt() as tilt:
+      sketch = tilt.sketch
+      self.assertRaises(LookupError, sketch.stroke_column, 'scale')
+      self.assertEqual(sketch.stroke_column('scale', 1).tolist(), [1] * 5)
+      self.assertEqual(sketch.stroke_column('brush_color').tolist(),
+                       [list(s.brush_color) for s in sketch.strokes])
+      sketch.strokes[2].scale = 4
+      sketch.set_stroke_column('scale', numpy.arange(5) * 0.5)
+      sketch.set_stroke_column('brush_size', sketch.stroke_column('brush_size') * 2)
+      sizes = [s.brush_size for s in sketch.strokes]
+      tilt.write_sketch()
+      for (i, stroke) in enumerate(Tilt(tilt.filename).sketch.strokes):
+        self.assertEqual(stroke.scale, i * 0.5)
+        self.assertEqual(stroke.flags, sketch.strokes[i].flags)
+        self.assertEqual(stroke.brush_size, sizes[i])
+
+
+class TestLargeSketch(unittest.TestCase):
+  def setUp(self):
+    limits = (tiltbrush.tilt.LARGE_SKETCH_STROKES, tiltbrush.tilt.LARGE_STROKE_CONTROLPOINTS)
+    def restore():
+      (tiltbrush.tilt.LARGE_SKETCH_STROKES, tiltbrush.tilt.LARGE_STROKE_CONTROLPOINTS) = limits
+    self.addCleanup(restore)
+
+  def test_lazy_sketch(self):
+    tiltbrush.tilt.LARGE_SKETCH_STROKES = 2
+    with copy_of_tilt() as tilt:
+      data = StringIO()
+      tilt.sketch.write(data)
+      expected = [s.fingerprint() for s in Tilt(tilt.filename).sketch.strokes]
+      for sketch in (Sketch(tilt), Sketch(StringIO(data.getvalue()))):
+        strokes = sketch.strokes
+        self.assertNotIsInstance(strokes, list)
+        self.assertEqual(len(strokes), 5)
+        self.assertIsNotNone(sketch.bounds)
+        self.assertEqual([s.fingerprint() for s in strokes], expected)
+        out = StringIO()
+        sketch.write(out)
+        self.assertEqual(out.getvalue(), data.getvalue())
+
+      sketch = Sketch(tilt)
+      strokes = sketch.strokes
+      self.assertIs(strokes[3], strokes[3])
+      strokes[3].brush_size = 1.5
+      new = strokes[0].clone()
+      new.brush_size = 2.5
+      del strokes[1]
+      strokes.insert(0, new)
+      strokes[2:2] = [new.clone()]
+      sketch.write(tilt)
+      written = Sketch(tilt)
+      self.assertEqual([s.brush_size for s in written.strokes],
+                       [2.5, strokes[1].brush_size, 2.5, strokes[3].brush_size, 1.5,
+                        strokes[5].brush_size])
+      self.assertEqual([s.fingerprint() for s in written.strokes],
+                       [s.fingerprint() for s in strokes])
+
+  def test_large_stroke(self):
+    tiltbrush.tilt.LARGE_STROKE_CONTROLPOINTS = 10
+    with copy_of_tilt() as tilt:
+      data = StringIO()
+      tilt.sketch.write(data)
+      sketch = Sketch(StringIO(data.getvalue()))
+      for (stroke, expected) in zip(sketch.strokes, tilt.sketch.strokes):
+        raw_data = stroke._controlpoints[2]
+        self.assertEqual(isinstance(raw_data, buffer), stroke.num_controlpoints > 10)
+        self.assertEqual(str(raw_data), str(expected._controlpoints[2]))
+
+  def test_large_strokes_share_a_file(self):
+    import tempfile
+    tiltbrush.tilt.LARGE_STROKE_CONTROLPOINTS = 10
+    real_temporary_file = tempfile.TemporaryFile
+    calls = []
+    def counting_temporary_file(*args, **kwargs):
+      calls.append(args)
+      return real_temporary_file(*args, **kwargs)
+    with copy_of_tilt() as tilt:
+      data = StringIO()
+      tilt.sketch.write(data)
+      expected = [str(s._controlpoints[2]) for s in tilt.sketch.strokes]
+      num_large = sum(1 for s in tilt.sketch.strokes if s.num_controlpoints > 10)
+      self.assertGreater(num_large, 1)
+      tempfile.TemporaryFile = counting_temporary_file
+      try:
+        sketch = Sketch(StringIO(data.getvalue()))
+      finally:
+        tempfile.TemporaryFile = real_temporary_file
+      self.assertEqual(len(calls), 1)
+      self.assertEqual([str(s._controlpoints[2]) for s in sketch.strokes], expected)
+      self.assertRaises(tiltbrush.tilt.BadTilt, Sketch, StringIO(data.getvalue()[:-100]))
+
+  def test_lazy_dedupe(self):
+    tiltbrush.tilt.LARGE_SKETCH_STROKES = 2
+    with copy_of_tilt() as tilt:
+      strokes = tilt.sketch.strokes
+      expected = [s.fingerprint() for s in strokes]
+      strokes.extend([s.clone() for s in strokes])
+      data = StringIO()
+      tilt.sketch.write(data)
+      for tolerance in (0, 1e-6):
+        sketch = Sketch(StringIO(data.getvalue()))
+        (num_removed, num_bytes) = sketch.dedupe(tolerance)
+        self.assertEqual(num_removed, 5)
+        self.assertEqual(len(sketch.strokes), 5)
+        # The strokes kept are still unparsed
+        self.assertTrue(all(isinstance(item, (int, long)) for item in sketch.strokes._items))
+        self.assertEqual([s.fingerprint() for s in sketch.strokes], expected)
+
+  def test_truncated(self):
+    with copy_of_tilt() as tilt:
+      data = StringIO()
+      tilt.sketch.write(data)
+      for large in (300000, 2):
+        tiltbrush.tilt.LARGE_SKETCH_STROKES = large
+        self.assertRaises(tiltbrush.tilt.BadTilt, Sketch, StringIO(data.getvalue()[:-100]))
+
+  def test_million_strokes(self):
+    import struct
+    import tempfile
+    num_strokes = 1000000
+    # A stroke with no extensions and no control points
+    stroke = struct.pack('<i4ffIIi', 3, 1, 0, 0, 1, 0.5, 0, 0, 0)
+    (fd, filename) = tempfile.mkstemp(suffix='.sketch')
+    try:
+      with os.fdopen(fd, 'wb') as outf:
+        outf.write(struct.pack('<3IIi', 0, 0, 0, 0, num_strokes) + stroke * num_strokes)
+      sketch = Sketch(filename)
+      self.assertEqual(len(sketch.strokes), num_strokes)
+      self.assertEqual(len(sketch.strokes._items), num_strokes)
+      sketch.strokes[-1].brush_idx = 4
+      sketch.write(filename)
+      strokes = Sketch(filename).strokes
+      self.assertEqual(len(strokes), num_strokes)
+      self.assertEqual((strokes[0].brush_idx, strokes[-1].brush_idx), (3, 4))
+      self.assertEqual(os.path.getsize(filename), 20 + len(stroke) * num_strokes)
+    finally:
+      os.unlink(filename)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestApplyTransform(unittest.TestCase):
+  TRANSLATION = [1, -2, 3]
+  ROTATION = [0.1825742, 0.3651484, 0.5477226, 0.7302967]   # Normalized (1, 2, 3, 4)
+  SCALE = 2.5
+
+  def expected(self, stroke):
+    # Straightforward per-point version, to check against
+    def qmul((x0, y0, z0, w0), (x1, y1, z1, w1)):
+      return [w0*x1 + x0*w1 + y0*z1 - z0*y1, w0*y1 + y0*w1 + z0*x1 - x0*z1,
+              w0*z1 + z0*w1 + x0*y1 - y0*x1, w0*w1 - x0*x1 - y0*y1 - z0*z1]
+    (x, y, z, w) = self.ROTATION
+    positions, orientations = [], []
+    for cp in stroke.controlpoints:
+      p = qmul(qmul(self.ROTATION, [self.SCALE * c for c in cp.position] + [0]), [-x, -y, -z, w])
+      positions.append([a + b for (a, b) in zip(p, self.TRANSLATION)])
+      orientations.append(qmul(self.ROTATION, cp.orientation))
+    return (positions, orientations)
+
+  def check(self, strokes, expected):
+    for (stroke, (positions, orientations)) in zip(strokes, expected):
+      self.assertTrue(numpy.allclose([cp.position for cp in stroke.controlpoints], positions,
+                                     atol=1e-4))
+      self.assertTrue(numpy.allclose([cp.orientation for cp in stroke.controlpoints],
+                                     orientations, atol=1e-5))
+
+  def transform(self, sketch, strokes=None):
+    sketch.apply_transform(self.TRANSLATION, self.ROTATION, self.SCALE, strokes)
+
+  def test_undecoded_strokes(self):
+    with copy_of_tilt() as tilt:
+      expected = [self.expected(s) for s in Tilt(tilt.filename).sketch.strokes]
+      self.transform(tilt.sketch)
+      self.assertFalse(any('controlpoints' in s.__dict__ for s in tilt.sketch.strokes))
+      tilt.write_sketch()
+      strokes = Tilt(tilt.filename).sketch.strokes
+      self.check(strokes, expected)
+      self.assertEqual([s.scale for s in strokes], [self.SCALE] * len(strokes))
+
+  def test_decoded_strokes(self):
+    with copy_of_tilt() as tilt:
+      strokes = tilt.sketch.strokes
+      expected = [self.expected(s) for s in strokes]
+      self.transform(tilt.sketch)
+      self.check(strokes, expected)
+
+  def test_columnar_subset(self):
+    with copy_of_tilt() as tilt:
+      original = tilt.sketch.strokes
+      sketch = Sketch(tilt, layout='columnar')
+      subset = [sketch.strokes[1], sketch.strokes[3]]
+      self.transform(sketch, subset)
+      for i in (0, 2, 4):
+        self.assertEqual(sketch.strokes[i].controlpoints[0].position,
+                         original[i].controlpoints[0].position)
+        self.assertRaises(AttributeError, lambda: sketch.strokes[i].scale)
+      self.check(subset, [self.expected(original[1]), self.expected(original[3])])
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestColumnarSketch(unittest.TestCase):
+  def test_columns_match_objects(self):
+    with copy_of_tilt() as tilt:
+      sketch = Sketch(tilt, layout='columnar')
+      for (i, stroke) in enumerate(tilt.sketch.strokes):
+        start, stop = sketch.cp_offsets[i], sketch.cp_offsets[i+1]
+        self.assertEqual(stop - start, len(stroke.controlpoints))
+        for (j, cp) in enumerate(stroke.controlpoints):
+          self.assertEqual(sketch.positions[start + j].tolist(), cp.position)
+          self.assertEqual(sketch.orientations[start + j].tolist(), cp.orientation)
+          view = sketch.strokes[i].controlpoints[j]
+          self.assertEqual(list(view.extension), cp.extension)
+
+  def test_write_is_identical(self):
+    with copy_of_tilt() as tilt:
+      expected, actual = StringIO(), StringIO()
+      tilt.sketch.write(expected)
+      Sketch(tilt, layout='columnar').write(actual)
+      self.assertEqual(expected.getvalue(), actual.getvalue())
+
+  def test_views_write_through(self):
+    with copy_of_tilt() as tilt:
+      sketch = Sketch(tilt, layout='columnar')
+      cp = sketch.strokes[1].controlpoints[2]
+      cp.position[1] = 3
+      cp.orientation = [0, 0, 0, 1]
+      self.assertEqual(sketch.positions[sketch.cp_offsets[1] + 2][1], 3)
+      sketch.positions[sketch.cp_offsets[2], 0] = 5
+      sketch.write(tilt)
+      strokes = Tilt(tilt.filename).sketch.strokes
+      self.assertEqual(strokes[1].controlpoints[2].position[1], 3)
+      self.assertEqual(strokes[1].controlpoints[2].orientation, [0, 0, 0, 1])
+      self.assertEqual(strokes[2].controlpoints[0].position[0], 5)
+
+  def test_views_are_lists(self):
+    with copy_of_tilt() as tilt:
+      expected = tilt.sketch.strokes[1].controlpoints[2]
+      cp = Sketch(tilt, layout='columnar').strokes[1].controlpoints[2]
+      for attr in ('position', 'orientation', 'extension'):
+        self.assertIsInstance(getattr(cp, attr), list)
+        self.assertEqual(getattr(cp, attr), getattr(expected, attr))
+        self.assertTrue(getattr(cp, attr) == getattr(expected, attr))
+      self.assertEqual(cp.orientation + [0], expected.orientation + [0])
+      cp.extension[1] += 5
+      self.assertEqual(cp.extension[1], expected.extension[1] + 5)
+
+  def test_clone_is_detached(self):
+    with copy_of_tilt() as tilt:
+      sketch = Sketch(tilt, layout='columnar')
+      clone = sketch.strokes[0].clone()
+      self.assertNotIn('controlpoints', sketch.strokes[0].__dict__)
+      self.assertEqual(clone.fingerprint(), sketch.strokes[0].fingerprint())
+      clone.controlpoints[0].position[0] += 1
+      self.assertNotEqual(sketch.positions[0][0], clone.controlpoints[0].position[0])
+
+
 if __name__ == '__main__':
   unittest.main()